@@ -1,32 +1,280 @@
-import sqlite3
-
-DB_NAME = "materials.db"
-
-conn = sqlite3.connect(DB_NAME)
-cursor = conn.cursor()
-
-# Show orders and their product names (if exist)
-print("Before cleanup:")
-for row in cursor.execute("""
-    SELECT o.order_id, o.product_id, m.id, m.name
-    FROM manufacturing_orders o
-    LEFT JOIN Materials m ON o.product_id = m.id
-"""):
-    print(row)
-
-# Delete invalid orders (with missing product)
-cursor.execute("""
-    DELETE FROM manufacturing_orders
-    WHERE product_id NOT IN (SELECT id FROM Materials)
-""")
-conn.commit()
-
-print("\nAfter cleanup:")
-for row in cursor.execute("""
-    SELECT o.order_id, o.product_id, m.id, m.name
-    FROM manufacturing_orders o
-    LEFT JOIN Materials m ON o.product_id = m.id
-"""):
-    print(row)
-
-conn.close()
+import os
+import sys
+from datetime import datetime, timedelta
+import database
+
+# ANALYZE / optimize / vacuum run at most this often unless forced
+MAINTENANCE_INTERVAL_DAYS = 7
+
+# Example rows shown per problem in the report
+SAMPLE_ROWS = 10
+
+# Stored prices further than this from the recomputed ones are stale
+PRICE_TOLERANCE = 1e-6
+
+# (name, rows shown in the report, statements that repair them).
+# Every repair is one set-based statement; they run in this order inside one
+# transaction, so later checks see the result of earlier ones.
+CHECKS = [
+    (
+        "orders with a missing product",
+        """
+            SELECT o.order_id, o.product_id, o.date
+            FROM manufacturing_orders o
+            WHERE o.product_id NOT IN (SELECT id FROM Materials)
+        """,
+        ["DELETE FROM manufacturing_orders WHERE product_id NOT IN (SELECT id FROM Materials)"],
+    ),
+    (
+        "order lines of missing orders",
+        """
+            SELECT oi.id, oi.order_id, oi.ingredient_id, oi.quantity
+            FROM order_ingredients oi
+            WHERE oi.order_id NOT IN (SELECT order_id FROM manufacturing_orders)
+        """,
+        ["DELETE FROM order_ingredients WHERE order_id NOT IN (SELECT order_id FROM manufacturing_orders)"],
+    ),
+    (
+        "stock movements of missing orders (reversed by an adjustment)",
+        """
+            SELECT order_id, material_id, SUM(quantity) AS quantity
+            FROM inventory_movements
+            WHERE order_id IS NOT NULL
+              AND order_id NOT IN (SELECT order_id FROM manufacturing_orders)
+              AND order_id NOT IN (SELECT order_id FROM temp.archived_orders)
+            GROUP BY order_id, material_id
+            HAVING ABS(SUM(quantity)) > 1e-9
+        """,
+        # inventory_movements is append-only: the reversal keeps the order_id,
+        # so the order nets to zero and is not reported again
+        ["""
+            INSERT INTO inventory_movements (material_id, kind, quantity, order_id, notes)
+            SELECT material_id, 'adjustment', -SUM(quantity), order_id,
+                   'cleanup: order ' || order_id || ' no longer exists'
+            FROM inventory_movements
+            WHERE order_id IS NOT NULL
+              AND order_id NOT IN (SELECT order_id FROM manufacturing_orders)
+              AND order_id NOT IN (SELECT order_id FROM temp.archived_orders)
+            GROUP BY order_id, material_id
+            HAVING ABS(SUM(quantity)) > 1e-9
+        """],
+    ),
+    (
+        "formula lines of deleted materials",
+        """
+            SELECT f.id, f.product_id, f.ingredient_id, f.quantity
+            FROM Formulas f
+            WHERE f.product_id NOT IN (SELECT id FROM Materials)
+               OR f.ingredient_id NOT IN (SELECT id FROM Materials)
+        """,
+        ["""
+            DELETE FROM Formulas
+            WHERE product_id NOT IN (SELECT id FROM Materials)
+               OR ingredient_id NOT IN (SELECT id FROM Materials)
+        """],
+    ),
+    (
+        "duplicate formula lines (merged, quantities added up)",
+        """
+            SELECT p.name AS product, i.name AS ingredient, COUNT(*) AS lines, SUM(f.quantity) AS quantity
+            FROM Formulas f
+            JOIN Materials p ON p.id = f.product_id
+            JOIN Materials i ON i.id = f.ingredient_id
+            GROUP BY f.product_id, f.ingredient_id
+            HAVING COUNT(*) > 1
+        """,
+        [
+            """
+                UPDATE Formulas SET quantity = (
+                    SELECT SUM(g.quantity) FROM Formulas g
+                    WHERE g.product_id = Formulas.product_id AND g.ingredient_id = Formulas.ingredient_id
+                )
+                WHERE id IN (
+                    SELECT MIN(id) FROM Formulas GROUP BY product_id, ingredient_id HAVING COUNT(*) > 1
+                )
+            """,
+            """
+                DELETE FROM Formulas
+                WHERE id NOT IN (SELECT MIN(id) FROM Formulas GROUP BY product_id, ingredient_id)
+            """,
+        ],
+    ),
+    (
+        "stale formula flags (has_formula, ingredient_count, level)",
+        """
+            SELECT id, name, has_formula, ingredient_count, level, count, new_level
+            FROM (
+                SELECT id, name, has_formula, ingredient_count, level,
+                       (SELECT COUNT(*) FROM Formulas f WHERE f.product_id = Materials.id) AS count,
+                       {level_sql} AS new_level
+                FROM Materials
+            )
+            WHERE ingredient_count != count OR has_formula != (count > 0) OR level != new_level
+        """,
+        ["""
+            UPDATE Materials SET
+                ingredient_count = s.count,
+                has_formula = s.count > 0,
+                level = s.new_level
+            FROM (
+                SELECT id,
+                       (SELECT COUNT(*) FROM Formulas f WHERE f.product_id = Materials.id) AS count,
+                       {level_sql} AS new_level
+                FROM Materials
+            ) AS s
+            WHERE Materials.id = s.id
+              AND (ingredient_count != s.count OR has_formula != (s.count > 0) OR level != s.new_level)
+        """],
+    ),
+]
+
+
+def run(apply=False, force=False, out=sys.stdout):
+    """
+    Find and repair inconsistent data, then run the periodic maintenance.
+    Without apply it is a dry run: the repairs are executed in a transaction
+    that is rolled back, so the report shows exactly what --apply would change.
+    Returns the number of rows that were (or would be) repaired.
+    """
+    database.create_tables()
+    backup = None
+    if apply:
+        # Copy of the database as it was, removed again if there was nothing to repair
+        folder = os.path.join(os.path.dirname(os.path.abspath(database.DB_NAME)), "backups")
+        backup = database.backup_database(folder)
+
+    conn = database.open_connection()
+    cursor = conn.cursor()
+    print("Dry run: nothing is changed (use --apply)\n" if not apply else "Repairing\n", file=out)
+
+    _collect_archived_orders(cursor)
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        repaired = _repair(cursor, out)
+        if apply:
+            conn.commit()
+        else:
+            conn.rollback()
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
+
+    if backup and repaired:
+        print(f"\nbackup: {backup}", file=out)
+    elif backup:
+        os.remove(backup)
+
+    try:
+        _maintain(conn, apply, force, out)
+    finally:
+        conn.close()
+    return repaired
+
+
+def _collect_archived_orders(cursor):
+    """
+    Fill temp.archived_orders with the ids of the orders moved to archive files,
+    whose movements are not orphans. ATTACH cannot run inside the repair transaction.
+    """
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS archived_orders (order_id INTEGER PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.archived_orders")
+    cursor.connection.commit()
+    for archive in database.list_archives():
+        database._attach_archive(cursor, archive.path)
+        try:
+            cursor.execute("INSERT OR IGNORE INTO temp.archived_orders SELECT order_id FROM archive.manufacturing_orders")
+        finally:
+            cursor.connection.commit()
+            cursor.execute("DETACH DATABASE archive")
+
+
+def _repair(cursor, out):
+    level_sql = database._BOM_LEVEL_SQL.format(max_depth=database.MAX_FORMULA_DEPTH)
+    total = 0
+    for name, report_sql, repair_sqls in CHECKS:
+        rows = cursor.execute(report_sql.format(level_sql=level_sql)).fetchall()
+        for sql in repair_sqls:
+            cursor.execute(sql.format(level_sql=level_sql))
+        _report(out, name, rows)
+        total += len(rows)
+
+    stale = _stale_prices(cursor)
+    cursor.executemany("UPDATE Materials SET price = ? WHERE id = ?", [(new, pid) for pid, (_, new, _) in stale.items()])
+    # Every price is exact now, so no flag of the lazy price mode is needed
+    cursor.execute("UPDATE Materials SET price_dirty = 0 WHERE price_dirty = 1")
+    _report(out, "stale product prices", [(pid, name, old, new) for pid, (old, new, name) in stale.items()])
+    return total + len(stale)
+
+
+def _stale_prices(cursor):
+    """{product_id: (stored price, recomputed price, name)} for products whose price is out of date."""
+    cursor.execute("""
+        SELECT f.product_id, f.ingredient_id, f.quantity, p.name, p.price AS product_price, i.price AS ingredient_price
+        FROM Formulas f
+        JOIN Materials p ON p.id = f.product_id
+        LEFT JOIN Materials i ON i.id = f.ingredient_id
+    """)
+    formulas = {}
+    stored = {}
+    names = {}
+    prices = {}
+    for r in cursor.fetchall():
+        formulas.setdefault(r["product_id"], []).append((r["ingredient_id"], r["quantity"]))
+        stored[r["product_id"]] = r["product_price"] or 0.0
+        names[r["product_id"]] = r["name"]
+        prices.setdefault(r["ingredient_id"], r["ingredient_price"] or 0.0)
+    new_prices = database._recompute_prices(formulas, prices)
+    return {
+        pid: (stored[pid], new, names[pid])
+        for pid, new in new_prices.items()
+        if abs(new - stored[pid]) > PRICE_TOLERANCE
+    }
+
+
+def _report(out, name, rows):
+    print(f"{len(rows):>6}  {name}", file=out)
+    for row in rows[:SAMPLE_ROWS]:
+        print(f"        {tuple(row)}", file=out)
+    if len(rows) > SAMPLE_ROWS:
+        print(f"        ... {len(rows) - SAMPLE_ROWS} more", file=out)
+
+
+def _maintain(conn, apply, force, out):
+    """ANALYZE, PRAGMA optimize and incremental vacuum when due; integrity_check every time."""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'maintenance_last_run'").fetchone()
+    last_run = datetime.fromisoformat(row[0]) if row else None
+    due = force or last_run is None or datetime.now() - last_run >= timedelta(days=MAINTENANCE_INTERVAL_DAYS)
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    print(f"\nlast maintenance: {last_run or 'never'}; pages: {page_count}, free: {free_pages}", file=out)
+    if not due:
+        print(f"maintenance not due (every {MAINTENANCE_INTERVAL_DAYS} days, --force to run now)", file=out)
+    elif not apply:
+        print("maintenance due: ANALYZE, PRAGMA optimize, "
+              + ("incremental vacuum" if incremental else "VACUUM to enable incremental vacuum"), file=out)
+    else:
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+        if incremental:
+            conn.execute("PRAGMA incremental_vacuum")
+        else:
+            # auto_vacuum only changes with a full VACUUM, once; later runs are incremental
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('maintenance_last_run', ?)",
+            (datetime.now().isoformat(timespec="seconds"),)
+        )
+        conn.commit()
+        print(f"maintenance done; pages: {conn.execute('PRAGMA page_count').fetchone()[0]}", file=out)
+
+    problems = [r[0] for r in conn.execute("PRAGMA integrity_check")]
+    print(f"integrity_check: {', '.join(problems[:SAMPLE_ROWS])}", file=out)
+
+
+if __name__ == "__main__":
+    import main
+    main.main(["cleanup", *sys.argv[1:]])
@@ -1,20 +1,395 @@
 # database.py
 import sqlite3
+import atexit
+import csv
+import json
+import hashlib
 import shutil
 import os
-from datetime import datetime
-from collections import deque
+import random
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+from collections import deque, namedtuple
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from urllib.request import pathname2url
+from search import TrigramIndex
 
 DB_NAME = "materials.db"
 
+# Seconds a statement waits for another station's lock before failing with
+# "database is locked" (the file is shared between several PCs)
+BUSY_TIMEOUT = float(os.environ.get("MATERIALMANAGER_BUSY_TIMEOUT", 10))
+
+# Write transactions that still hit a lock are retried as a whole this many
+# times, sleeping WRITE_BACKOFF * 2**attempt seconds (with jitter) in between
+WRITE_RETRIES = 4
+WRITE_BACKOFF = 0.25
+
+# "eager": a price change is propagated to every product using the material at
+# once. "lazy": those products are only flagged (price_dirty) and recomputed
+# together on the next read that shows prices, or by refresh_dirty_prices()
+PRICE_MODE = os.environ.get("MATERIALMANAGER_PRICE_MODE", "eager")
+
+# Floor stations (--kiosk): every connection is opened read-only, so this
+# process never takes a write lock and cannot slow down the writers
+READ_ONLY = os.environ.get("MATERIALMANAGER_READ_ONLY") == "1"
+
+# Read-only connections read the file through a memory map of this size
+# instead of copying pages into their own cache
+READ_ONLY_MMAP_SIZE = 256 * 1024 * 1024
+
+# Prepared statements kept by each read-only connection
+STATEMENT_CACHE_SIZE = 256
+
+# Single-station installs on slow disks or network shares (--in-memory): the
+# database is loaded into RAM at startup and written back with flush_to_disk()
+IN_MEMORY = os.environ.get("MATERIALMANAGER_IN_MEMORY") == "1"
+
+# In-memory mode: every committed write call is appended (and fsync'd) to this
+# file next to the database until the next flush, and replayed after a crash
+REDO_JOURNAL_SUFFIX = "-redo"
+
+# Lock contention seen by this process: write transactions started (lock_waits),
+# the seconds they spent blocked in BEGIN IMMEDIATE waiting for the write lock
+# (inside busy_timeout) and the longest such wait; retried transactions,
+# transactions that gave up and the seconds slept between attempts
+lock_stats = {
+    "lock_waits": 0, "lock_wait_seconds": 0.0, "lock_wait_max": 0.0,
+    "retries": 0, "failures": 0, "backoff_seconds": 0.0,
+}
+
+
+class ConcurrentModificationError(Exception):
+    """The row was changed by another station after it was read (stale row_version)."""
+
 
 def connect():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    unit = getattr(_thread_state, "unit_of_work", None)
+    if unit is not None:
+        joined = _JoinedConnection(unit)
+        return joined, joined.cursor()
+    bound = getattr(_thread_state, "connection", None)
+    if bound is not None:
+        return bound, bound.cursor()
+    conn = open_connection()
     cursor = conn.cursor()
     return conn, cursor
 
 
+def open_connection(read_only=False):
+    if _memory is not None:
+        # Every connection works on the RAM copy; flush_to_disk() writes it back
+        conn = sqlite3.connect(_memory.uri, uri=True, timeout=BUSY_TIMEOUT)
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+    elif read_only or READ_ONLY:
+        # mode=ro: SQLite opens the file read-only and never asks for a write lock
+        uri = f"file:{pathname2url(os.path.abspath(DB_NAME))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute(f"PRAGMA mmap_size = {READ_ONLY_MMAP_SIZE}")
+        conn.execute("PRAGMA query_only = ON")
+    else:
+        conn = sqlite3.connect(DB_NAME, timeout=BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def data_version():
+    """
+    PRAGMA data_version of the connection connect() hands out: it changes when
+    another connection commits. Only meaningful on a bound connection.
+    """
+    conn, cursor = connect()
+    version = cursor.execute("PRAGMA data_version").fetchone()[0]
+    conn.close()
+    return version
+
+
+# Long-lived connections bound to a thread (server workers): connect() hands
+# them out instead of opening a new one each call
+_thread_state = threading.local()
+
+
+class _BoundConnection:
+    """Stand-in returned by connect() for a bound connection; close() only ends an unfinished transaction."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn.in_transaction:
+            self._conn.rollback()
+
+
+class _JoinedConnection(_BoundConnection):
+    """
+    Returned by connect() inside transaction(). The call's own write becomes a
+    savepoint: its commit() releases it and its rollback() (or close() after an
+    error) undoes only that call; the enclosing block commits everything once.
+    """
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        self._savepoint = None
+
+    def begin(self):
+        _thread_state.savepoints = getattr(_thread_state, "savepoints", 0) + 1
+        self._savepoint = f"uow_{_thread_state.savepoints}"
+        self._conn.execute(f"SAVEPOINT {self._savepoint}")
+
+    def commit(self):
+        if self._savepoint is not None:
+            self._conn.execute(f"RELEASE {self._savepoint}")
+            self._savepoint = None
+
+    def rollback(self):
+        if self._savepoint is not None:
+            self._conn.execute(f"ROLLBACK TO {self._savepoint}")
+            self.commit()
+
+    def close(self):
+        self.rollback()
+
+
+def _begin_immediate(conn):
+    """BEGIN IMMEDIATE on conn (or a cursor), timing the wait for the write lock into lock_stats."""
+    start = time.perf_counter()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+    finally:
+        waited = time.perf_counter() - start
+        lock_stats["lock_waits"] += 1
+        lock_stats["lock_wait_seconds"] += waited
+        lock_stats["lock_wait_max"] = max(lock_stats["lock_wait_max"], waited)
+
+
+def _begin(conn):
+    """Start a write transaction, or a savepoint when the call joins a transaction() block."""
+    if isinstance(conn, _JoinedConnection):
+        conn.begin()
+    else:
+        _begin_immediate(conn)
+
+
+@contextmanager
+def transaction():
+    """
+    Unit of work: every database call made in this thread inside the block joins
+    one write transaction, committed once at the end (one fsync) or rolled back
+    as a whole if the block raises. Nested blocks join the outermost one.
+    The write lock is held for the whole block, so keep dialogs out of it.
+    """
+    if getattr(_thread_state, "unit_of_work", None) is not None:
+        yield
+        return
+
+    bound = getattr(_thread_state, "connection", None)
+    conn = bound._conn if bound is not None else open_connection()
+    try:
+        retry_on_locked(_begin_immediate)(conn)
+        _thread_state.unit_of_work = conn
+        _thread_state.pending_events = []
+        _thread_state.pending_journal = []
+        try:
+            yield
+            with _memory.lock if _memory is not None else nullcontext():
+                conn.commit()
+                _append_journal(_thread_state.pending_journal)
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            _thread_state.unit_of_work = None
+            events, _thread_state.pending_events = _thread_state.pending_events, []
+    finally:
+        if bound is None:
+            conn.close()
+    # Only reached after a successful commit
+    _publish(*events)
+
+
+def bind_connection(read_only=False):
+    """Open a connection that every database call in this thread will reuse until unbind_connection()."""
+    unbind_connection()
+    _thread_state.connection = _BoundConnection(open_connection(read_only))
+
+
+def unbind_connection():
+    bound = getattr(_thread_state, "connection", None)
+    if bound is not None:
+        _thread_state.connection = None
+        bound._conn.close()
+
+
+def _is_locked_error(error):
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+def retry_on_locked(func):
+    """
+    Re-run a write transaction when it fails because another station holds the
+    lock past BUSY_TIMEOUT. The wrapped function must open its own connection
+    and leave nothing committed when it raises, so running it again is safe.
+    Inside transaction() the lock is already held and calls run once.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_thread_state, "unit_of_work", None) is not None:
+            return func(*args, **kwargs)
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not _is_locked_error(e):
+                    raise
+                if attempt == WRITE_RETRIES:
+                    lock_stats["failures"] += 1
+                    raise
+                delay = WRITE_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                lock_stats["retries"] += 1
+                lock_stats["backoff_seconds"] += delay
+                time.sleep(delay)
+    return wrapper
+
+
+# Write functions replayed from the redo journal, by name
+_JOURNALED = {}
+
+
+def _journaled(func):
+    """
+    In-memory mode: record each committed call of a write function in the redo
+    journal before it returns, so load_into_memory() can replay the work not
+    yet flushed when the program or the PC died. Calls made by the function
+    itself are part of its entry; inside transaction() entries are written at
+    the commit. CURRENT_TIMESTAMP is pinned to the call's time (see _timestamp).
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _memory is None or getattr(_thread_state, "journaling", False):
+            return func(*args, **kwargs)
+        call = {
+            "call": func.__name__, "args": args, "kwargs": kwargs,
+            "at": datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT),
+        }
+        _thread_state.journaling = True
+        _thread_state.clock = call["at"]
+        try:
+            if getattr(_thread_state, "unit_of_work", None) is not None:
+                result = func(*args, **kwargs)
+                _thread_state.pending_journal.append(call)
+                return result
+            # Held until the entry is written, so a flush never falls between the two
+            with _memory.lock:
+                result = func(*args, **kwargs)
+                _append_journal([call])
+                return result
+        finally:
+            _thread_state.journaling = False
+            _thread_state.clock = None
+
+    _JOURNALED[func.__name__] = wrapper
+    return wrapper
+
+
+def _timestamp():
+    """Time of the journaled call being made or replayed, for COALESCE(?, CURRENT_TIMESTAMP)."""
+    return getattr(_thread_state, "clock", None)
+
+
+# ------------------------
+# --- Records ------------
+# ------------------------
+# Read functions return these immutable tuples (no per-row dict); they unpack
+# like the plain tuples they replace and also allow access by attribute.
+Material = namedtuple("Material", "id name identifier description price row_version has_formula ingredient_count level")
+FormulaLine = namedtuple("FormulaLine", "ingredient_id name quantity price")
+Order = namedtuple("Order", "order_id product_name units date client_name proforma_number")
+OrderLine = namedtuple("OrderLine", "ingredient_id name quantity")
+OrderInfo = namedtuple("OrderInfo", "product_id units date client_name proforma_number")
+OrderDetails = namedtuple("OrderDetails", "product_id units ingredients client_name proforma_number")
+FormulaVersion = namedtuple("FormulaVersion", "version_id content_hash created_at order_count")
+WhereUsed = namedtuple("WhereUsed", "product_id name depth quantity")
+PriceChange = namedtuple("PriceChange", "product_id name old_price new_price delta")
+Archive = namedtuple("Archive", "year path")
+SearchHit = namedtuple("SearchHit", "material_id name identifier score")
+
+# Column-oriented results of the bulk readers: one tuple per field
+MaterialColumns = namedtuple("MaterialColumns", Material._fields)
+OrderColumns = namedtuple("OrderColumns", Order._fields)
+
+MATERIAL_COLUMNS_SQL = "id, name, identifier, description, price, row_version, has_formula, ingredient_count, level"
+
+
+def _record_factory(record):
+    """row_factory building `record` straight from the row tuple (columns must be in field order)."""
+    make = record._make
+    return lambda _cursor, row: make(row)
+
+
+_material_row = _record_factory(Material)
+_formula_line_row = _record_factory(FormulaLine)
+_order_row = _record_factory(Order)
+_order_line_row = _record_factory(OrderLine)
+_order_info_row = _record_factory(OrderInfo)
+_formula_version_row = _record_factory(FormulaVersion)
+_where_used_row = _record_factory(WhereUsed)
+
+
+def _columns(record, rows):
+    if not rows:
+        return record(*([] for _ in record._fields))
+    return record(*zip(*rows))
+
+
+# ------------------------
+# --- Change events ------
+# ------------------------
+# Published to the listeners once the write that caused them is committed
+# (at the end of the enclosing transaction() block, if any).
+MaterialAdded = namedtuple("MaterialAdded", "material_id")
+MaterialUpdated = namedtuple("MaterialUpdated", "material_id")
+FormulaSaved = namedtuple("FormulaSaved", "product_id")
+PricesChanged = namedtuple("PricesChanged", "material_ids")
+OrderCreated = namedtuple("OrderCreated", "order_id")
+DatabaseReplaced = namedtuple("DatabaseReplaced", "source")
+
+_listeners = []
+
+
+def add_listener(callback):
+    """callback(event) is called, in the writing thread, for every committed change."""
+    _listeners.append(callback)
+
+
+def remove_listener(callback):
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+
+def _publish(*events):
+    if getattr(_thread_state, "unit_of_work", None) is not None:
+        _thread_state.pending_events.extend(events)
+        return
+    for event in events:
+        for callback in list(_listeners):
+            try:
+                callback(event)
+            except Exception:
+                # The change is already committed: a failing listener must not undo it for the caller
+                traceback.print_exc()
+
+
 def create_tables():
     conn, cursor = connect()
 
@@ -67,15 +442,607 @@ def create_tables():
         );
     """)
 
+    _migrate(cursor)
+
     conn.commit()
     conn.close()
 
 
+# ------------------------
+# --- Schema migrations --
+# ------------------------
+# Stored order timestamps: sortable ISO-8601, same as CURRENT_TIMESTAMP
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_LEGACY_TIMESTAMP_FORMATS = [
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d",
+    "%d-%m-%Y %H:%M:%S",
+    "%d-%m-%Y",
+    "%d/%m/%Y %H:%M:%S",
+    "%d/%m/%Y",
+]
+
+
+def normalize_timestamp(value):
+    """Return value as 'YYYY-MM-DD HH:MM:SS', or None if it cannot be parsed."""
+    if value is None:
+        return None
+    text = str(value).strip()
+    for fmt in _LEGACY_TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime(TIMESTAMP_FORMAT)
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(text).strftime(TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+def _normalize_order_dates(cursor, schema="main"):
+    cursor.execute(f"SELECT order_id, date FROM {schema}.manufacturing_orders WHERE date IS NOT datetime(date)")
+    updates = []
+    for row in cursor.fetchall():
+        normalized = normalize_timestamp(row["date"])
+        if normalized is None:
+            print(f"Orden {row['order_id']}: fecha no reconocida {row['date']!r}, se deja como está")
+            continue
+        updates.append((normalized, row["order_id"]))
+    cursor.executemany(f"UPDATE {schema}.manufacturing_orders SET date = ? WHERE order_id = ?", updates)
+
+
+def _migration_1_normalize_dates(cursor):
+    """Canonical order dates, kept that way by triggers, and an index to sort/filter by them."""
+    _normalize_order_dates(cursor)
+    cursor.connection.commit()  # ATTACH is not allowed inside a transaction
+    for archive in list_archives():
+        _attach_archive(cursor, archive.path)
+        try:
+            _normalize_order_dates(cursor, "archive")
+        finally:
+            cursor.connection.commit()
+            cursor.execute("DETACH DATABASE archive")
+
+    for event in ("INSERT", "UPDATE OF date"):
+        name = "insert" if event == "INSERT" else "update"
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS orders_date_check_{name}
+            BEFORE {event} ON manufacturing_orders
+            WHEN NEW.date IS NOT NULL AND datetime(NEW.date) IS NULL
+            BEGIN
+                SELECT RAISE(ABORT, 'manufacturing_orders.date must be an ISO-8601 date');
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS orders_date_normalize_{name}
+            AFTER {event} ON manufacturing_orders
+            WHEN NEW.date IS NOT datetime(NEW.date)
+            BEGIN
+                UPDATE manufacturing_orders SET date = datetime(NEW.date) WHERE order_id = NEW.order_id;
+            END
+        """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_date ON manufacturing_orders(date)")
+
+
+# Per-unit quantities in formula versions are rounded to this many decimals,
+# so the same recipe always hashes the same
+FORMULA_VERSION_DECIMALS = 9
+
+
+def _migration_2_formula_versions(cursor):
+    """
+    Immutable, content-addressed formula versions. Orders reference one plus their
+    units instead of copying every ingredient into order_ingredients; existing
+    orders are converted where the stored quantities are reproduced exactly enough.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS formula_versions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            content_hash TEXT NOT NULL UNIQUE,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(product_id) REFERENCES Materials(id)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS formula_version_lines (
+            version_id INTEGER NOT NULL,
+            ingredient_id INTEGER NOT NULL,
+            quantity REAL NOT NULL,
+            FOREIGN KEY(version_id) REFERENCES formula_versions(id),
+            FOREIGN KEY(ingredient_id) REFERENCES Materials(id)
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_formula_version_lines ON formula_version_lines(version_id)")
+    columns = {r["name"] for r in cursor.execute("PRAGMA table_info(manufacturing_orders)")}
+    if "formula_version_id" not in columns:
+        cursor.execute(
+            "ALTER TABLE manufacturing_orders ADD COLUMN formula_version_id INTEGER REFERENCES formula_versions(id)"
+        )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_order_ingredients_order ON order_ingredients(order_id)")
+
+    # Compatibility view with the old order_ingredients shape
+    cursor.execute("DROP VIEW IF EXISTS order_lines")
+    cursor.execute("""
+        CREATE VIEW order_lines AS
+        SELECT oi.order_id, oi.ingredient_id, oi.quantity FROM order_ingredients oi
+        UNION ALL
+        SELECT o.order_id, l.ingredient_id, l.quantity * o.units
+        FROM manufacturing_orders o
+        JOIN formula_version_lines l ON l.version_id = o.formula_version_id
+    """)
+
+    # Compact existing orders
+    cursor.execute("""
+        SELECT o.order_id, o.product_id, o.units, oi.ingredient_id, oi.quantity
+        FROM manufacturing_orders o
+        JOIN order_ingredients oi ON oi.order_id = o.order_id
+        WHERE o.formula_version_id IS NULL AND o.units != 0
+        ORDER BY o.order_id
+    """)
+    converted = []
+    current = None
+    lines = []
+
+    def flush():
+        if current is None:
+            return
+        order_id, product_id, units = current
+        per_unit = [(ing_id, round(qty / units, FORMULA_VERSION_DECIMALS)) for ing_id, qty in lines]
+        if all(abs(pu * units - qty) <= 1e-6 for (_, pu), (_, qty) in zip(per_unit, lines)):
+            converted.append((_store_formula_version(cursor, product_id, per_unit), order_id))
+
+    for row in cursor.fetchall():
+        key = (row["order_id"], row["product_id"], row["units"])
+        if key != current:
+            flush()
+            current, lines = key, []
+        lines.append((row["ingredient_id"], row["quantity"]))
+    flush()
+
+    cursor.executemany("UPDATE manufacturing_orders SET formula_version_id = ? WHERE order_id = ?", converted)
+    cursor.executemany("DELETE FROM order_ingredients WHERE order_id = ?", [(oid,) for _, oid in converted])
+    cursor.connection.commit()
+
+    for archive in list_archives():
+        _attach_archive(cursor, archive.path)
+        try:
+            _ensure_archive_schema(cursor)
+        finally:
+            cursor.connection.commit()
+            cursor.execute("DETACH DATABASE archive")
+
+
+def _migration_3_formula_indexes(cursor):
+    """
+    Indexes for walking the formula graph both ways, and revision counters in
+    `meta` bumped by triggers, so caches can tell when formulas or material
+    names changed (from any station).
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_formulas_product ON Formulas(product_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_formulas_ingredient ON Formulas(ingredient_id)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+    cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('formulas_rev', 0), ('materials_rev', 0)")
+
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS formulas_rev_{event.lower()} AFTER {event} ON Formulas
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'formulas_rev';
+            END
+        """)
+    for event in ("INSERT", "UPDATE OF name, identifier", "DELETE"):
+        name = event.split()[0].lower()
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS materials_rev_{name} AFTER {event} ON Materials
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'materials_rev';
+            END
+        """)
+
+
+# A stock snapshot is written every this many movements of a material
+STOCK_SNAPSHOT_INTERVAL = 500
+
+
+def _migration_4_inventory(cursor):
+    """
+    Append-only inventory ledger with per-material balances kept by a trigger
+    in the same transaction, and periodic snapshots for balance-as-of queries.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS inventory_movements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            material_id INTEGER NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('receipt', 'consumption', 'adjustment')),
+            quantity REAL NOT NULL,
+            date TEXT DEFAULT CURRENT_TIMESTAMP,
+            order_id INTEGER,
+            notes TEXT,
+            FOREIGN KEY(material_id) REFERENCES Materials(id),
+            FOREIGN KEY(order_id) REFERENCES manufacturing_orders(order_id)
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_movements_material ON inventory_movements(material_id, id)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_balances (
+            material_id INTEGER PRIMARY KEY,
+            quantity REAL NOT NULL DEFAULT 0,
+            last_movement_id INTEGER,
+            since_snapshot INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(material_id) REFERENCES Materials(id)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_snapshots (
+            material_id INTEGER NOT NULL,
+            movement_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            quantity REAL NOT NULL,
+            PRIMARY KEY (material_id, movement_id)
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_date ON stock_snapshots(material_id, date)")
+
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS inventory_post AFTER INSERT ON inventory_movements
+        BEGIN
+            INSERT INTO stock_balances (material_id, quantity, last_movement_id, since_snapshot)
+            VALUES (NEW.material_id, NEW.quantity, NEW.id, 1)
+            ON CONFLICT(material_id) DO UPDATE SET
+                quantity = quantity + excluded.quantity,
+                last_movement_id = excluded.last_movement_id,
+                since_snapshot = since_snapshot + 1;
+            INSERT INTO stock_snapshots (material_id, movement_id, date, quantity)
+            SELECT material_id, last_movement_id, NEW.date, quantity
+            FROM stock_balances
+            WHERE material_id = NEW.material_id AND since_snapshot >= {STOCK_SNAPSHOT_INTERVAL};
+            UPDATE stock_balances SET since_snapshot = 0
+            WHERE material_id = NEW.material_id AND since_snapshot >= {STOCK_SNAPSHOT_INTERVAL};
+        END
+    """)
+    for event in ("UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS inventory_append_only_{event.lower()}
+            BEFORE {event} ON inventory_movements
+            BEGIN
+                SELECT RAISE(ABORT, 'inventory_movements is append-only; post an adjustment instead');
+            END
+        """)
+
+
+def _migration_5_row_versions(cursor):
+    """
+    Optimistic concurrency: a row_version on Materials and Formulas. A trigger
+    bumps Materials.row_version on every edit that does not bump it itself;
+    update_formula stamps all rows of a formula with the next version.
+    """
+    for table in ("Materials", "Formulas"):
+        columns = {r["name"] for r in cursor.execute(f"PRAGMA table_info({table})")}
+        if "row_version" not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS materials_row_version
+        AFTER UPDATE OF name, identifier, description, price ON Materials
+        WHEN NEW.row_version = OLD.row_version
+        BEGIN
+            UPDATE Materials SET row_version = OLD.row_version + 1 WHERE id = NEW.id;
+        END
+    """)
+
+
+def _migration_6_price_dirty(cursor):
+    """Stale-price flag for the lazy price mode, with a partial index so finding dirty rows is cheap."""
+    columns = {r["name"] for r in cursor.execute("PRAGMA table_info(Materials)")}
+    if "price_dirty" not in columns:
+        cursor.execute("ALTER TABLE Materials ADD COLUMN price_dirty INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_materials_price_dirty ON Materials(id) WHERE price_dirty = 1")
+
+
+# Longest path from a material down to its raw materials (0 for a raw material);
+# a formula cycle is cut at MAX_FORMULA_DEPTH
+_BOM_LEVEL_SQL = """
+    (WITH RECURSIVE down(id, depth) AS (
+        SELECT Materials.id, 0
+        UNION
+        SELECT f.ingredient_id, d.depth + 1
+        FROM Formulas f JOIN down d ON f.product_id = d.id
+        WHERE d.depth < {max_depth}
+    )
+    SELECT MAX(depth) FROM down)
+"""
+
+# Ids of a product and every product containing it, at any depth
+_UPSTREAM_IDS_SQL = """
+    (WITH RECURSIVE up(id) AS (
+        SELECT {product_id}
+        UNION
+        SELECT f.product_id FROM Formulas f JOIN up u ON f.ingredient_id = u.id
+    )
+    SELECT id FROM up)
+"""
+
+
+def _migration_7_product_flags(cursor):
+    """
+    Denormalized formula facts on Materials, kept by triggers on Formulas:
+    has_formula, ingredient_count (formula lines) and level (BOM depth).
+    A new line can only raise levels, so inserts update the product and the
+    products above it in one step; a deleted line that may have set the level
+    makes them recompute it.
+    """
+    columns = {r["name"] for r in cursor.execute("PRAGMA table_info(Materials)")}
+    for column in ("has_formula", "ingredient_count", "level"):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE Materials ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_materials_has_formula ON Materials(name) WHERE has_formula = 1")
+
+    level_sql = _BOM_LEVEL_SQL.format(max_depth=MAX_FORMULA_DEPTH)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS formulas_flags_insert AFTER INSERT ON Formulas
+        BEGIN
+            UPDATE Materials SET ingredient_count = ingredient_count + 1, has_formula = 1
+            WHERE id = NEW.product_id;
+            UPDATE Materials
+            SET level = MAX(level, u.dist + 1 + COALESCE((SELECT level FROM Materials WHERE id = NEW.ingredient_id), 0))
+            FROM (
+                WITH RECURSIVE up(id, dist) AS (
+                    SELECT NEW.product_id, 0
+                    UNION
+                    SELECT f.product_id, up.dist + 1
+                    FROM Formulas f JOIN up ON f.ingredient_id = up.id
+                    WHERE up.dist < {MAX_FORMULA_DEPTH}
+                )
+                SELECT id, MAX(dist) AS dist FROM up GROUP BY id
+            ) AS u
+            WHERE Materials.id = u.id;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS formulas_flags_delete AFTER DELETE ON Formulas
+        BEGIN
+            UPDATE Materials SET ingredient_count = ingredient_count - 1, has_formula = ingredient_count > 1
+            WHERE id = OLD.product_id;
+            UPDATE Materials SET level = {level_sql}
+            WHERE COALESCE((SELECT level FROM Materials WHERE id = OLD.ingredient_id), 0) + 1
+                  >= (SELECT level FROM Materials WHERE id = OLD.product_id)
+              AND id IN {_UPSTREAM_IDS_SQL.format(product_id="OLD.product_id")};
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS formulas_flags_update
+        AFTER UPDATE OF product_id, ingredient_id ON Formulas
+        BEGIN
+            UPDATE Materials SET ingredient_count = ingredient_count - 1, has_formula = ingredient_count > 1
+            WHERE id = OLD.product_id;
+            UPDATE Materials SET ingredient_count = ingredient_count + 1, has_formula = 1
+            WHERE id = NEW.product_id;
+            UPDATE Materials SET level = {level_sql}
+            WHERE id IN {_UPSTREAM_IDS_SQL.format(product_id="OLD.product_id")}
+               OR id IN {_UPSTREAM_IDS_SQL.format(product_id="NEW.product_id")};
+        END
+    """)
+
+    cursor.execute("""
+        UPDATE Materials SET
+            ingredient_count = (SELECT COUNT(*) FROM Formulas f WHERE f.product_id = Materials.id),
+            has_formula = EXISTS (SELECT 1 FROM Formulas f WHERE f.product_id = Materials.id)
+    """)
+    cursor.execute(f"UPDATE Materials SET level = {level_sql} WHERE has_formula = 1")
+
+
+# Journal entry of one change, replacing the previous entry of the same entity
+_JOURNAL_SQL = "INSERT OR REPLACE INTO change_journal (entity, uid, op) "
+
+# A fresh globally unique row id
+_NEW_UID_SQL = "lower(hex(randomblob(16)))"
+
+
+def _migration_8_change_journal(cursor):
+    """
+    Change journal for `materialmanager sync`. Materials and orders get a uid
+    that is the same in every copy of the database; triggers keep one journal
+    row per changed entity (material, formula of a product, order), replaced
+    on every change, so the journal holds the latest change of each.
+    origin is NULL for changes made in this database; sync import stamps the
+    rows it applied with the origin they came from. Derived product prices
+    are not journaled: the importing side recomputes them.
+    """
+    # Existing rows get a uid derived from their content, so copies of the
+    # database made before this migration agree on them
+    for table, key, content in (("Materials", "id", "name"), ("manufacturing_orders", "order_id", "date")):
+        columns = {r["name"] for r in cursor.execute(f"PRAGMA table_info({table})")}
+        if "uid" not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN uid TEXT")
+        cursor.execute(f"SELECT {key}, {content} FROM {table} WHERE uid IS NULL")
+        cursor.executemany(f"UPDATE {table} SET uid = ? WHERE {key} = ?", [
+            (hashlib.sha256(f"{table}:{r[0]}:{r[1]}".encode("utf-8")).hexdigest()[:32], r[0])
+            for r in cursor.fetchall()
+        ])
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table.lower()}_uid ON {table}(uid)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS change_journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            uid TEXT NOT NULL,
+            op TEXT NOT NULL,
+            origin TEXT,
+            origin_seq INTEGER,
+            changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            UNIQUE (entity, uid)
+        );
+    """)
+    # Per origin: its last change imported here, and this journal's seq at that import
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            origin TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL,
+            local_seq INTEGER NOT NULL
+        );
+    """)
+    cursor.execute(f"INSERT OR IGNORE INTO meta (key, value) VALUES ('origin_id', {_NEW_UID_SQL})")
+
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS materials_journal_insert AFTER INSERT ON Materials
+        BEGIN
+            UPDATE Materials SET uid = {_NEW_UID_SQL} WHERE id = NEW.id AND uid IS NULL;
+            {_JOURNAL_SQL} SELECT 'material', uid, 'I' FROM Materials WHERE id = NEW.id;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS materials_journal_update
+        AFTER UPDATE OF name, identifier, description, price ON Materials
+        WHEN OLD.name IS NOT NEW.name OR OLD.identifier IS NOT NEW.identifier
+          OR OLD.description IS NOT NEW.description
+          OR (OLD.price IS NOT NEW.price AND NEW.has_formula = 0)
+        BEGIN
+            {_JOURNAL_SQL} VALUES ('material', NEW.uid, 'U');
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS materials_journal_delete AFTER DELETE ON Materials
+        WHEN OLD.uid IS NOT NULL
+        BEGIN
+            {_JOURNAL_SQL} VALUES ('material', OLD.uid, 'D');
+        END
+    """)
+    for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS formulas_journal_{event.lower()} AFTER {event} ON Formulas
+            BEGIN
+                {_JOURNAL_SQL} SELECT 'formula', uid, 'U' FROM Materials WHERE id = {row}.product_id;
+            END
+        """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS orders_journal_insert AFTER INSERT ON manufacturing_orders
+        BEGIN
+            UPDATE manufacturing_orders SET uid = {_NEW_UID_SQL} WHERE order_id = NEW.order_id AND uid IS NULL;
+            {_JOURNAL_SQL} SELECT 'order', uid, 'I' FROM manufacturing_orders WHERE order_id = NEW.order_id;
+        END
+    """)
+
+
+def _migration_9_user_edit_row_version(cursor):
+    """
+    row_version only counts edits a user makes: derived writes (a product's
+    price recomputed from its formula, or rewritten with the same value) no
+    longer look like a conflicting edit from another station.
+    """
+    cursor.execute("DROP TRIGGER IF EXISTS materials_row_version")
+    cursor.execute("""
+        CREATE TRIGGER materials_row_version
+        AFTER UPDATE OF name, identifier, description, price ON Materials
+        WHEN NEW.row_version = OLD.row_version
+         AND (OLD.name IS NOT NEW.name OR OLD.identifier IS NOT NEW.identifier
+              OR OLD.description IS NOT NEW.description
+              OR (OLD.price IS NOT NEW.price AND NEW.has_formula = 0))
+        BEGIN
+            UPDATE Materials SET row_version = OLD.row_version + 1 WHERE id = NEW.id;
+        END
+    """)
+
+
+def _migration_10_movement_journal(cursor):
+    """
+    Stock movements join the change journal, so receipts and adjustments made
+    in another copy reach this one with `sync`. Movements are append-only, so
+    each one is journaled once by uid and never conflicts. The append-only
+    trigger now lets a NULL uid be filled in, and nothing else.
+    """
+    columns = {r["name"] for r in cursor.execute("PRAGMA table_info(inventory_movements)")}
+    if "uid" not in columns:
+        cursor.execute("ALTER TABLE inventory_movements ADD COLUMN uid TEXT")
+    cursor.execute("DROP TRIGGER IF EXISTS inventory_append_only_update")
+    # Content-derived like migration 8, so copies made before it agree
+    cursor.execute("SELECT id, material_id, quantity, date FROM inventory_movements WHERE uid IS NULL")
+    cursor.executemany("UPDATE inventory_movements SET uid = ? WHERE id = ?", [
+        (hashlib.sha256(f"inventory_movements:{r[0]}:{r[1]}:{r[2]}:{r[3]}".encode("utf-8")).hexdigest()[:32], r[0])
+        for r in cursor.fetchall()
+    ])
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_inventory_movements_uid ON inventory_movements(uid)")
+    cursor.execute("""
+        CREATE TRIGGER inventory_append_only_update
+        BEFORE UPDATE ON inventory_movements
+        WHEN OLD.uid IS NOT NULL OR NEW.id IS NOT OLD.id OR NEW.material_id IS NOT OLD.material_id
+          OR NEW.kind IS NOT OLD.kind OR NEW.quantity IS NOT OLD.quantity OR NEW.date IS NOT OLD.date
+          OR NEW.order_id IS NOT OLD.order_id OR NEW.notes IS NOT OLD.notes
+        BEGIN
+            SELECT RAISE(ABORT, 'inventory_movements is append-only; post an adjustment instead');
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS movements_journal_insert AFTER INSERT ON inventory_movements
+        BEGIN
+            UPDATE inventory_movements SET uid = {_NEW_UID_SQL} WHERE id = NEW.id AND uid IS NULL;
+            {_JOURNAL_SQL} SELECT 'movement', uid, 'I' FROM inventory_movements WHERE id = NEW.id;
+        END
+    """)
+    # Movements posted before the upgrade are sent once; the other side skips the ones it has
+    cursor.execute(f"{_JOURNAL_SQL} SELECT 'movement', uid, 'I' FROM inventory_movements ORDER BY id")
+
+
+# Applied in order; PRAGMA user_version records how many already ran
+MIGRATIONS = [
+    _migration_1_normalize_dates,
+    _migration_2_formula_versions,
+    _migration_3_formula_indexes,
+    _migration_4_inventory,
+    _migration_5_row_versions,
+    _migration_6_price_dirty,
+    _migration_7_product_flags,
+    _migration_8_change_journal,
+    _migration_9_user_edit_row_version,
+    _migration_10_movement_journal,
+]
+
+
+def _migrate(cursor):
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(cursor)
+        cursor.execute(f"PRAGMA user_version = {number}")
+        cursor.connection.commit()
+
 
 # ------------------------
 # --- Materials CRUD -----
 # ------------------------
 
+def _taken_suffixes(cursor, column, base, sep="-"):
+    """
+    Devuelve (base_ocupada, sufijos_ocupados) para `column` con una sola consulta.
+    """
+    pattern = (base + sep).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    cursor.execute(
+        f"SELECT {column} FROM Materials WHERE {column} = ? OR {column} LIKE ? ESCAPE '\\'",
+        (base, pattern)
+    )
+    base_taken = False
+    suffixes = set()
+    prefix = base + sep
+    for (value,) in cursor.fetchall():
+        if value == base:
+            base_taken = True
+        elif value.startswith(prefix) and value[len(prefix):].isdigit():
+            suffixes.add(int(value[len(prefix):]))
+    return base_taken, suffixes
+
+
+def _first_free(base, base_taken, suffixes, sep="-"):
+    if not base_taken:
+        return base
+    suffix = 1
+    while suffix in suffixes:
+        suffix += 1
+    return f"{base}{sep}{suffix}"
+
+
 def generate_unique_identifier(base_identifier, cursor):
     """
     Dado un identificador base, añade sufijos -1, -2, etc. hasta encontrar uno libre.
@@ -83,21 +1050,28 @@ def generate_unique_identifier(base_identifier, cursor):
     if base_identifier is None:
         return None
 
-    new_identifier = str(base_identifier)
-    suffix = 1
-    # mientras exista en BD, añadir sufijo
-    while cursor.execute("SELECT 1 FROM Materials WHERE identifier = ?", (new_identifier,)).fetchone():
-        new_identifier = f"{base_identifier}-{suffix}"
-        suffix += 1
-    return new_identifier
+    base = str(base_identifier)
+    base_taken, suffixes = _taken_suffixes(cursor, "identifier", base)
+    return _first_free(base, base_taken, suffixes)
+
+
+def generate_unique_name(base_name, cursor):
+    """
+    Igual que generate_unique_identifier pero para el nombre ("X - Copia", "X - Copia 1", ...).
+    """
+    base_taken, suffixes = _taken_suffixes(cursor, "name", base_name, sep=" ")
+    return _first_free(base_name, base_taken, suffixes, sep=" ")
 
 
+@_journaled
+@retry_on_locked
 def add_material(name, description="", identifier=None, price=0.0):
     """
     Añade un nuevo material con identificador único.
     """
     conn, cursor = connect()
     try:
+        _begin(conn)
         # Si se da un identificador, asegurar que sea único
         final_identifier = None
         if identifier:
@@ -120,9 +1094,13 @@ def add_material(name, description="", identifier=None, price=0.0):
             )
 
         conn.commit()
+        _publish(MaterialAdded(material_id))
         return True
 
     except Exception as e:
+        conn.rollback()
+        if _is_locked_error(e):
+            raise
         print("Error en add_material:", e)
         return False
     finally:
@@ -131,31 +1109,47 @@ def add_material(name, description="", identifier=None, price=0.0):
 
 
 def get_material_by_name(name):
+    """Return the Material with the given name, or None."""
     conn, cursor = connect()
-    cursor.execute("SELECT id, name FROM Materials WHERE name = ?", (name,))
-    row = cursor.fetchone()
+    cursor.row_factory = _material_row
+    cursor.execute(f"SELECT {MATERIAL_COLUMNS_SQL} FROM Materials WHERE name = ?", (name,))
+    material = cursor.fetchone()
     conn.close()
-    if row:
-        return {"id": row[0], "name": row[1]}
-    return None
+    return material
+
 
 def get_material_by_id(material_id):
-    """Return dict-like row or None for given material id."""
+    """Return the Material with the given id, or None."""
     conn, cursor = connect()
-    cursor.execute("SELECT id, name, identifier, description, price FROM Materials WHERE id = ?", (material_id,))
+    _refresh_stale_prices(cursor)
+    cursor.row_factory = _material_row
+    cursor.execute(f"SELECT {MATERIAL_COLUMNS_SQL} FROM Materials WHERE id = ?", (material_id,))
     row = cursor.fetchone()
     conn.close()
-    return dict(row) if row else None
+    return row
 
 
-def update_material(material_id, name=None, identifier=None, description=None, price=None):
+@_journaled
+@retry_on_locked
+def update_material(material_id, name=None, identifier=None, description=None, price=None,
+                    expected_version=None):
     """
     Update provided fields for a material.
     If price is updated, propagate price recalculation to products that depend on this material.
+    With expected_version (the row_version read by the caller) raises
+    ConcurrentModificationError if another station changed the material meanwhile.
     Returns True on success, False on uniqueness error.
     """
     conn, cursor = connect()
     try:
+        _begin(conn)
+        if expected_version is not None:
+            cursor.execute("SELECT row_version FROM Materials WHERE id = ?", (material_id,))
+            row = cursor.fetchone()
+            if row is None or row["row_version"] != expected_version:
+                conn.rollback()
+                raise ConcurrentModificationError(f"Material {material_id} was modified by another user")
+
         updates = []
         params = []
         if name is not None:
@@ -176,27 +1170,115 @@ def update_material(material_id, name=None, identifier=None, description=None, p
             sql = "UPDATE Materials SET " + ", ".join(updates) + " WHERE id = ?"
             params.append(material_id)
             cursor.execute(sql, tuple(params))
-            conn.commit()
 
         # If price changed (price is not None), propagate to dependent products
-        if price is not None:
-            propagate_price_updates([material_id])
+        # in the same transaction
+        repriced = _prices_changed(cursor, [material_id]) if price is not None else None
 
+        conn.commit()
+        if updates:
+            _publish(MaterialUpdated(material_id))
+        if repriced is not None:
+            _publish(PricesChanged((material_id, *repriced)))
         return True
     except sqlite3.IntegrityError:
+        conn.rollback()
         return False
     finally:
         conn.close()
 
 
+@_journaled
+@retry_on_locked
+def clone_product(product_id, deep=False, name_suffix=" - Copia"):
+    """
+    Clone a product and its formula in a single transaction.
+    With deep=True every intermediate product of its formula (ingredients that
+    have a formula themselves, at any depth) is cloned as well and the cloned
+    formulas point to the cloned intermediates.
+    Returns the id of the new product, or None on failure.
+    """
+    conn, cursor = connect()
+    try:
+        _refresh_stale_prices(cursor)
+        _begin(conn)
+        if deep:
+            cursor.execute("""
+                WITH RECURSIVE subtree(id) AS (
+                    SELECT ?
+                    UNION
+                    SELECT f.ingredient_id
+                    FROM Formulas f
+                    JOIN subtree s ON f.product_id = s.id
+                    JOIN Materials g ON g.id = f.ingredient_id
+                    WHERE g.has_formula = 1
+                )
+                SELECT m.id, m.name, m.identifier, m.description, m.price
+                FROM Materials m JOIN subtree s ON m.id = s.id
+            """, (product_id,))
+        else:
+            cursor.execute(
+                "SELECT id, name, identifier, description, price FROM Materials WHERE id = ?",
+                (product_id,)
+            )
+        originals = cursor.fetchall()
+        if not originals:
+            conn.rollback()
+            return None
+
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS clone_map (old_id INTEGER PRIMARY KEY, new_id INTEGER)")
+        cursor.execute("DELETE FROM temp.clone_map")
+        for row in originals:
+            new_name = generate_unique_name(row["name"] + name_suffix, cursor)
+            new_identifier = generate_unique_identifier(row["identifier"], cursor)
+            cursor.execute(
+                "INSERT INTO Materials (name, description, identifier, price) VALUES (?, ?, ?, ?)",
+                (new_name, row["description"], new_identifier, row["price"] or 0.0)
+            )
+            new_id = cursor.lastrowid
+            if new_identifier is None:
+                cursor.execute(
+                    "UPDATE Materials SET identifier = ? WHERE id = ?",
+                    (generate_unique_identifier(new_id, cursor), new_id)
+                )
+            cursor.execute("INSERT INTO temp.clone_map (old_id, new_id) VALUES (?, ?)", (row["id"], new_id))
+
+        # Copy every cloned formula at once, re-pointing ingredients that were cloned too
+        cursor.execute("""
+            INSERT INTO Formulas (product_id, ingredient_id, quantity)
+            SELECT p.new_id, COALESCE(i.new_id, f.ingredient_id), f.quantity
+            FROM Formulas f
+            JOIN temp.clone_map p ON f.product_id = p.old_id
+            LEFT JOIN temp.clone_map i ON f.ingredient_id = i.old_id
+        """)
+        cursor.execute("SELECT old_id, new_id FROM temp.clone_map")
+        clone_map = dict(cursor.fetchall())
+        new_product_id = clone_map[product_id]
+        cursor.execute("DELETE FROM temp.clone_map")
+        conn.commit()
+        _publish(*(MaterialAdded(new_id) for new_id in clone_map.values()))
+        return new_product_id
+
+    except sqlite3.Error as e:
+        conn.rollback()
+        if _is_locked_error(e):
+            raise
+        print("Error en clone_product:", e)
+        return None
+    finally:
+        conn.close()
+
+
 # ------------------------
 # --- Formulas ----------
 # ------------------------
 def get_formulas(product_id):
     """
-    Returns a list of tuples: (ingredient_id, ingredient_name, quantity, price)
+    Returns a list of FormulaLine(ingredient_id, name, quantity, price)
     """
     conn, cursor = connect()
+    _refresh_stale_prices(cursor)
+    cursor.row_factory = _formula_line_row
     cursor.execute("""
     SELECT f.ingredient_id as ingredient_id,
            m.name as ingredient_name,
@@ -209,49 +1291,73 @@ def get_formulas(product_id):
     """, (product_id,))
     rows = cursor.fetchall()
     conn.close()
-    return [(r["ingredient_id"], r["ingredient_name"], r["quantity"], r["price"]) for r in rows]
+    return rows
 
 
 
+@_journaled
+@retry_on_locked
 def delete_formula(product_id):
     conn, cursor = connect()
-    cursor.execute("DELETE FROM Formulas WHERE product_id = ?", (product_id,))
-    conn.commit()
-    conn.close()
+    try:
+        cursor.execute("DELETE FROM Formulas WHERE product_id = ?", (product_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    _publish(FormulaSaved(product_id))
+
+
+def _formula_row_version(cursor, product_id):
+    cursor.execute("SELECT COALESCE(MAX(row_version), 0) FROM Formulas WHERE product_id = ?", (product_id,))
+    return cursor.fetchone()[0]
+
+
+def get_formula_version(product_id):
+    """row_version of a product's formula (0 if it has none), for update_formula(expected_version=...)."""
+    conn, cursor = connect()
+    try:
+        return _formula_row_version(cursor, product_id)
+    finally:
+        conn.close()
 
 
-def update_formula(product_id, ingredients):
+@_journaled
+@retry_on_locked
+def update_formula(product_id, ingredients, expected_version=None):
     """
     ingredients: list of (ingredient_id, quantity)
     Replaces existing formula with the new set and recalculates product price and propagates updates upstream.
+    With expected_version (from get_formula_version) raises ConcurrentModificationError
+    if another station saved this formula meanwhile. Returns the new formula version.
     """
     conn, cursor = connect()
     try:
-        cursor.execute("BEGIN")
+        _begin(conn)
+        current_version = _formula_row_version(cursor, product_id)
+        if expected_version is not None and current_version != expected_version:
+            raise ConcurrentModificationError(f"Formula of product {product_id} was modified by another user")
+        new_version = current_version + 1
         cursor.execute("DELETE FROM Formulas WHERE product_id = ?", (product_id,))
         if ingredients:
             cursor.executemany(
-                "INSERT INTO Formulas (product_id, ingredient_id, quantity) VALUES (?, ?, ?)",
-                [(product_id, ing_id, qty) for ing_id, qty in ingredients]
+                "INSERT INTO Formulas (product_id, ingredient_id, quantity, row_version) VALUES (?, ?, ?, ?)",
+                [(product_id, ing_id, qty, new_version) for ing_id, qty in ingredients]
             )
+        else:
+            cursor.execute("UPDATE Materials SET price = 0.0 WHERE id = ?", (product_id,))
+
+        # Recalculate this product and everything using it before committing,
+        # so a retried or conflicting save never leaves prices half updated
+        repriced = _prices_changed(cursor, [product_id])
         conn.commit()
+        _publish(FormulaSaved(product_id), PricesChanged((product_id, *repriced)))
+        return new_version
     except Exception:
         conn.rollback()
         raise
     finally:
         conn.close()
 
-    # After formula update, calculate price for this product and propagate (downstream)
-    price = calculate_product_price(product_id)
-    # Update product's price in Materials
-    conn, cursor = connect()
-    cursor.execute("UPDATE Materials SET price = ? WHERE id = ?", (price, product_id))
-    conn.commit()
-    conn.close()
-
-    # Propagate to any products that depend on this product
-    propagate_price_updates([product_id])
-
 
 # ------------------------
 # --- Pricing helpers ----
@@ -290,209 +1396,866 @@ def get_products_using_ingredient(ingredient_id):
     return [r["product_id"] for r in rows]
 
 
+# Depth limit for formula graph walks, so a (bad) cycle cannot recurse forever
+MAX_FORMULA_DEPTH = 64
+
+_where_used_cache = {}
+_where_used_cache_rev = None
+
+
+def _get_revisions(cursor):
+    cursor.execute("SELECT key, value FROM meta WHERE key IN ('formulas_rev', 'materials_rev') ORDER BY key")
+    return tuple(r[1] for r in cursor.fetchall())
+
+
+def where_used(material_id, max_depth=None):
+    """
+    Every product that contains material_id at any depth (or up to max_depth levels),
+    as a list of WhereUsed(product_id, name, depth, quantity) ordered by depth:
+    depth is the shortest path (1 = direct ingredient) and quantity the total amount
+    of the material in one unit of the product, summed over all paths.
+    max_depth=0 returns nothing; None means MAX_FORMULA_DEPTH. Results are cached until formulas or material names change.
+    """
+    global _where_used_cache_rev
+    depth_limit = min(MAX_FORMULA_DEPTH if max_depth is None else max_depth, MAX_FORMULA_DEPTH)
+    if depth_limit < 1:
+        return []
+
+    conn, cursor = connect()
+    try:
+        rev = _get_revisions(cursor)
+        if rev != _where_used_cache_rev:
+            _where_used_cache.clear()
+            _where_used_cache_rev = rev
+        key = (material_id, depth_limit)
+        if key in _where_used_cache:
+            return list(_where_used_cache[key])
+
+        cursor.execute("""
+            WITH RECURSIVE used(product_id, depth, quantity) AS (
+                SELECT f.product_id, 1, f.quantity
+                FROM Formulas f
+                WHERE f.ingredient_id = ?
+                UNION ALL
+                SELECT f.product_id, u.depth + 1, u.quantity * f.quantity
+                FROM used u
+                JOIN Formulas f ON f.ingredient_id = u.product_id
+                WHERE u.depth < ?
+            )
+            SELECT u.product_id, m.name, MIN(u.depth) AS depth, SUM(u.quantity) AS quantity
+            FROM used u
+            JOIN Materials m ON m.id = u.product_id
+            GROUP BY u.product_id
+            ORDER BY depth, m.name
+        """, (material_id, depth_limit))
+        cursor.row_factory = _where_used_row
+        result = cursor.fetchall()
+    finally:
+        conn.close()
+
+    _where_used_cache[key] = tuple(result)
+    return result
+
+
+def _load_upstream_graph(cursor, material_ids):
+    """
+    Load, in one query, the part of the formula graph that depends on material_ids:
+    every product that contains one of them at any depth, with its formula lines.
+    Returns (formulas, prices, names) where formulas is {product_id: [(ingredient_id, qty)]}
+    and prices/names cover those products and all their ingredients.
+    """
+    cursor.execute("""
+        WITH RECURSIVE upstream(id) AS (
+            SELECT value FROM json_each(?)
+            UNION
+            SELECT f.product_id FROM Formulas f JOIN upstream u ON f.ingredient_id = u.id
+        )
+        SELECT f.product_id, f.ingredient_id, f.quantity,
+               p.name AS product_name, p.price AS product_price, i.price AS ingredient_price
+        FROM upstream u
+        JOIN Formulas f ON f.product_id = u.id
+        JOIN Materials p ON p.id = f.product_id
+        LEFT JOIN Materials i ON i.id = f.ingredient_id
+    """, (json.dumps(list(material_ids)),))
+    formulas = {}
+    prices = {}
+    names = {}
+    for r in cursor.fetchall():
+        formulas.setdefault(r["product_id"], []).append((r["ingredient_id"], r["quantity"]))
+        prices[r["product_id"]] = r["product_price"] or 0.0
+        names[r["product_id"]] = r["product_name"]
+        prices.setdefault(r["ingredient_id"], r["ingredient_price"] or 0.0)
+    return formulas, prices, names
+
+
+def _recompute_prices(formulas, prices):
+    """
+    Recompute every product in formulas from its ingredients, ingredients first
+    (topological order), updating prices in place. Returns {product_id: new_price}.
+    Products caught in a formula cycle are computed once, in arbitrary order.
+    """
+    pending = {pid: sum(1 for ing_id, _ in lines if ing_id in formulas and ing_id != pid)
+               for pid, lines in formulas.items()}
+    users = {}
+    for pid, lines in formulas.items():
+        for ing_id, _ in lines:
+            if ing_id in formulas and ing_id != pid:
+                users.setdefault(ing_id, []).append(pid)
+
+    ready = deque(pid for pid, n in pending.items() if n == 0)
+    new_prices = {}
+    while len(new_prices) < len(formulas):
+        if not ready:
+            # cycle: break it at any product not yet computed
+            ready.append(next(pid for pid in formulas if pid not in new_prices))
+        pid = ready.popleft()
+        if pid in new_prices:
+            continue
+        total = 0.0
+        for ing_id, qty in formulas[pid]:
+            total += float(prices.get(ing_id) or 0.0) * float(qty)
+        prices[pid] = new_prices[pid] = total
+        for up_pid in users.get(pid, ()):
+            pending[up_pid] -= 1
+            if pending[up_pid] == 0:
+                ready.append(up_pid)
+    return new_prices
+
+
+@_journaled
+@retry_on_locked
 def propagate_price_updates(initial_product_ids):
     """
     Given a list/iterable of product ids whose price changed, recalculate prices for them (if formula exists)
-    and propagate updates to any products that include them (BFS), so all upstream products get updated.
+    and for every product that includes them at any depth, ingredients before the products using them.
+    The affected part of the graph is loaded in one query and the new prices are written in one statement.
+    """
+    conn, cursor = connect()
+    try:
+        _begin(conn)
+        repriced = _propagate_prices(cursor, initial_product_ids)
+        conn.commit()
+    finally:
+        conn.close()
+    if repriced:
+        _publish(PricesChanged(tuple(repriced)))
+
+
+def _propagate_prices(cursor, initial_product_ids):
+    """Returns the ids of the recomputed products."""
+    formulas, prices, _names = _load_upstream_graph(cursor, initial_product_ids)
+    new_prices = _recompute_prices(formulas, prices)
+    cursor.executemany(
+        "UPDATE Materials SET price = ? WHERE id = ?",
+        [(price, pid) for pid, price in new_prices.items()]
+    )
+    return list(new_prices)
+
+
+def _prices_changed(cursor, material_ids):
+    """
+    Propagate now or, in lazy mode, only flag the products using material_ids.
+    Returns the ids of the products whose price was recomputed.
+    """
+    if PRICE_MODE == "lazy":
+        _mark_prices_dirty(cursor, material_ids)
+        return []
+    return _propagate_prices(cursor, material_ids)
+
+
+def _mark_prices_dirty(cursor, material_ids):
+    """
+    Flag, in one statement, every product containing material_ids at any depth
+    (and those of material_ids that have a formula). The walk stops at products
+    already flagged: everything above a dirty product is dirty too.
     """
-    queue = deque(initial_product_ids)
-    visited = set()
+    cursor.execute("""
+        WITH RECURSIVE upstream(id) AS (
+            SELECT value FROM json_each(?)
+            UNION
+            SELECT f.product_id
+            FROM Formulas f
+            JOIN upstream u ON f.ingredient_id = u.id
+            JOIN Materials m ON m.id = f.product_id
+            WHERE m.price_dirty = 0
+        )
+        UPDATE Materials SET price_dirty = 1
+        WHERE price_dirty = 0
+          AND id IN (SELECT id FROM upstream)
+          AND has_formula = 1
+    """, (json.dumps(list(material_ids)),))
+
+
+def _recompute_dirty_prices(cursor):
+    """Recompute every flagged product in one pass, ingredients first, and clear the flags."""
+    cursor.execute("""
+        SELECT f.product_id, f.ingredient_id, f.quantity, i.price AS ingredient_price
+        FROM Materials p
+        JOIN Formulas f ON f.product_id = p.id
+        LEFT JOIN Materials i ON i.id = f.ingredient_id
+        WHERE p.price_dirty = 1
+    """)
+    formulas = {}
+    prices = {}
+    for r in cursor.fetchall():
+        formulas.setdefault(r["product_id"], []).append((r["ingredient_id"], r["quantity"]))
+        prices.setdefault(r["ingredient_id"], r["ingredient_price"] or 0.0)
+    new_prices = _recompute_prices(formulas, prices)
+    cursor.executemany(
+        "UPDATE Materials SET price = ? WHERE id = ?",
+        [(price, pid) for pid, price in new_prices.items()]
+    )
+    cursor.execute("UPDATE Materials SET price_dirty = 0 WHERE price_dirty = 1")
+    return list(new_prices)
+
 
+def _refresh_stale_prices(cursor):
+    """
+    Lazy mode: before a read that shows prices, bring flagged prices up to date.
+    Read-only connections, and a database another station is writing to, get
+    the stored prices; they are refreshed by the next writer or sweep.
+    """
+    if PRICE_MODE != "lazy":
+        return
+    if cursor.execute("SELECT 1 FROM Materials WHERE price_dirty = 1 LIMIT 1").fetchone() is None:
+        return
+    if getattr(_thread_state, "unit_of_work", None) is not None:
+        # Already holding the write lock
+        _publish(PricesChanged(tuple(_recompute_dirty_prices(cursor))))
+        return
+    if cursor.connection.in_transaction or cursor.execute("PRAGMA query_only").fetchone()[0]:
+        return
+    try:
+        _begin_immediate(cursor)
+        repriced = _recompute_dirty_prices(cursor)
+        cursor.connection.commit()
+    except sqlite3.OperationalError as e:
+        cursor.connection.rollback()
+        if not _is_locked_error(e):
+            raise
+        return
+    _publish(PricesChanged(tuple(repriced)))
+
+
+@_journaled
+@retry_on_locked
+def refresh_dirty_prices():
+    """Background sweep for the lazy price mode. Returns how many prices were recomputed."""
     conn, cursor = connect()
     try:
-        while queue:
-            pid = queue.popleft()
-            if pid in visited:
-                continue
-            visited.add(pid)
+        _begin(conn)
+        repriced = _recompute_dirty_prices(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+    if repriced:
+        _publish(PricesChanged(tuple(repriced)))
+    return len(repriced)
 
-            # If pid has a formula (is a processed product), recalc its price
-            cursor.execute("SELECT COUNT(*) as cnt FROM Formulas WHERE product_id = ?", (pid,))
-            has_formula = cursor.fetchone()["cnt"] > 0
-            if has_formula:
-                new_price = calculate_product_price(pid)
-                cursor.execute("UPDATE Materials SET price = ? WHERE id = ?", (new_price, pid))
-                conn.commit()
 
-            # Find products that use this pid as an ingredient and enqueue them
-            cursor.execute("SELECT DISTINCT product_id FROM Formulas WHERE ingredient_id = ?", (pid,))
-            for row in cursor.fetchall():
-                up_pid = row["product_id"]
-                if up_pid not in visited:
-                    queue.append(up_pid)
+def simulate_price_changes(changes):
+    """
+    What-if pricing without touching the database.
+    changes: {material_id: new_price}. Returns the products whose price would be
+    recalculated, as a list of PriceChange(product_id, name, old_price, new_price, delta) sorted by name.
+    """
+    conn, cursor = connect()
+    try:
+        _refresh_stale_prices(cursor)
+        formulas, prices, names = _load_upstream_graph(cursor, changes.keys())
     finally:
         conn.close()
 
+    old_prices = {pid: prices[pid] for pid in formulas}
+    for material_id, price in changes.items():
+        prices[material_id] = float(price)
+    new_prices = _recompute_prices(formulas, prices)
+
+    result = [
+        PriceChange(pid, names[pid], old_prices[pid], new_price, new_price - old_prices[pid])
+        for pid, new_price in new_prices.items()
+    ]
+    result.sort(key=lambda r: r.name)
+    return result
+
+
+# ------------------------
+# --- Formula versions ---
+# ------------------------
+def _formula_content_hash(product_id, lines):
+    """lines: iterable of (ingredient_id, per-unit quantity), already rounded."""
+    content = json.dumps([product_id, sorted(lines)], separators=(",", ":"))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _store_formula_version(cursor, product_id, lines):
+    """Return the id of the immutable version with these lines, creating it only if new."""
+    lines = [(ing_id, round(float(qty), FORMULA_VERSION_DECIMALS)) for ing_id, qty in lines]
+    content_hash = _formula_content_hash(product_id, lines)
+    cursor.execute("SELECT id FROM formula_versions WHERE content_hash = ?", (content_hash,))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    cursor.execute(
+        "INSERT INTO formula_versions (product_id, content_hash, created_at) VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))",
+        (product_id, content_hash, _timestamp())
+    )
+    version_id = cursor.lastrowid
+    cursor.executemany(
+        "INSERT INTO formula_version_lines (version_id, ingredient_id, quantity) VALUES (?, ?, ?)",
+        [(version_id, ing_id, qty) for ing_id, qty in lines]
+    )
+    return version_id
+
+
+def _current_formula_version(cursor, product_id):
+    cursor.execute("SELECT ingredient_id, quantity FROM Formulas WHERE product_id = ?", (product_id,))
+    return _store_formula_version(cursor, product_id, [(r[0], r[1]) for r in cursor.fetchall()])
+
+
+def get_formula_versions(product_id):
+    """
+    Returns the recorded versions of a product formula, newest first:
+      FormulaVersion(version_id, content_hash, created_at, order_count)
+    """
+    conn, cursor = connect()
+    cursor.row_factory = _formula_version_row
+    cursor.execute("""
+        SELECT v.id, v.content_hash, v.created_at,
+               (SELECT COUNT(*) FROM manufacturing_orders o WHERE o.formula_version_id = v.id) AS order_count
+        FROM formula_versions v
+        WHERE v.product_id = ?
+        ORDER BY v.id DESC
+    """, (product_id,))
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+
+def _order_lines_sql(schema, single_order=False):
+    """
+    (order_id, ingredient_id, quantity) for the orders in schema: rows stored in
+    order_ingredients by older versions plus lines derived from each order's
+    formula version times its units. With single_order the lines are limited to
+    order_id = ?1.
+    """
+    where_oi = "WHERE oi.order_id = ?1" if single_order else ""
+    where_o = "WHERE o.order_id = ?1" if single_order else ""
+    return f"""
+        SELECT oi.order_id, oi.ingredient_id, oi.quantity, oi.id AS line_id
+        FROM {schema}.order_ingredients oi
+        {where_oi}
+        UNION ALL
+        SELECT o.order_id, l.ingredient_id, l.quantity * o.units, l.rowid
+        FROM {schema}.manufacturing_orders o
+        JOIN main.formula_version_lines l ON l.version_id = o.formula_version_id
+        {where_o}
+    """
+
 
 # ------------------------
 # --- Manufacturing Orders
 # ------------------------
-def create_order(product_id, units, notes="", client_name=None, proforma_number=None):
+@_journaled
+@retry_on_locked
+def create_order(product_id, units, notes="", client_name=None, proforma_number=None, order_id=None):
     """
-    Creates a manufacturing order and stores the multiplied ingredient quantities.
+    Creates a manufacturing order pointing to the current version of the product
+    formula; ingredient quantities are derived from it (see order_lines).
+    order_id may be a number claimed earlier with reserve_order_ids; otherwise
+    the next one is assigned inside the write transaction.
     Returns order_id.
     """
     conn, cursor = connect()
     try:
-        # Insert the manufacturing order with all optional fields
+        _begin(conn)
+        version_id = _current_formula_version(cursor, product_id)
         cursor.execute(
             """
             INSERT INTO manufacturing_orders
-            (product_id, units, notes, client_name, proforma_number)
-            VALUES (?, ?, ?, ?, ?)
+            (order_id, product_id, units, notes, client_name, proforma_number, formula_version_id, date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
             """,
-            (product_id, units, notes, client_name, proforma_number)
+            (order_id, product_id, units, notes, client_name, proforma_number, version_id, _timestamp())
         )
         order_id = cursor.lastrowid
 
-        # Fetch formula (per-unit) and insert multiplied quantities
-        formula = get_formulas(product_id)
-        for ing_id, _, qty, _price in formula:
-            total_qty = qty * units
-            cursor.execute(
-                "INSERT INTO order_ingredients (order_id, ingredient_id, quantity) VALUES (?, ?, ?)",
-                (order_id, ing_id, total_qty)
-            )
+        # Consumption of every ingredient, in the same transaction
+        cursor.execute("""
+            INSERT INTO inventory_movements (material_id, kind, quantity, order_id, date)
+            SELECT ingredient_id, 'consumption', -SUM(quantity) * ?, ?, COALESCE(?, CURRENT_TIMESTAMP)
+            FROM formula_version_lines
+            WHERE version_id = ?
+            GROUP BY ingredient_id
+        """, (units, order_id, _timestamp(), version_id))
 
         conn.commit()
+        _publish(OrderCreated(order_id))
         return order_id
     finally:
         conn.close()
 
 
+ORDER_LIST_SQL = """
+    SELECT o.order_id,
+           COALESCE(m.name, m.identifier, 'Unknown') AS product_display_name,
+           o.units,
+           o.date,
+           o.client_name,
+           o.proforma_number
+    FROM {schema}.manufacturing_orders o
+    LEFT JOIN main.Materials m ON o.product_id = m.id
+"""
 
 
+def _order_range_filter(date_from, date_to):
+    where = []
+    params = []
+    if date_from:
+        where.append("o.date >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append("o.date < date(?, '+1 day')")
+        params.append(date_to)
+    return where, params
 
 
-def get_orders():
+def get_orders(date_from=None, date_to=None):
     """
-    Returns list of all orders:
-      (order_id, product_display_name, units, date, client_name, proforma_number)
+    Returns list of orders, newest first, optionally limited to an inclusive
+    'YYYY-MM-DD' date range (archived years are read only when date_from reaches them):
+      Order(order_id, product_name, units, date, client_name, proforma_number)
     """
+    where, params = _order_range_filter(date_from, date_to)
+    sql = ORDER_LIST_SQL
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY o.date DESC"
+
     conn, cursor = connect()
-    cursor.execute("""
-    SELECT o.order_id,
-           COALESCE(m.name, m.identifier, 'Unknown') AS product_display_name,
-           o.units,
-           o.date,
-           o.client_name,
-           o.proforma_number
-    FROM manufacturing_orders o
-    LEFT JOIN Materials m ON o.product_id = m.id
-    ORDER BY o.date DESC
-    """)
-    rows = cursor.fetchall()
-    conn.close()
-    return [
-        (r["order_id"], r["product_display_name"], r["units"], r["date"], r["client_name"], r["proforma_number"])
-        for r in rows
-    ]
+    try:
+        cursor.row_factory = _order_row
+        return _query_order_sources(cursor, sql, params, date_from, date_to)
+    finally:
+        conn.close()
+
+
+def get_order_columns(date_from=None, date_to=None):
+    """Same orders as get_orders, as OrderColumns (one tuple per field) for large reads."""
+    where, params = _order_range_filter(date_from, date_to)
+    sql = ORDER_LIST_SQL
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY o.date DESC"
+
+    conn, cursor = connect()
+    try:
+        cursor.row_factory = None
+        return _columns(OrderColumns, _query_order_sources(cursor, sql, params, date_from, date_to))
+    finally:
+        conn.close()
+
+
+def get_order(order_id):
+    """The Order record (as listed by get_orders) for one order, or None."""
+    conn, cursor = connect()
+    try:
+        cursor.row_factory = _order_row
+        rows = _query_order_by_id(cursor, order_id, ORDER_LIST_SQL + " WHERE o.order_id = ?1")
+    finally:
+        conn.close()
+    return rows[0] if rows else None
 
 
-def search_orders(query):
+def search_orders(query, date_from=None, date_to=None):
     """
     Search orders by client_name OR proforma_number (case-insensitive, partial match).
-    Returns same tuple structure as get_orders.
+    Returns Order records like get_orders.
     """
     q = f"%{query}%"
+    where, params = _order_range_filter(date_from, date_to)
+    where.insert(0, "(o.client_name LIKE ? OR o.proforma_number LIKE ?)")
+    sql = ORDER_LIST_SQL + " WHERE " + " AND ".join(where) + " ORDER BY o.date DESC"
+
     conn, cursor = connect()
-    cursor.execute("""
-    SELECT o.order_id,
-           COALESCE(m.name, m.identifier, 'Unknown') AS product_display_name,
-           o.units,
-           o.date,
-           o.client_name,
-           o.proforma_number
-    FROM manufacturing_orders o
-    LEFT JOIN Materials m ON o.product_id = m.id
-    WHERE (o.client_name LIKE ? OR o.proforma_number LIKE ?)
-    ORDER BY o.date DESC
-    """, (q, q))
-    rows = cursor.fetchall()
-    conn.close()
-    return [
-        (r["order_id"], r["product_display_name"], r["units"], r["date"], r["client_name"], r["proforma_number"])
-        for r in rows
-    ]
+    try:
+        cursor.row_factory = _order_row
+        return _query_order_sources(cursor, sql, [q, q] + params, date_from, date_to)
+    finally:
+        conn.close()
 
 
 def get_order_ingredients(order_id):
     """
-    Returns list of ingredients for an order: (ingredient_name, quantity)
-    (kept for backward compatibility)
+    Returns list of ingredients for an order: OrderLine(ingredient_id, name, quantity)
+    (kept for backward compatibility; get_order_details also has the order fields)
     """
     conn, cursor = connect()
-    cursor.execute("""
-    SELECT m.name as ingredient_name, oi.quantity
-    FROM order_ingredients oi
-    JOIN Materials m ON oi.ingredient_id = m.id
-    WHERE oi.order_id = ?
-    """, (order_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    return [(r["ingredient_name"], r["quantity"]) for r in rows]
+    try:
+        cursor.row_factory = _order_line_row
+        return _query_order_by_id(cursor, order_id, """
+            SELECT oi.ingredient_id, m.name, oi.quantity
+            FROM ({lines}) oi
+            JOIN main.Materials m ON oi.ingredient_id = m.id
+        """, lines=True)
+    finally:
+        conn.close()
 
 
 def get_order_details(order_id):
     """
-    Returns (product_id, units, ingredients, client_name, proforma_number)
-    Where ingredients is list of tuples (ingredient_id, name, qty)
+    Returns OrderDetails(product_id, units, ingredients, client_name, proforma_number),
+    or None if the order does not exist,
+    where ingredients is a list of OrderLine(ingredient_id, name, quantity)
     """
     conn, cursor = connect()
-    cursor.execute(
-        "SELECT product_id, units, client_name, proforma_number FROM manufacturing_orders WHERE order_id = ?",
-        (order_id,)
-    )
-    row = cursor.fetchone()
-    if not row:
+    try:
+        rows = _query_order_by_id(cursor, order_id, """
+            SELECT o.product_id, o.units, o.client_name, o.proforma_number,
+                   oi.ingredient_id, m.name as ingredient_name, oi.quantity
+            FROM {schema}.manufacturing_orders o
+            LEFT JOIN ({lines}) oi ON 1
+            LEFT JOIN main.Materials m ON oi.ingredient_id = m.id
+            WHERE o.order_id = ?1
+            ORDER BY m.name
+        """, lines=True)
+    finally:
         conn.close()
-        return None, None, [], None, None
+    if not rows:
+        return None
+
+    row = rows[0]
+    ingredients = [
+        OrderLine(r["ingredient_id"], r["ingredient_name"], r["quantity"])
+        for r in rows if r["ingredient_id"] is not None
+    ]
+    return OrderDetails(row["product_id"], row["units"], ingredients, row["client_name"], row["proforma_number"])
 
-    product_id = row["product_id"]
-    units = row["units"]
-    client_name = row["client_name"]
-    proforma_number = row["proforma_number"]
 
-    cursor.execute("""
-        SELECT oi.ingredient_id, m.name as ingredient_name, oi.quantity
-        FROM order_ingredients oi
-        JOIN Materials m ON oi.ingredient_id = m.id
-        WHERE oi.order_id = ?
-        ORDER BY m.name
-    """, (order_id,))
-    ingredients = [(r["ingredient_id"], r["ingredient_name"], r["quantity"]) for r in cursor.fetchall()]
+def get_order_info(order_id):
+    """
+    Returns metadata for an order, or None if it does not exist:
+      OrderInfo(product_id, units, date, client_name, proforma_number)
+    """
+    conn, cursor = connect()
+    try:
+        cursor.row_factory = _order_info_row
+        rows = _query_order_by_id(cursor, order_id, """
+            SELECT product_id, units, date, client_name, proforma_number
+            FROM {schema}.manufacturing_orders
+            WHERE order_id = ?1
+        """)
+    finally:
+        conn.close()
+    return rows[0] if rows else None
+
 
+def get_next_order_id():
+    """
+    Id AUTOINCREMENT will give the next order. Read from sqlite_sequence, so it
+    stays right when old orders have been archived out of the table.
+    Only a preview: another station may take it first (see reserve_order_ids).
+    """
+    conn, cursor = connect()
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'manufacturing_orders'")
+    row = cursor.fetchone()
     conn.close()
-    return product_id, units, ingredients, client_name, proforma_number
+    return row[0] + 1 if row else 1
 
 
+@_journaled
+@retry_on_locked
+def reserve_order_ids(count=1):
+    """
+    Claim `count` consecutive order numbers for this station by advancing the
+    AUTOINCREMENT sequence; no other station will be given them. Pass each one
+    to create_order(order_id=...). Returns the list of reserved ids.
+    """
+    conn, cursor = connect()
+    try:
+        _begin(conn)
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'manufacturing_orders'")
+        row = cursor.fetchone()
+        first = (row[0] if row else 0) + 1
+        if row:
+            cursor.execute(
+                "UPDATE sqlite_sequence SET seq = ? WHERE name = 'manufacturing_orders'",
+                (first + count - 1,)
+            )
+        else:
+            cursor.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES ('manufacturing_orders', ?)",
+                (first + count - 1,)
+            )
+        conn.commit()
+        return list(range(first, first + count))
+    finally:
+        conn.close()
+
 
+# ------------------------
+# --- Inventory ----------
+# ------------------------
+def _post_movement(cursor, material_id, kind, quantity, notes=None, order_id=None):
+    cursor.execute(
+        """
+            INSERT INTO inventory_movements (material_id, kind, quantity, order_id, notes, date)
+            VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        """,
+        (material_id, kind, float(quantity), order_id, notes, _timestamp())
+    )
+    return cursor.lastrowid
 
 
-def get_order_info(order_id):
+@_journaled
+@retry_on_locked
+def record_receipt(material_id, quantity, notes=None):
+    """Post a goods receipt (positive quantity). Returns the movement id."""
+    conn, cursor = connect()
+    try:
+        _begin(conn)
+        movement_id = _post_movement(cursor, material_id, "receipt", abs(float(quantity)), notes)
+        conn.commit()
+        return movement_id
+    finally:
+        conn.close()
+
+
+@_journaled
+@retry_on_locked
+def record_adjustment(material_id, counted_quantity, notes=None):
     """
-    Returns metadata for an order:
-      (product_id, units, date, client_name, proforma_number)
+    Post a stock count: an adjustment movement for the difference between the
+    counted quantity and the current balance. Returns the movement id, or None
+    if the count matches.
     """
     conn, cursor = connect()
-    cursor.execute("""
-    SELECT product_id, units, date, client_name, proforma_number
-    FROM manufacturing_orders
-    WHERE order_id = ?
-    """, (order_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if not row:
-        return None, None, None, None, None
-    return row["product_id"], row["units"], row["date"], row["client_name"], row["proforma_number"]
+    try:
+        _begin(conn)
+        cursor.execute("SELECT quantity FROM stock_balances WHERE material_id = ?", (material_id,))
+        row = cursor.fetchone()
+        difference = float(counted_quantity) - (row["quantity"] if row else 0.0)
+        movement_id = None
+        if abs(difference) > 1e-9:
+            movement_id = _post_movement(cursor, material_id, "adjustment", difference, notes)
+        conn.commit()
+        return movement_id
+    finally:
+        conn.close()
 
 
-def get_next_order_id():
+def get_stock(material_id=None):
+    """
+    Current balance of a material (0.0 if it never moved), or a dict
+    {material_id: balance} of every material with movements when called without one.
+    """
     conn, cursor = connect()
-    cursor.execute("SELECT MAX(order_id) + 1 FROM manufacturing_orders")
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row and row[0] else 1
+    try:
+        if material_id is None:
+            cursor.execute("SELECT material_id, quantity FROM stock_balances")
+            return {r["material_id"]: r["quantity"] for r in cursor.fetchall()}
+        cursor.execute("SELECT quantity FROM stock_balances WHERE material_id = ?", (material_id,))
+        row = cursor.fetchone()
+        return row["quantity"] if row else 0.0
+    finally:
+        conn.close()
+
+
+def get_stock_as_of(material_id, as_of):
+    """
+    Balance of a material at a past moment ('YYYY-MM-DD' means end of that day):
+    the last snapshot taken before it plus the few movements after that snapshot.
+    """
+    as_of = f"{as_of} 23:59:59" if len(as_of) == 10 else as_of
+    conn, cursor = connect()
+    try:
+        cursor.execute("""
+            SELECT movement_id, quantity FROM stock_snapshots
+            WHERE material_id = ? AND date <= ?
+            ORDER BY date DESC, movement_id DESC
+            LIMIT 1
+        """, (material_id, as_of))
+        snap = cursor.fetchone()
+        start_id, base = (snap["movement_id"], snap["quantity"]) if snap else (0, 0.0)
+
+        # The tail never goes past the next snapshot, so it is at most one interval long
+        cursor.execute("""
+            SELECT MIN(movement_id) FROM stock_snapshots WHERE material_id = ? AND movement_id > ?
+        """, (material_id, start_id))
+        end_id = cursor.fetchone()[0]
+        cursor.execute("""
+            SELECT COALESCE(SUM(quantity), 0) FROM inventory_movements
+            WHERE material_id = ? AND id > ? AND id <= ? AND date <= ?
+        """, (material_id, start_id, end_id if end_id is not None else 2 ** 63 - 1, as_of))
+        return base + cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+
+@_journaled
+@retry_on_locked
+def checkpoint_stock():
+    """Snapshot every balance that moved since its last snapshot (e.g. at month end)."""
+    conn, cursor = connect()
+    try:
+        _begin(conn)
+        cursor.execute("""
+            INSERT OR IGNORE INTO stock_snapshots (material_id, movement_id, date, quantity)
+            SELECT material_id, last_movement_id, COALESCE(?, CURRENT_TIMESTAMP), quantity
+            FROM stock_balances
+            WHERE since_snapshot > 0
+        """, (_timestamp(),))
+        cursor.execute("UPDATE stock_balances SET since_snapshot = 0 WHERE since_snapshot > 0")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ------------------------
+# --- Archive ------------
+# ------------------------
+def archive_path(year):
+    """Archive file for a year, next to the main database: materials_archive_YYYY.db"""
+    base, ext = os.path.splitext(os.path.abspath(DB_NAME))
+    return f"{base}_archive_{year}{ext or '.db'}"
+
+
+def list_archives():
+    """Returns [Archive(year, path), ...] of existing archive files, newest first."""
+    base, ext = os.path.splitext(os.path.abspath(DB_NAME))
+    prefix = os.path.basename(base) + "_archive_"
+    folder = os.path.dirname(base)
+    archives = []
+    for filename in os.listdir(folder):
+        stem, file_ext = os.path.splitext(filename)
+        year = stem[len(prefix):]
+        if stem.startswith(prefix) and file_ext == (ext or ".db") and year.isdigit():
+            archives.append(Archive(int(year), os.path.join(folder, filename)))
+    archives.sort(reverse=True)
+    return archives
+
+
+def _archives_in_range(date_from=None, date_to=None):
+    """Archives overlapping the range; none unless date_from explicitly reaches back."""
+    if not date_from:
+        return []
+    return [
+        archive for archive in list_archives()
+        if archive.year >= int(date_from[:4]) and (not date_to or archive.year <= int(date_to[:4]))
+    ]
+
+
+def _attach_archive(cursor, path):
+    cursor.execute("ATTACH DATABASE ? AS archive", (path,))
+
+
+def _query_order_sources(cursor, sql, params, date_from=None, date_to=None):
+    """
+    Run sql, which reads the order tables as {schema}.table, on the main database
+    and then on every archive overlapping the date range (newest year first).
+    Without date_from only the main database is read.
+    Archives are attached one at a time, so there is no limit on how many exist.
+    """
+    rows = cursor.execute(sql.format(schema="main"), params).fetchall()
+    for archive in _archives_in_range(date_from, date_to):
+        _attach_archive(cursor, archive.path)
+        try:
+            rows.extend(cursor.execute(sql.format(schema="archive"), params).fetchall())
+        finally:
+            cursor.execute("DETACH DATABASE archive")
+    return rows
+
+
+def _query_order_by_id(cursor, order_id, sql, lines=False):
+    """
+    Rows for a single order (bound as ?1) from the main database or, failing that,
+    the archive that holds it. With lines=True, {lines} in sql is replaced by that
+    order's ingredient lines (see _order_lines_sql).
+    """
+    def run(schema):
+        lines_sql = _order_lines_sql(schema, single_order=True) if lines else ""
+        return cursor.execute(sql.format(schema=schema, lines=lines_sql), (order_id,)).fetchall()
+
+    rows = run("main")
+    if rows:
+        return rows
+    for archive in list_archives():
+        _attach_archive(cursor, archive.path)
+        try:
+            rows = run("archive")
+        finally:
+            cursor.execute("DETACH DATABASE archive")
+        if rows:
+            return rows
+    return []
+
+
+def _ensure_archive_schema(cursor):
+    """Create the order tables in the attached archive like the main ones, adding any missing columns."""
+    for table in ("manufacturing_orders", "order_ingredients"):
+        cursor.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        create_sql = cursor.fetchone()[0]
+        create_sql = create_sql.replace(f"CREATE TABLE {table}", f"CREATE TABLE IF NOT EXISTS archive.{table}", 1)
+        cursor.execute(create_sql)
+
+        archive_columns = {r["name"] for r in cursor.execute(f"PRAGMA archive.table_info({table})")}
+        for col in cursor.execute(f"PRAGMA main.table_info({table})").fetchall():
+            if col["name"] not in archive_columns:
+                cursor.execute(f"ALTER TABLE archive.{table} ADD COLUMN {col['name']} {col['type']}")
+
+
+def archive_orders(cutoff_date):
+    """
+    Move orders dated before cutoff_date ('YYYY-MM-DD'), with their order_ingredients,
+    out of the main database into one archive file per year. Each year is copied and
+    removed in a single transaction, so an order is always in exactly one place.
+    Returns the number of orders archived.
+    """
+    conn, cursor = connect()
+    moved = 0
+    try:
+        cursor.execute(
+            "SELECT DISTINCT substr(date, 1, 4) AS year FROM manufacturing_orders WHERE date < ?",
+            (cutoff_date,)
+        )
+        years = [r["year"] for r in cursor.fetchall() if r["year"] and r["year"].isdigit()]
+
+        for year in years:
+            _attach_archive(cursor, archive_path(year))
+            try:
+                _ensure_archive_schema(cursor)
+                conn.commit()
+                _begin_immediate(cursor)
+                cursor.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS archive_ids (order_id INTEGER PRIMARY KEY)
+                """)
+                cursor.execute("DELETE FROM temp.archive_ids")
+                cursor.execute("""
+                    INSERT INTO temp.archive_ids
+                    SELECT order_id FROM main.manufacturing_orders
+                    WHERE date < ? AND substr(date, 1, 4) = ?
+                """, (cutoff_date, year))
+
+                for table in ("manufacturing_orders", "order_ingredients"):
+                    columns = ", ".join(r["name"] for r in cursor.execute(f"PRAGMA main.table_info({table})"))
+                    cursor.execute(f"""
+                        INSERT INTO archive.{table} ({columns})
+                        SELECT {columns} FROM main.{table}
+                        WHERE order_id IN (SELECT order_id FROM temp.archive_ids)
+                    """)
+                cursor.execute("DELETE FROM main.order_ingredients WHERE order_id IN (SELECT order_id FROM temp.archive_ids)")
+                cursor.execute("DELETE FROM main.manufacturing_orders WHERE order_id IN (SELECT order_id FROM temp.archive_ids)")
+                moved += cursor.rowcount
+                cursor.execute("DELETE FROM temp.archive_ids")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.execute("DETACH DATABASE archive")
+    finally:
+        conn.close()
+    return moved
 
 
 # ------------------------
@@ -516,14 +2279,355 @@ def backup_database(destination_folder=None):
     else:
         backup_path = backup_name
 
+    flush_to_disk()
     shutil.copy2(DB_NAME, backup_path)
     return backup_path
 
 
+def restore_database(backup_path):
+    """Replace the current database file with a backup copy."""
+    shutil.copy2(backup_path, DB_NAME)
+    if _memory is not None:
+        # The journaled work belongs to the database being replaced
+        _memory.load(discard_journal=True)
+    _publish(DatabaseReplaced(backup_path))
+
+
+# ------------------------
+# --- In-memory copy -----
+# ------------------------
+class _MemoryCopy:
+    """
+    DB_NAME loaded into a memdb database shared by every connection of this
+    process, and the redo journal of the writes made since the last flush.
+    Each journal line is one committed unit {"seq", "calls"}; meta 'redo_seq'
+    is the last seq included in the file, so a flush that died before the
+    journal was cleared is not replayed twice.
+    """
+
+    def __init__(self):
+        self.uri = f"file:/materialmanager-{os.getpid()}?vfs=memdb"
+        self.anchor = sqlite3.connect(self.uri, uri=True, check_same_thread=False)  # keeps it alive
+        # Kept open: its data_version changes only when another program writes the file
+        self.disk = sqlite3.connect(DB_NAME, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.journal_path = DB_NAME + REDO_JOURNAL_SUFFIX
+        self.seq = 0
+        self.lock = threading.RLock()
+
+    def load(self, discard_journal=False):
+        with self.lock:
+            self.disk.backup(self.anchor)
+            self.disk_version = self.disk.execute("PRAGMA data_version").fetchone()[0]
+            self.flushed_version = self.anchor.execute("PRAGMA data_version").fetchone()[0]
+            row = self.anchor.execute("SELECT value FROM meta WHERE key = 'redo_seq'").fetchone()
+            flushed_seq = int(row[0]) if row else 0
+            self.seq = max(self.seq, flushed_seq)
+            if discard_journal:
+                self.clear_journal()
+                return
+            units = [unit for unit in self.read_journal() if unit["seq"] > flushed_seq]
+            for unit in units:
+                self.replay(unit)
+                self.seq = unit["seq"]
+        if units:
+            # Make the recovered work durable in the file and start a new journal
+            flush_to_disk()
+
+    def read_journal(self):
+        if not os.path.exists(self.journal_path):
+            return []
+        units = []
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    units.append(json.loads(line))
+                except ValueError:
+                    break  # torn last line: that unit never returned to the user
+        return units
+
+    def replay(self, unit):
+        _thread_state.journaling = True
+        try:
+            with transaction():
+                for call in unit["calls"]:
+                    _thread_state.clock = call["at"]
+                    _JOURNALED[call["call"]](*call["args"], **call["kwargs"])
+        except Exception as e:
+            print(f"Could not replay {unit['calls']} from {self.journal_path}: {e}", file=sys.stderr)
+        finally:
+            _thread_state.journaling = False
+            _thread_state.clock = None
+
+    def append(self, calls):
+        self.seq += 1
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"seq": self.seq, "calls": calls}, ensure_ascii=False, default=list) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear_journal(self):
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+
+_memory = None
+
+
+def load_into_memory():
+    """
+    Copy DB_NAME into RAM: from now on every connection reads and writes the
+    copy, and flush_to_disk() (also run at exit) writes it back. Work left in
+    the redo journal by a session that crashed is replayed and flushed first.
+    """
+    global _memory
+    if _memory is None:
+        _memory = _MemoryCopy()
+        _memory.load()
+        atexit.register(_flush_at_exit)
+
+
+def _append_journal(calls):
+    if _memory is not None and calls:
+        _memory.append(calls)
+
+
+def flush_to_disk(force=False):
+    """
+    Write the RAM copy back to DB_NAME if it changed since the last flush; returns
+    whether it wrote. Raises ConcurrentModificationError if another program wrote
+    the file meanwhile, unless force (the other program's changes are then lost).
+    """
+    if _memory is None:
+        return False
+    with _memory.lock:
+        # Read first: a commit made during the backup leaves the copy dirty for the next flush
+        version = _memory.anchor.execute("PRAGMA data_version").fetchone()[0]
+        if version == _memory.flushed_version:
+            return False
+        if not force and _memory.disk.execute("PRAGMA data_version").fetchone()[0] != _memory.disk_version:
+            raise ConcurrentModificationError(f"{DB_NAME} was modified by another program since it was loaded")
+        _memory.anchor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('redo_seq', ?)", (_memory.seq,))
+        _memory.anchor.commit()
+        # One write transaction on DB_NAME: its rollback journal leaves the file
+        # either as it was or as the copy, even if the PC crashes half-way
+        _memory.anchor.backup(_memory.disk)
+        _memory.disk_version = _memory.disk.execute("PRAGMA data_version").fetchone()[0]
+        _memory.flushed_version = version
+        _memory.clear_journal()
+    return True
+
+
+def _flush_at_exit():
+    try:
+        flush_to_disk()
+    except (ConcurrentModificationError, sqlite3.Error) as e:
+        print(f"Changes made in memory were not written to {DB_NAME}: {e}", file=sys.stderr)
+
+
 
 def get_materials():
+    """Every material as a Material record, ordered by name."""
+    conn, cursor = connect()
+    _refresh_stale_prices(cursor)
+    cursor.row_factory = _material_row
+    cursor.execute(f"SELECT {MATERIAL_COLUMNS_SQL} FROM Materials ORDER BY name")
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+
+def get_products():
+    """Materials that have a formula, ordered by name (read from the has_formula flag and its index)."""
     conn, cursor = connect()
-    cursor.execute("SELECT id, name, identifier, price FROM materials ORDER BY name")
+    _refresh_stale_prices(cursor)
+    cursor.row_factory = _material_row
+    cursor.execute(f"SELECT {MATERIAL_COLUMNS_SQL} FROM Materials WHERE has_formula = 1 ORDER BY name")
     rows = cursor.fetchall()
     conn.close()
     return rows
+
+
+def get_material_columns():
+    """All materials ordered by name as MaterialColumns (one tuple per field), for large reads."""
+    conn, cursor = connect()
+    _refresh_stale_prices(cursor)
+    cursor.row_factory = None
+    cursor.execute(f"SELECT {MATERIAL_COLUMNS_SQL} FROM Materials ORDER BY name")
+    rows = cursor.fetchall()
+    conn.close()
+    return _columns(MaterialColumns, rows)
+
+
+# ------------------------
+# --- Search -------------
+# ------------------------
+# (materials_rev, TrigramIndex, {id: (name, identifier)}) of the last search
+_search_index = (None, None, {})
+
+
+def search_materials(query, limit=50, ids=None):
+    """
+    Typo- and accent-tolerant search over material names and identifiers, as a
+    list of SearchHit: every substring match first, then the fuzzy ones, ranked
+    by similarity (at most limit; all if limit is None). ids, if given, restricts
+    the hits to those material ids. The trigram index is built on the first
+    search and rebuilt only when a name or identifier changed.
+    """
+    global _search_index
+    conn, cursor = connect()
+    try:
+        rev = cursor.execute("SELECT value FROM meta WHERE key = 'materials_rev'").fetchone()[0]
+        cached_rev, index, materials = _search_index
+        if index is None or rev != cached_rev:
+            cursor.execute("SELECT id, name, identifier FROM Materials ORDER BY name")
+            materials = {r["id"]: (r["name"], r["identifier"]) for r in cursor.fetchall()}
+            index = TrigramIndex((mid, f"{name} {identifier or ''}") for mid, (name, identifier) in materials.items())
+            _search_index = (rev, index, materials)
+    finally:
+        conn.close()
+
+    allowed = set(ids) if ids is not None else None
+    return [SearchHit(mid, *materials[mid], score) for mid, score in index.search(query, limit, allowed)]
+
+
+# ------------------------
+# --- Export -------------
+# ------------------------
+EXPORT_COLUMNS = (
+    "order_id", "date", "product_id", "product_name", "product_identifier", "units",
+    "client_name", "proforma_number", "notes",
+    "ingredient_id", "ingredient_name", "ingredient_identifier", "quantity",
+)
+
+
+def export_orders(path, date_from=None, date_to=None, format="csv", resume=False, batch_size=1000):
+    """
+    Stream manufacturing orders joined to their ingredients into a CSV or JSON Lines
+    file, one row per ingredient line, ordered by order_id (archived years first).
+    Memory use is bounded by batch_size rows regardless of the history size.
+    date_from / date_to are inclusive 'YYYY-MM-DD' bounds on the order date;
+    archived years are only included when date_from reaches back to them.
+    With resume=True an existing file is continued: the last (possibly incomplete)
+    order in it is rewritten and export carries on from there.
+    Returns the number of rows written.
+    """
+    if format not in ("csv", "jsonl"):
+        raise ValueError(f"Unknown export format: {format}")
+
+    first_order_id = None
+    offset = 0
+    if resume and os.path.exists(path) and os.path.getsize(path) > 0:
+        offset, first_order_id = _export_resume_point(path, format)
+
+    where, params = _order_range_filter(date_from, date_to)
+    range_sql = "SELECT MIN(o.order_id), MAX(o.order_id) FROM {schema}.manufacturing_orders o"
+    if where:
+        range_sql += " WHERE " + " AND ".join(where)
+
+    # An order has either stored lines (older versions) or a formula version, so
+    # the two are joined directly instead of through the _order_lines_sql union:
+    # the plan then walks orders by order_id over their indexes and streams,
+    # only sorting the lines of each order
+    sql = """
+        SELECT o.order_id, o.date, o.product_id, p.name AS product_name, p.identifier AS product_identifier,
+               o.units, o.client_name, o.proforma_number, o.notes,
+               COALESCE(oi.ingredient_id, l.ingredient_id), m.name AS ingredient_name,
+               m.identifier AS ingredient_identifier, COALESCE(oi.quantity, l.quantity * o.units)
+        FROM {schema}.manufacturing_orders o
+        LEFT JOIN main.Materials p ON o.product_id = p.id
+        LEFT JOIN {schema}.order_ingredients oi ON oi.order_id = o.order_id
+        LEFT JOIN main.formula_version_lines l ON l.version_id = o.formula_version_id AND oi.id IS NULL
+        LEFT JOIN main.Materials m ON m.id = COALESCE(oi.ingredient_id, l.ingredient_id)
+        WHERE o.order_id BETWEEN ? AND ?
+    """
+    if where:
+        sql += " AND " + " AND ".join(where)
+    sql += " ORDER BY o.order_id, oi.id, l.rowid"
+
+    conn, cursor = connect()
+    cursor.row_factory = None
+    written = 0
+    # Archived years first (oldest first), then the main database
+    sources = [archive.path for archive in reversed(_archives_in_range(date_from, date_to))] + [None]
+    try:
+        if offset:
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+            f = open(path, "a", encoding="utf-8", newline="")
+        else:
+            f = open(path, "w", encoding="utf-8-sig" if format == "csv" else "utf-8", newline="")
+        with f:
+            if format == "csv":
+                writer = csv.writer(f)
+                if not offset:
+                    writer.writerow(EXPORT_COLUMNS)
+                write_rows = writer.writerows
+            else:
+                def write_rows(rows):
+                    f.writelines(
+                        json.dumps(dict(zip(EXPORT_COLUMNS, r)), ensure_ascii=False) + "\n" for r in rows
+                    )
+            for source in sources:
+                if source:
+                    _attach_archive(cursor, source)
+                try:
+                    schema = "archive" if source else "main"
+                    # order_id bounds of the date range from the date index, so a
+                    # short range reads only the orders in it
+                    low, high = cursor.execute(range_sql.format(schema=schema), params).fetchone()
+                    if low is None:
+                        continue
+                    if first_order_id is not None:
+                        low = max(low, first_order_id)
+                    cursor.execute(sql.format(schema=schema), [low, high] + params)
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        write_rows(rows)
+                        written += len(rows)
+                finally:
+                    if source:
+                        cursor.execute("DETACH DATABASE archive")
+    finally:
+        conn.close()
+    return written
+
+
+def _export_resume_point(path, format):
+    """
+    Scan an existing export and return (byte offset, order_id) of the start of its
+    last order, which may have been cut short. Returns (0, None) if nothing usable.
+    """
+    end = [0]
+    last_raw = [b""]
+
+    def lines(f):
+        for raw in f:
+            end[0] += len(raw)
+            last_raw[0] = raw
+            yield raw.decode("utf-8-sig" if end[0] == len(raw) else "utf-8")
+
+    last_id = None
+    last_start = 0
+    with open(path, "rb") as f:
+        if format == "csv":
+            records = csv.reader(lines(f))
+            # Cut short while the header was written: start over with a new file
+            if next(records, None) != list(EXPORT_COLUMNS) or not last_raw[0].endswith(b"\n"):
+                return 0, None
+        else:
+            records = lines(f)
+        start = end[0]
+        for record in records:
+            try:
+                order_id = int(record[0]) if format == "csv" else json.loads(record)["order_id"]
+            except (ValueError, IndexError, KeyError, TypeError):
+                break
+            if order_id != last_id:
+                last_id, last_start = order_id, start
+            start = end[0]
+
+    if last_id is None:
+        return (start if format == "csv" else 0), None
+    return last_start, last_id
@@ -0,0 +1,193 @@
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import database
+from stats import percentile
+
+# Relative weight of each operation in the mix a simulated station replays
+DEFAULT_MIX = {
+    "get_orders": 35,
+    "search_orders": 25,
+    "create_order": 15,
+    "update_material": 15,
+    "update_formula": 10,
+}
+
+# Seconds between starting the workers and the first operation, so they all begin together
+START_DELAY = 1.0
+
+CLIENTS = ["Pinturas Levante", "Suelos Norte", "Obras Garcia", "Industrias Sur", "Cliente contado"]
+
+
+def parse_mix(text):
+    """'create_order=20,get_orders=80' -> {"create_order": 20, "get_orders": 80}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"unknown operation {name!r}; choose from {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run(workers=4, duration=30.0, rate=2.0, mix=None, in_place=False, seed=None, out=sys.stdout):
+    """
+    Run `workers` processes against one database for `duration` seconds, each
+    issuing operations picked from mix at `rate` per second on average
+    (Poisson arrivals, so bursts happen as they do on the shop floor).
+    Unless in_place, a copy of the database is used and removed afterwards.
+    Prints and returns the merged results.
+    """
+    mix = mix or DEFAULT_MIX
+    database.create_tables()
+    if in_place:
+        path = os.path.abspath(database.DB_NAME)
+        tmp_dir = None
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix="loadtest_")
+        path = os.path.join(tmp_dir, "materials.db")
+        shutil.copyfile(database.DB_NAME, path)
+
+    seed = random.randrange(1 << 30) if seed is None else seed
+    start_at = time.time() + START_DELAY
+    config = {
+        "db": path, "duration": duration, "rate": rate, "mix": mix, "start_at": start_at,
+        "price_mode": database.PRICE_MODE, "busy_timeout": database.BUSY_TIMEOUT,
+    }
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_worker, [dict(config, seed=seed + n) for n in range(workers)])
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    merged = _merge(results)
+    _report(merged, workers, duration, rate, out)
+    return merged
+
+
+# ------------------------
+# --- Worker -------------
+# ------------------------
+def _worker(config):
+    """One simulated station. Returns its latencies, errors and lock statistics."""
+    database.DB_NAME = config["db"]
+    database.PRICE_MODE = config["price_mode"]
+    database.BUSY_TIMEOUT = config["busy_timeout"]
+    rng = random.Random(config["seed"])
+    station = _Station(rng)
+    names = list(config["mix"])
+    weights = [config["mix"][n] for n in names]
+
+    latencies = {name: [] for name in names}
+    errors = {name: {} for name in names}
+    next_at = config["start_at"]
+    end_at = config["start_at"] + config["duration"]
+    while True:
+        next_at += rng.expovariate(config["rate"])
+        if next_at >= end_at:
+            break
+        delay = next_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        name = rng.choices(names, weights)[0]
+        start = time.perf_counter()
+        try:
+            getattr(station, name)()
+        except Exception as e:
+            locked = isinstance(e, sqlite3.OperationalError) and database._is_locked_error(e)
+            kind = "locked" if locked else type(e).__name__
+            errors[name][kind] = errors[name].get(kind, 0) + 1
+        # Measured from the scheduled time: a station that falls behind shows it
+        latencies[name].append(time.perf_counter() - start + max(0.0, -delay))
+
+    return {
+        "latencies": latencies, "errors": errors, "lock_stats": dict(database.lock_stats),
+        "elapsed": time.time() - config["start_at"],
+    }
+
+
+class _Station:
+    """The operations of one station, on materials sampled from the database."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.products = [p.id for p in database.get_products()]
+        self.raw_materials = [m.id for m in database.get_materials() if not m.has_formula]
+
+    def get_orders(self):
+        database.get_orders()
+
+    def search_orders(self):
+        client = self.rng.choice(CLIENTS)
+        database.search_orders(client[:self.rng.randint(3, len(client))])
+
+    def create_order(self):
+        database.create_order(
+            self.rng.choice(self.products), self.rng.choice((25, 50, 100, 250, 500)),
+            client_name=self.rng.choice(CLIENTS), proforma_number=f"P-{self.rng.randint(1, 9999)}"
+        )
+
+    def update_material(self):
+        material_id = self.rng.choice(self.raw_materials)
+        material = database.get_material_by_id(material_id)
+        price = (material.price or 1.0) * self.rng.uniform(0.95, 1.05)
+        database.update_material(material_id, price=round(price, 4))
+
+    def update_formula(self):
+        product_id = self.rng.choice(self.products)
+        lines = [(line.ingredient_id, line.quantity) for line in database.get_formulas(product_id)]
+        if lines:
+            i = self.rng.randrange(len(lines))
+            lines[i] = (lines[i][0], round(lines[i][1] * self.rng.uniform(0.98, 1.02), 4))
+        database.update_formula(product_id, lines)
+
+
+# ------------------------
+# --- Report -------------
+# ------------------------
+def _merge(results):
+    merged = {"latencies": {}, "errors": {}, "lock_stats": dict.fromkeys(database.lock_stats, 0),
+              "elapsed": max(r["elapsed"] for r in results)}
+    for result in results:
+        for name, values in result["latencies"].items():
+            merged["latencies"].setdefault(name, []).extend(values)
+        for name, kinds in result["errors"].items():
+            target = merged["errors"].setdefault(name, {})
+            for kind, count in kinds.items():
+                target[kind] = target.get(kind, 0) + count
+        for key, value in result["lock_stats"].items():
+            if key == "lock_wait_max":
+                merged["lock_stats"][key] = max(merged["lock_stats"][key], value)
+            else:
+                merged["lock_stats"][key] += value
+    return merged
+
+
+def _report(merged, workers, duration, rate, out):
+    total = sum(len(v) for v in merged["latencies"].values())
+    # Stations that fell behind keep working past duration: throughput is over the real time
+    print(f"{workers} workers x {rate:g} ops/s for {duration:g} s: {total} operations in "
+          f"{merged['elapsed']:.1f} s, {total / merged['elapsed']:.1f} ops/s", file=out)
+    print(f"{'operation':<16} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}  errors", file=out)
+    for name, values in sorted(merged["latencies"].items()):
+        if not values:
+            continue
+        values = sorted(v * 1000 for v in values)
+        errors = ", ".join(f"{kind} {count}" for kind, count in merged["errors"].get(name, {}).items())
+        print(f"{name:<16} {len(values):>6} {percentile(values, 50):>9.1f} {percentile(values, 95):>9.1f} "
+              f"{percentile(values, 99):>9.1f} {values[-1]:>9.1f}  {errors or '-'}", file=out)
+    stats = merged["lock_stats"]
+    locked = sum(kinds.get("locked", 0) for kinds in merged["errors"].values())
+    waits = stats["lock_waits"]
+    mean = stats["lock_wait_seconds"] / waits * 1000 if waits else 0.0
+    print(f"lock waits: {waits} write transactions, {stats['lock_wait_seconds']:.2f} s blocked on the write lock "
+          f"(mean {mean:.1f} ms, max {stats['lock_wait_max'] * 1000:.1f} ms)", file=out)
+    print(f"retries: {stats['retries']} retried transactions, {stats['backoff_seconds']:.2f} s backing off; "
+          f"'database is locked' errors: {locked}", file=out)
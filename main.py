@@ -1,4 +1,124 @@
-from ui.app import run_app
+import argparse
+import multiprocessing
+import database
 
-if __name__ == "__main__":
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="materialmanager")
+    parser.add_argument("--db", help="database file (default: materials.db)")
+    parser.add_argument("--price-mode", choices=("eager", "lazy"),
+                        help="propagate price changes at once or on the next read (default: eager)")
+    parser.add_argument("--profile", choices=("time", "cprofile", "tracemalloc"),
+                        help="measure UI callbacks and write a summary to profiles/ at exit")
+    parser.add_argument("--kiosk", action="store_true",
+                        help="read-only viewer for shop-floor stations: no editing, never takes a write lock")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="work on a copy of the database in RAM, written back every 30 s and at exit, "
+                             "with a redo journal replayed after a crash "
+                             "(single-station installs on slow or network storage)")
+    sub = parser.add_subparsers(dest="command")
+
+    export = sub.add_parser("export", help="export orders with their ingredients")
+    export.add_argument("path")
+    export.add_argument("--from", dest="date_from", help="first date, YYYY-MM-DD (archived years are only read when this reaches them)")
+    export.add_argument("--to", dest="date_to", help="last date, YYYY-MM-DD")
+    export.add_argument("--format", choices=("csv", "jsonl"), help="default: from the file extension")
+    export.add_argument("--resume", action="store_true", help="continue an interrupted export")
+
+    archive = sub.add_parser("archive", help="move old orders to per-year archive databases")
+    archive.add_argument("--before", required=True, help="archive orders dated before YYYY-MM-DD")
+
+    cleanup = sub.add_parser("cleanup", help="repair inconsistent data and run periodic maintenance")
+    cleanup.add_argument("--apply", action="store_true", help="make the changes (default: dry run)")
+    cleanup.add_argument("--force", action="store_true", help="run ANALYZE/optimize/vacuum even if not due")
+
+    sync = sub.add_parser("sync", help="exchange changes with a copy of the database")
+    sync_sub = sync.add_subparsers(dest="sync_command", required=True)
+    sync_export = sync_sub.add_parser("export", help="write the changes since the last export to a file")
+    sync_export.add_argument("path")
+    sync_export.add_argument("--peer", default="default", help="copy the file is for; each peer has its own last export")
+    sync_export.add_argument("--all", action="store_true", help="every journaled change, not only the new ones")
+    sync_import = sync_sub.add_parser("import", help="apply a file written by sync export")
+    sync_import.add_argument("path")
+    sync_import.add_argument("--policy", choices=("newest", "local", "remote"), default="newest",
+                             help="which side wins when both changed the same thing (default: newest)")
+    sync_sub.add_parser("fork", help="run on a fresh copy of the database before using it elsewhere")
+
+    loadtest = sub.add_parser("loadtest", help="simulate several stations using the database at once")
+    loadtest.add_argument("--workers", type=int, default=4, help="station processes (default: 4)")
+    loadtest.add_argument("--duration", type=float, default=30, help="seconds (default: 30)")
+    loadtest.add_argument("--rate", type=float, default=2, help="operations per second per station (default: 2)")
+    loadtest.add_argument("--mix", help="operation weights, e.g. create_order=20,get_orders=80")
+    loadtest.add_argument("--seed", type=int)
+    loadtest.add_argument("--in-place", action="store_true", help="use the database itself, not a copy")
+
+    serve = sub.add_parser("serve", help="run the JSON/HTTP server for other stations")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--readers", type=int, default=4, help="read connections (default: 4)")
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.db:
+        database.DB_NAME = args.db
+    if args.price_mode:
+        database.PRICE_MODE = args.price_mode
+    if args.kiosk:
+        database.READ_ONLY = True
+    if args.in_memory:
+        database.IN_MEMORY = True
+
+    if args.command == "export":
+        if not database.READ_ONLY:
+            database.create_tables()
+        fmt = args.format or ("jsonl" if args.path.endswith(".jsonl") else "csv")
+        rows = database.export_orders(args.path, args.date_from, args.date_to, format=fmt, resume=args.resume)
+        print(f"{rows} rows written to {args.path}")
+        return
+
+    if args.command == "archive":
+        database.create_tables()
+        moved = database.archive_orders(args.before)
+        print(f"{moved} orders archived")
+        return
+
+    if args.command == "cleanup":
+        import cleanup
+        cleanup.run(apply=args.apply, force=args.force)
+        return
+
+    if args.command == "sync":
+        import sync
+        if args.sync_command == "export":
+            count = sync.export_changes(args.path, peer=args.peer, full=args.all)
+            print(f"{count} changes written to {args.path}")
+        elif args.sync_command == "import":
+            sync.import_changes(args.path, policy=args.policy)
+        else:
+            print(f"new origin {sync.fork()}")
+        return
+
+    if args.command == "loadtest":
+        import loadtest
+        mix = loadtest.parse_mix(args.mix) if args.mix else None
+        loadtest.run(args.workers, args.duration, args.rate, mix, in_place=args.in_place, seed=args.seed)
+        return
+
+    if args.command == "serve":
+        import server
+        server.serve(args.host, args.port, args.readers)
+        return
+
+    from ui import profiling
+    from ui.app import run_app
+    if args.profile:
+        profiling.PROFILE = args.profile
     run_app()
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()  # process pool for printing in the frozen .exe
+    main()
@@ -0,0 +1,98 @@
+import heapq
+import re
+import unicodedata
+from collections import Counter
+from itertools import chain
+
+# Hits must contain at least this fraction of the query's trigrams
+MIN_SCORE = 0.5
+
+_NON_WORD = re.compile(r"[^0-9a-z]+")
+
+
+def fold(text):
+    """Lower-case, accent-free text with punctuation collapsed to single spaces ("Résina-Epoxy" -> "resina epoxy")."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _NON_WORD.sub(" ", text.casefold()).strip()
+
+
+def trigrams(folded):
+    """Set of trigrams of each word, padded so short words and word starts count ("  r", " re", ...)."""
+    grams = set()
+    for word in folded.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """
+    In-memory inverted index from trigrams of accent-folded text to entries.
+    search() returns every entry containing the query as a substring, then the
+    fuzzy matches; each group is ranked by the share of the query's trigrams an
+    entry contains, ties broken by Dice similarity (shorter, closer texts first).
+    """
+
+    def __init__(self, entries):
+        """entries: iterable of (key, text)."""
+        self.keys = []
+        self.texts = []
+        self.sizes = []
+        self.postings = {}  # trigram -> [entry index]
+        for key, text in entries:
+            folded = fold(text)
+            grams = trigrams(folded)
+            index = len(self.keys)
+            self.keys.append(key)
+            self.texts.append(folded)
+            self.sizes.append(len(grams))
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(index)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, query, limit=50, allowed=None, min_score=MIN_SCORE):
+        """
+        Best matches for query as a list of (key, score), best first, at most
+        limit of them (all if limit is None); score is the Dice similarity of
+        the two trigram sets. Substring matches are returned whatever their
+        score. allowed, if given, is a set of the keys that may be returned.
+        """
+        folded = fold(query)
+        grams = trigrams(folded)
+        if not grams:
+            return []
+
+        shared = Counter(chain.from_iterable(self.postings.get(gram, ()) for gram in grams))
+
+        size = len(grams)
+        needed = min_score * size
+        passing = {index for index, count in shared.items() if count >= needed}
+        passing.update(self._containing(folded))
+        if allowed is not None:
+            keys = self.keys
+            passing = {index for index in passing if keys[index] in allowed}
+
+        texts = self.texts
+        sizes = self.sizes
+        candidates = [
+            (folded in texts[index], shared[index], 2 * shared[index] / (size + sizes[index]), -index)
+            for index in passing
+        ]
+        best = sorted(candidates, reverse=True) if limit is None else heapq.nlargest(limit, candidates)
+        return [(self.keys[-index], dice) for _, _, dice, index in best]
+
+    def _containing(self, folded):
+        """Indexes of the entries whose text contains folded."""
+        # Every unpadded trigram of a query word occurs in the matching text word,
+        # so only entries on all those postings can contain the query
+        inner = {word[i:i + 3] for word in folded.split() for i in range(len(word) - 2)}
+        if inner:
+            postings = sorted((self.postings.get(gram, []) for gram in inner), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            candidates = range(len(self.texts))  # words too short for a trigram
+        texts = self.texts
+        return [index for index in candidates if folded in texts[index]]
@@ -0,0 +1,476 @@
+# server.py
+# Optional JSON/HTTP front end for the database (`materialmanager serve`), so
+# tablets and office PCs talk to one process instead of each opening the
+# SQLite file over the network share.
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import database
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_READERS = 4
+
+# Largest request body accepted, in bytes
+MAX_BODY = 4 * 1024 * 1024
+
+# Cached GET responses kept per data version; PDFs are never cached
+MAX_CACHED_RESPONSES = 512
+
+REASONS = {
+    200: "OK", 201: "Created", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+    405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# ------------------------
+# --- Handlers -----------
+# ------------------------
+# Each handler gets (match, query, body) and returns JSON-able data, or a
+# (status, data) pair; bytes are sent as a PDF.
+
+def _require(body, *keys):
+    missing = [k for k in keys if k not in body]
+    if missing:
+        raise HttpError(400, f"missing fields: {', '.join(missing)}")
+
+
+def _first(query, key, default=None):
+    return query.get(key, [default])[0]
+
+
+def list_materials(match, query, body):
+    text = (_first(query, "q") or "").strip()
+    if text:
+        return [hit._asdict() for hit in database.search_materials(text, int(_first(query, "limit") or 50))]
+    if _first(query, "columns"):
+        return database.get_material_columns()._asdict()
+    return [m._asdict() for m in database.get_materials()]
+
+
+def _material(material):
+    if material is None:
+        raise HttpError(404, "material not found")
+    return material._asdict()
+
+
+def get_material(match, query, body):
+    return _material(database.get_material_by_id(int(match["id"])))
+
+
+def add_material(match, query, body):
+    _require(body, "name")
+    ok = database.add_material(
+        body["name"], body.get("description", ""), body.get("identifier"), body.get("price", 0.0)
+    )
+    if not ok:
+        raise HttpError(409, "name or identifier already exists")
+    return 201, _material(database.get_material_by_name(body["name"]))
+
+
+def update_material(match, query, body):
+    material_id = int(match["id"])
+    if database.get_material_by_id(material_id) is None:
+        raise HttpError(404, "material not found")
+    fields = {k: body[k] for k in ("name", "identifier", "description", "price", "expected_version") if k in body}
+    if not database.update_material(material_id, **fields):
+        raise HttpError(409, "name or identifier already exists")
+    return _material(database.get_material_by_id(material_id))
+
+
+def clone_material(match, query, body):
+    new_id = database.clone_product(int(match["id"]), deep=bool(body.get("deep")))
+    if new_id is None:
+        raise HttpError(404, "material not found")
+    return 201, _material(database.get_material_by_id(new_id))
+
+
+def material_where_used(match, query, body):
+    depth = _first(query, "max_depth")
+    return [row._asdict() for row in database.where_used(int(match["id"]), int(depth) if depth else None)]
+
+
+def get_formula(match, query, body):
+    product_id = int(match["id"])
+    return {
+        "product_id": product_id,
+        "version": database.get_formula_version(product_id),
+        "lines": [line._asdict() for line in database.get_formulas(product_id)],
+    }
+
+
+def put_formula(match, query, body):
+    _require(body, "ingredients")
+    product_id = int(match["id"])
+    ingredients = [(int(i), float(q)) for i, q in body["ingredients"]]
+    database.update_formula(product_id, ingredients, expected_version=body.get("expected_version"))
+    return get_formula(match, query, body)
+
+
+def simulate_prices(match, query, body):
+    _require(body, "changes")
+    changes = {int(k): float(v) for k, v in body["changes"].items()}
+    return [
+        {"product_id": row.product_id, "name": row.name, "old": row.old_price, "new": row.new_price, "delta": row.delta}
+        for row in database.simulate_price_changes(changes)
+    ]
+
+
+def list_orders(match, query, body):
+    text = _first(query, "q")
+    date_from, date_to = _first(query, "from"), _first(query, "to")
+    if text:
+        rows = database.search_orders(text, date_from, date_to)
+    elif _first(query, "columns"):
+        return database.get_order_columns(date_from, date_to)._asdict()
+    else:
+        rows = database.get_orders(date_from, date_to)
+    return [order._asdict() for order in rows]
+
+
+def get_order(match, query, body):
+    order_id = int(match["id"])
+    info = database.get_order_info(order_id)
+    if info is None:
+        raise HttpError(404, "order not found")
+    details = database.get_order_details(order_id)
+    return {
+        "order_id": order_id, **info._asdict(),
+        "ingredients": [line._asdict() for line in details.ingredients],
+    }
+
+
+def create_order(match, query, body):
+    _require(body, "product_id", "units")
+    order_id = database.create_order(
+        int(body["product_id"]), float(body["units"]), body.get("notes", ""),
+        body.get("client_name"), body.get("proforma_number"), body.get("order_id")
+    )
+    return 201, {"order_id": order_id}
+
+
+def reserve_orders(match, query, body):
+    return 201, {"order_ids": database.reserve_order_ids(int(body.get("count", 1)))}
+
+
+def next_order_id(match, query, body):
+    return {"order_id": database.get_next_order_id()}
+
+
+def order_pdf(match, query, body):
+    return _render_pdf([int(match["id"])])
+
+
+def print_orders(match, query, body):
+    _require(body, "order_ids")
+    return _render_pdf([int(i) for i in body["order_ids"]])
+
+
+def _render_pdf(order_ids):
+    from ui.print_order import print_orders as render
+
+    paths = render(order_ids)
+    if not paths:
+        raise HttpError(404, "order not found")
+    try:
+        with open(paths[0], "rb") as f:
+            return f.read()
+    finally:
+        os.remove(paths[0])
+
+
+def get_stock(match, query, body):
+    if match["id"]:
+        material_id = int(match["id"])
+        as_of = _first(query, "as_of")
+        if as_of:
+            return {"material_id": material_id, "quantity": database.get_stock_as_of(material_id, as_of)}
+        return {"material_id": material_id, "quantity": database.get_stock(material_id)}
+    return database.get_stock()
+
+
+# (method, path pattern, handler, writes)
+ROUTES = [
+    ("GET", r"/materials", list_materials, False),
+    ("POST", r"/materials", add_material, True),
+    ("GET", r"/materials/(?P<id>\d+)", get_material, False),
+    ("PUT", r"/materials/(?P<id>\d+)", update_material, True),
+    ("POST", r"/materials/(?P<id>\d+)/clone", clone_material, True),
+    ("GET", r"/materials/(?P<id>\d+)/where-used", material_where_used, False),
+    ("GET", r"/products/(?P<id>\d+)/formula", get_formula, False),
+    ("PUT", r"/products/(?P<id>\d+)/formula", put_formula, True),
+    ("POST", r"/prices/simulate", simulate_prices, False),
+    ("GET", r"/orders", list_orders, False),
+    ("POST", r"/orders", create_order, True),
+    ("GET", r"/orders/next-id", next_order_id, False),
+    ("POST", r"/orders/reserve", reserve_orders, True),
+    ("GET", r"/orders/(?P<id>\d+)", get_order, False),
+    ("GET", r"/orders/(?P<id>\d+)/pdf", order_pdf, False),
+    ("POST", r"/orders/print", print_orders, False),
+    ("GET", r"/stock(?:/(?P<id>\d+))?", get_stock, False),
+]
+ROUTES = [(method, re.compile(pattern + r"/?"), handler, writes) for method, pattern, handler, writes in ROUTES]
+
+
+def _resolve(method, path):
+    allowed = False
+    for route_method, pattern, handler, writes in ROUTES:
+        match = pattern.fullmatch(path)
+        if match:
+            if route_method == method:
+                return match, handler, writes
+            allowed = True
+    raise HttpError(405 if allowed else 404, f"no route for {method} {path}")
+
+
+def _call(handler, match, query, body):
+    """Run a handler in a worker thread and turn failures into (status, data)."""
+    try:
+        result = handler(match, query, body)
+    except HttpError as e:
+        return e.status, {"error": str(e)}
+    except database.ConcurrentModificationError as e:
+        return 409, {"error": str(e)}
+    except sqlite3.OperationalError as e:
+        if database._is_locked_error(e):
+            return 503, {"error": str(e)}
+        raise
+    except (KeyError, ValueError, TypeError) as e:
+        return 400, {"error": f"invalid request: {e}"}
+    if isinstance(result, tuple):
+        return result
+    return 200, result
+
+
+def _encode(data):
+    if isinstance(data, bytes):
+        return data, "application/pdf"
+    body = json.dumps(data, ensure_ascii=False, default=dict, separators=(",", ":"))
+    return body.encode("utf-8"), "application/json; charset=utf-8"
+
+
+# ------------------------
+# --- Server -------------
+# ------------------------
+class Server:
+    """
+    One writer thread with its own connection runs every write, one at a time;
+    a pool of read-only connections serves reads. Identical GETs in flight are
+    answered by a single query, and GET responses are cached with an ETag until
+    the database changes (from this server or any other connection).
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, readers=DEFAULT_READERS):
+        self.host = host
+        self.port = port
+        self.writer = ThreadPoolExecutor(1, "db-writer", database.bind_connection)
+        self.readers = ThreadPoolExecutor(readers, "db-reader", database.bind_connection, (True,))
+        self.in_flight = {}
+        self.cache = {}
+        self.cache_version = None
+        self.server = None
+        self.monitor = None
+        self.writes = 0
+        self.sweep_pending = False
+
+    async def start(self):
+        # Its PRAGMA data_version changes whenever another connection commits
+        self.monitor = database.open_connection(read_only=True)
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.writer.shutdown()
+        self.readers.shutdown()
+        if self.monitor is not None:
+            self.monitor.close()
+
+    def data_version(self):
+        return (self.writes, self.monitor.execute("PRAGMA data_version").fetchone()[0])
+
+    async def dispatch(self, method, target, body):
+        """Returns (status, data) for one request; used for single and batched requests."""
+        parts = urlsplit(target)
+        query = parse_qs(parts.query)
+        try:
+            match, handler, writes = _resolve(method, parts.path)
+        except HttpError as e:
+            return e.status, {"error": str(e)}
+
+        loop = asyncio.get_running_loop()
+        if writes:
+            try:
+                return await loop.run_in_executor(self.writer, _call, handler, match, query, body)
+            finally:
+                self.writes += 1
+                self.schedule_price_sweep()
+
+        if method != "GET":
+            return await loop.run_in_executor(self.readers, _call, handler, match, query, body)
+
+        # Coalesce identical reads already running
+        pending = self.in_flight.get(target)
+        if pending is None:
+            pending = loop.run_in_executor(self.readers, _call, handler, match, query, None)
+            self.in_flight[target] = pending
+            pending.add_done_callback(lambda _f: self.in_flight.pop(target, None))
+        return await asyncio.shield(pending)
+
+    def schedule_price_sweep(self):
+        """
+        Lazy price mode: readers are read-only, so stale prices are recomputed on
+        the writer thread, once after a burst of queued writes.
+        """
+        if database.PRICE_MODE != "lazy" or self.sweep_pending:
+            return
+        self.sweep_pending = True
+
+        def sweep():
+            self.sweep_pending = False
+            database.refresh_dirty_prices()
+
+        self.writer.submit(sweep)
+
+    async def cached_get(self, target):
+        """Returns (status, body, content_type, etag)."""
+        version = self.data_version()
+        if version != self.cache_version:
+            self.cache.clear()
+            self.cache_version = version
+        hit = self.cache.get(target)
+        if hit is not None:
+            return hit
+
+        status, data = await self.dispatch("GET", target, None)
+        body, content_type = _encode(data)
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        response = (status, body, content_type, etag)
+        # PDFs are large and rarely fetched twice: only JSON responses are kept
+        if status == 200 and not isinstance(data, bytes) and self.data_version() == version:
+            if len(self.cache) >= MAX_CACHED_RESPONSES:
+                self.cache.clear()
+            self.cache[target] = response
+        return response
+
+    async def batch(self, body):
+        """POST /batch {"requests": [{"method", "path", "body"}, ...]}: runs them concurrently, in one round trip."""
+        requests = body.get("requests") if isinstance(body, dict) else None
+        if not isinstance(requests, list):
+            return 400, {"error": "expected {\"requests\": [...]}"}
+
+        async def one(item):
+            method = str(item.get("method", "GET")).upper()
+            status, data = await self.dispatch(method, item.get("path", ""), item.get("body") or {})
+            if isinstance(data, bytes):
+                return {"status": 400, "body": {"error": "binary responses are not available in a batch"}}
+            return {"status": status, "body": data}
+
+        return 200, await asyncio.gather(*(one(item) for item in requests))
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, 400, *_encode({"error": "malformed request line"}), close=True)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY:
+                    await self.respond(writer, 413, *_encode({"error": "request too large"}), close=True)
+                    break
+                raw = await reader.readexactly(length) if length else b""
+
+                await self.handle_request(writer, method.upper(), target, headers, raw, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, writer, method, target, headers, raw, keep_alive):
+        try:
+            if method == "GET":
+                status, body, content_type, etag = await self.cached_get(target)
+                if status == 200 and headers.get("if-none-match") == etag:
+                    await self.respond(writer, 304, b"", None, etag=etag, close=not keep_alive)
+                    return
+                await self.respond(writer, status, body, content_type, etag=etag, close=not keep_alive)
+                return
+
+            try:
+                payload = json.loads(raw.decode("utf-8")) if raw else {}
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                status, data = 400, {"error": "body must be JSON"}
+            else:
+                if urlsplit(target).path.rstrip("/") == "/batch" and method == "POST":
+                    status, data = await self.batch(payload)
+                else:
+                    status, data = await self.dispatch(method, target, payload)
+        except Exception as e:
+            status, data = 500, {"error": f"{type(e).__name__}: {e}"}
+        await self.respond(writer, status, *_encode(data), close=not keep_alive)
+
+    async def respond(self, writer, status, body, content_type, etag=None, close=False):
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}", f"Content-Length: {len(body)}"]
+        if content_type:
+            lines.append(f"Content-Type: {content_type}")
+        if etag:
+            lines.append(f"ETag: {etag}")
+            lines.append("Cache-Control: no-cache")
+        lines.append("Connection: close" if close else "Connection: keep-alive")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, readers=DEFAULT_READERS):
+    database.create_tables()
+    server = Server(host, port, readers)
+
+    async def run():
+        await server.start()
+        print(f"Serving {database.DB_NAME} on http://{server.host}:{server.port}")
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,6 @@
+import math
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
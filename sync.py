@@ -0,0 +1,442 @@
+import gzip
+import json
+import sys
+from datetime import datetime
+import database
+
+FORMAT_VERSION = 1
+
+# Conflict rules for an entity changed here and in the incoming file since the
+# last import from that origin: "newest" keeps the later change, "local"
+# keeps this database's, "remote" takes the incoming one
+POLICIES = ("newest", "local", "remote")
+
+# Materials first so formulas, orders and stock movements can refer to them
+ENTITY_ORDER = {"material": 0, "formula": 1, "order": 2, "movement": 3}
+
+# Returned by the APPLY functions for a change that refers to a material not
+# known here: it is left for a later import instead of being dropped
+DEFERRED = object()
+
+
+def _origin_id(cursor):
+    return cursor.execute("SELECT value FROM meta WHERE key = 'origin_id'").fetchone()[0]
+
+
+# ------------------------
+# --- Export -------------
+# ------------------------
+def export_changes(path, peer="default", full=False):
+    """
+    Write the changes journaled since the last export to peer (or all of them
+    with full) to a gzip'd JSON file for `sync import` on another copy.
+    Returns the number of changes written.
+    """
+    database.create_tables()
+    conn, cursor = database.connect()
+    try:
+        origin = _origin_id(cursor)
+        key = f"sync_exported:{peer}"
+        row = cursor.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        since = 0 if full or row is None else int(row[0])
+        cursor.execute("""
+            SELECT seq, entity, uid, op, origin, origin_seq, changed_at
+            FROM change_journal WHERE seq > ? ORDER BY seq
+        """, (since,))
+        journal = cursor.fetchall()
+        data = _load_entities(cursor, journal)
+
+        changes = []
+        for r in sorted(journal, key=lambda r: (ENTITY_ORDER[r["entity"]], r["seq"])):
+            entry = data.get((r["entity"], r["uid"]))
+            if entry is None and r["op"] != "D":
+                continue  # gone since (archived order, material deleted by hand)
+            changes.append({
+                "entity": r["entity"], "uid": r["uid"], "op": r["op"],
+                "origin": r["origin"] or origin,
+                "seq": r["origin_seq"] if r["origin"] else r["seq"],
+                "changed_at": r["changed_at"],
+                "data": entry,
+            })
+
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump({
+                "format": FORMAT_VERSION,
+                "origin": origin,
+                "exported_at": datetime.now().isoformat(timespec="seconds"),
+                "changes": changes,
+            }, f, ensure_ascii=False, separators=(",", ":"))
+
+        if journal:
+            cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, journal[-1]["seq"]))
+            conn.commit()
+    finally:
+        conn.close()
+    return len(changes)
+
+
+def _load_entities(cursor, journal):
+    """Current content of every journaled entity, loaded with one query per entity type."""
+    uids = {}
+    for r in journal:
+        uids.setdefault(r["entity"], []).append(r["uid"])
+    data = {}
+
+    cursor.execute("""
+        SELECT uid, name, identifier, description, price
+        FROM Materials WHERE uid IN (SELECT value FROM json_each(?))
+    """, (json.dumps(uids.get("material", [])),))
+    for r in cursor.fetchall():
+        data["material", r["uid"]] = {
+            "name": r["name"], "identifier": r["identifier"],
+            "description": r["description"], "price": r["price"],
+        }
+
+    cursor.execute("""
+        SELECT p.uid AS product, i.uid AS ingredient, f.quantity
+        FROM Materials p
+        LEFT JOIN Formulas f ON f.product_id = p.id
+        LEFT JOIN Materials i ON i.id = f.ingredient_id
+        WHERE p.uid IN (SELECT value FROM json_each(?))
+    """, (json.dumps(uids.get("formula", [])),))
+    for r in cursor.fetchall():
+        lines = data.setdefault(("formula", r["product"]), {"lines": []})["lines"]
+        if r["ingredient"] is not None:
+            lines.append([r["ingredient"], r["quantity"]])
+
+    cursor.execute("""
+        SELECT o.uid, o.order_id, p.uid AS product, o.units, o.date, o.notes,
+               o.client_name, o.proforma_number, i.uid AS ingredient, SUM(l.quantity) AS quantity
+        FROM manufacturing_orders o
+        JOIN Materials p ON p.id = o.product_id
+        LEFT JOIN order_lines l ON l.order_id = o.order_id
+        LEFT JOIN Materials i ON i.id = l.ingredient_id
+        WHERE o.uid IN (SELECT value FROM json_each(?))
+        GROUP BY o.order_id, i.uid
+    """, (json.dumps(uids.get("order", [])),))
+    for r in cursor.fetchall():
+        entry = data.setdefault(("order", r["uid"]), {
+            "order_id": r["order_id"], "product": r["product"], "units": r["units"],
+            "date": r["date"], "notes": r["notes"], "client_name": r["client_name"],
+            "proforma_number": r["proforma_number"], "lines": [],
+        })
+        if r["ingredient"] is not None:
+            entry["lines"].append([r["ingredient"], r["quantity"]])
+
+    # An archived order is not in the main database: its movements go without it
+    cursor.execute("""
+        SELECT v.uid, m.uid AS material, v.kind, v.quantity, v.date, o.uid AS "order", v.notes
+        FROM inventory_movements v
+        JOIN Materials m ON m.id = v.material_id
+        LEFT JOIN manufacturing_orders o ON o.order_id = v.order_id
+        WHERE v.uid IN (SELECT value FROM json_each(?))
+    """, (json.dumps(uids.get("movement", [])),))
+    for r in cursor.fetchall():
+        data["movement", r["uid"]] = {
+            "material": r["material"], "kind": r["kind"], "quantity": r["quantity"],
+            "date": r["date"], "order": r["order"], "notes": r["notes"],
+        }
+    return data
+
+
+# ------------------------
+# --- Import -------------
+# ------------------------
+def import_changes(path, policy="newest", out=sys.stdout):
+    """
+    Apply a `sync export` file in one transaction. Changes already applied,
+    and this database's own changes coming back, are skipped; an entity
+    changed on both sides since the last import from that origin is resolved
+    by policy (see POLICIES). Derived prices are recomputed at the end.
+    A change that refers to a material unknown here is deferred: the origin is
+    only marked as seen up to just before it, so importing the file again (or
+    an `--all` export) once the material exists applies it.
+    Returns {"applied": n, "skipped": n, "conflicts": n, "deferred": n}.
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"policy must be one of {', '.join(POLICIES)}")
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        payload = json.load(f)
+    if payload.get("format") != FORMAT_VERSION:
+        raise ValueError(f"unsupported sync file format {payload.get('format')!r}")
+
+    database.create_tables()
+    report = {"applied": 0, "skipped": 0, "conflicts": 0, "deferred": 0}
+    notes = []
+    with database.transaction():
+        conn, cursor = database.connect()
+        own = _origin_id(cursor)
+        if payload["origin"] == own:
+            raise ValueError("the file comes from a database with this same origin; "
+                             "run `sync fork` on the copy first")
+        changes = payload["changes"]
+        state = {r["origin"]: (r["last_seq"], r["local_seq"]) for r in cursor.execute("SELECT * FROM sync_state")}
+        cursor.execute("""
+            SELECT entity, uid, seq, origin, origin_seq, changed_at FROM change_journal
+            WHERE uid IN (SELECT value FROM json_each(?))
+        """, (json.dumps([c["uid"] for c in changes]),))
+        journal = {(r["entity"], r["uid"]): r for r in cursor.fetchall()}
+
+        applied = []
+        repriced = set()
+        last_seen = {}
+        deferred = {}  # origin -> lowest seq left for a later import
+        for change in changes:
+            origin, seq = change["origin"], change["seq"]
+            last_seen[origin] = max(seq, last_seen.get(origin, 0))
+            last_seq, local_seq = state.get(origin, (0, 0))
+            local = journal.get((change["entity"], change["uid"]))
+            if (origin == own or seq <= last_seq
+                    or (local is not None and local["origin"] == origin and local["origin_seq"] >= seq)):
+                report["skipped"] += 1
+                continue
+            if local is not None and local["origin"] is None and local["seq"] > local_seq:
+                report["conflicts"] += 1
+                remote_wins = policy == "remote" or (
+                    policy == "newest" and (change["changed_at"], origin) > (local["changed_at"], own)
+                )
+                notes.append(f"conflict on {change['entity']} {_describe(change)}: "
+                             f"{'incoming' if remote_wins else 'local'} change kept")
+                if not remote_wins:
+                    continue
+            material_id = APPLY[change["entity"]](cursor, change, notes)
+            if material_id is DEFERRED:
+                report["deferred"] += 1
+                deferred[origin] = min(seq, deferred.get(origin, seq))
+                continue
+            if material_id is None:
+                report["skipped"] += 1
+                continue
+            if change["entity"] != "movement":  # stock does not affect prices
+                repriced.add(material_id)
+            applied.append(change)
+
+        cursor.executemany("""
+            UPDATE change_journal SET origin = ?, origin_seq = ?, changed_at = ?
+            WHERE entity = ? AND uid = ?
+        """, [(c["origin"], c["seq"], c["changed_at"], c["entity"], c["uid"]) for c in applied])
+        local_seq = cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_journal").fetchone()[0]
+        seen = []
+        for origin, seq in last_seen.items():
+            if origin == own:
+                continue
+            if origin in deferred:
+                # Local edits keep counting as conflicts until the origin is fully imported
+                seen.append((origin, deferred[origin] - 1, state.get(origin, (0, 0))[1]))
+            else:
+                seen.append((origin, seq, local_seq))
+        cursor.executemany("""
+            INSERT INTO sync_state (origin, last_seq, local_seq) VALUES (?, ?, ?)
+            ON CONFLICT(origin) DO UPDATE SET
+                last_seq = MAX(last_seq, excluded.last_seq), local_seq = excluded.local_seq
+        """, seen)
+        if repriced:
+            database.propagate_price_updates(repriced)
+        report["applied"] = len(applied)
+
+    for note in notes:
+        print(note, file=out)
+    print(f"{report['applied']} changes applied, {report['skipped']} skipped, "
+          f"{report['conflicts']} conflicts, {report['deferred']} deferred", file=out)
+    return report
+
+
+def _describe(change):
+    data = change["data"] or {}
+    return data.get("name") or data.get("order_id") or change["uid"]
+
+
+def _material_id(cursor, uid):
+    row = cursor.execute("SELECT id FROM Materials WHERE uid = ?", (uid,)).fetchone()
+    return row[0] if row else None
+
+
+def _apply_material(cursor, change, notes):
+    """Returns the local material id, or None if nothing was applied."""
+    uid = change["uid"]
+    material_id = _material_id(cursor, uid)
+    if change["op"] == "D":
+        if material_id is None:
+            return None
+        in_use = cursor.execute("""
+            SELECT 1 FROM Formulas WHERE product_id = ?1 OR ingredient_id = ?1
+            UNION ALL SELECT 1 FROM manufacturing_orders WHERE product_id = ?1
+            LIMIT 1
+        """, (material_id,)).fetchone()
+        if in_use:
+            notes.append(f"material {uid} deleted remotely but still used here: kept")
+            return None
+        cursor.execute("DELETE FROM Materials WHERE id = ?", (material_id,))
+        return material_id
+
+    data = change["data"]
+    if material_id is None:
+        # Same material created in both copies before they had uids in common
+        row = cursor.execute("SELECT id FROM Materials WHERE name = ?", (data["name"],)).fetchone()
+        if row:
+            material_id = row[0]
+            cursor.execute("UPDATE Materials SET uid = ? WHERE id = ?", (uid, material_id))
+
+    name = data["name"]
+    taken = cursor.execute("SELECT 1 FROM Materials WHERE name = ? AND uid != ?", (name, uid)).fetchone()
+    if taken:
+        name = database.generate_unique_name(name, cursor)
+        notes.append(f"material {data['name']!r} renamed to {name!r}: the name is taken here")
+    identifier = data["identifier"]
+    if identifier and cursor.execute(
+        "SELECT 1 FROM Materials WHERE identifier = ? AND uid != ?", (identifier, uid)
+    ).fetchone():
+        identifier = database.generate_unique_identifier(identifier, cursor)
+
+    if material_id is None:
+        cursor.execute(
+            "INSERT INTO Materials (uid, name, identifier, description, price) VALUES (?, ?, ?, ?, ?)",
+            (uid, name, identifier, data["description"], data["price"])
+        )
+        return cursor.lastrowid
+    cursor.execute(
+        "UPDATE Materials SET name = ?, identifier = ?, description = ?, price = ? WHERE id = ?",
+        (name, identifier, data["description"], data["price"], material_id)
+    )
+    return material_id
+
+
+def _resolve_lines(cursor, change, notes):
+    """[(local ingredient id, quantity)], or DEFERRED if an ingredient is unknown here."""
+    lines = change["data"]["lines"]
+    cursor.execute(
+        "SELECT uid, id FROM Materials WHERE uid IN (SELECT value FROM json_each(?))",
+        (json.dumps([uid for uid, _ in lines]),)
+    )
+    ids = dict(cursor.fetchall())
+    missing = [uid for uid, _ in lines if uid not in ids]
+    if missing:
+        notes.append(f"{change['entity']} {_describe(change)} deferred: unknown ingredients {missing}")
+        return DEFERRED
+    return [(ids[uid], qty) for uid, qty in lines]
+
+
+def _apply_formula(cursor, change, notes):
+    """Returns the product id, or DEFERRED if it or an ingredient is unknown here."""
+    product_id = _material_id(cursor, change["uid"])
+    if product_id is None:
+        notes.append(f"formula {_describe(change)} deferred: unknown product")
+        return DEFERRED
+    lines = _resolve_lines(cursor, change, notes)
+    if lines is DEFERRED:
+        return DEFERRED
+    version = cursor.execute(
+        "SELECT COALESCE(MAX(row_version), 0) + 1 FROM Formulas WHERE product_id = ?", (product_id,)
+    ).fetchone()[0]
+    cursor.execute("DELETE FROM Formulas WHERE product_id = ?", (product_id,))
+    cursor.executemany(
+        "INSERT INTO Formulas (product_id, ingredient_id, quantity, row_version) VALUES (?, ?, ?, ?)",
+        [(product_id, ing_id, qty, version) for ing_id, qty in lines]
+    )
+    if not lines:
+        cursor.execute("UPDATE Materials SET price = 0.0 WHERE id = ?", (product_id,))
+    return product_id
+
+
+def _apply_order(cursor, change, notes):
+    """
+    Orders are only ever added; one whose number is taken here gets the next free one.
+    Their consumption arrives as separate movement changes.
+    Returns the product id, None if the order is already here, or DEFERRED if its
+    product or an ingredient is unknown here.
+    """
+    if cursor.execute("SELECT 1 FROM manufacturing_orders WHERE uid = ?", (change["uid"],)).fetchone():
+        return None
+    data = change["data"]
+    product_id = _material_id(cursor, data["product"])
+    if product_id is None:
+        notes.append(f"order {_describe(change)} deferred: unknown product")
+        return DEFERRED
+    lines = _resolve_lines(cursor, change, notes)
+    if lines is DEFERRED:
+        return DEFERRED
+
+    order_id = data["order_id"]
+    if cursor.execute("SELECT 1 FROM manufacturing_orders WHERE order_id = ?", (order_id,)).fetchone():
+        order_id = None
+    units = data["units"]
+    version_id = None
+    if units:
+        per_unit = [(ing_id, round(qty / units, database.FORMULA_VERSION_DECIMALS)) for ing_id, qty in lines]
+        if all(abs(pu * units - qty) <= 1e-6 for (_, pu), (_, qty) in zip(per_unit, lines)):
+            version_id = database._store_formula_version(cursor, product_id, per_unit)
+
+    cursor.execute("""
+        INSERT INTO manufacturing_orders
+        (order_id, uid, product_id, units, date, notes, client_name, proforma_number, formula_version_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (order_id, change["uid"], product_id, units, data["date"], data["notes"],
+          data["client_name"], data["proforma_number"], version_id))
+    new_id = cursor.lastrowid
+    if order_id is None:
+        notes.append(f"order {data['order_id']} imported as {new_id}: the number is taken here")
+    if version_id is None:
+        cursor.executemany(
+            "INSERT INTO order_ingredients (order_id, ingredient_id, quantity) VALUES (?, ?, ?)",
+            [(new_id, ing_id, qty) for ing_id, qty in lines]
+        )
+    return product_id
+
+
+def _apply_movement(cursor, change, notes):
+    """
+    Stock movements are append-only and only ever added, under their uid.
+    Returns the material id, None if the movement is already here, or DEFERRED
+    if its material or order is unknown here.
+    """
+    if cursor.execute("SELECT 1 FROM inventory_movements WHERE uid = ?", (change["uid"],)).fetchone():
+        return None
+    data = change["data"]
+    material_id = _material_id(cursor, data["material"])
+    if material_id is None:
+        notes.append(f"stock movement {change['uid']} deferred: unknown material")
+        return DEFERRED
+    order_id = None
+    if data["order"]:
+        row = cursor.execute("SELECT order_id FROM manufacturing_orders WHERE uid = ?", (data["order"],)).fetchone()
+        if row is None:
+            notes.append(f"stock movement {change['uid']} deferred: unknown order")
+            return DEFERRED
+        order_id = row[0]
+    cursor.execute("""
+        INSERT INTO inventory_movements (uid, material_id, kind, quantity, date, order_id, notes)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (change["uid"], material_id, data["kind"], data["quantity"], data["date"], order_id, data["notes"]))
+    return material_id
+
+
+APPLY = {
+    "material": _apply_material, "formula": _apply_formula, "order": _apply_order,
+    "movement": _apply_movement,
+}
+
+
+# ------------------------
+# --- Fork ---------------
+# ------------------------
+def fork():
+    """
+    Give a copied database its own origin, so its changes are told apart from
+    those of the database it was copied from. Run it on the copy right after
+    copying. Returns the new origin id.
+    """
+    database.create_tables()
+    with database.transaction():
+        conn, cursor = database.connect()
+        old = _origin_id(cursor)
+        max_seq = cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_journal").fetchone()[0]
+        # Everything journaled so far happened in the original and is already there
+        cursor.execute("UPDATE change_journal SET origin = ?, origin_seq = seq WHERE origin IS NULL", (old,))
+        cursor.execute(
+            "INSERT OR REPLACE INTO sync_state (origin, last_seq, local_seq) VALUES (?, ?, ?)",
+            (old, max_seq, max_seq)
+        )
+        cursor.execute("UPDATE meta SET value = ? WHERE key LIKE 'sync_exported:%'", (max_seq,))
+        cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('sync_exported:default', ?)", (max_seq,))
+        cursor.execute("UPDATE meta SET value = lower(hex(randomblob(16))) WHERE key = 'origin_id'")
+        return _origin_id(cursor)
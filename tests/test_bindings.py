@@ -0,0 +1,94 @@
+import tkinter as tk
+import unittest
+from ui.bindings import ListboxBinding, TreeviewBinding
+
+
+class FakeTree:
+    """The few ttk.Treeview calls TreeviewBinding makes, without a display."""
+
+    def __init__(self):
+        self.items = []
+
+    def insert(self, parent, index, iid, values):
+        self.items.insert(index, iid)
+
+    def delete(self, *iids):
+        self.items = [iid for iid in self.items if iid not in iids]
+
+    def item(self, iid, values):
+        pass
+
+    def move(self, iid, parent, index):
+        self.items.remove(iid)
+        self.items.insert(index, iid)
+
+
+class TreeviewBindingTest(unittest.TestCase):
+
+    def test_repeated_keys_map_back_to_their_row(self):
+        tree = FakeTree()
+        binding = TreeviewBinding(tree)
+        binding.update([(5, ("Resina", "1")), (7, ("Masilla", "2")), (5, ("Resina", "3"))])
+
+        self.assertEqual(tree.items, ["5", "7", "5#2"])
+        self.assertEqual([binding.index(iid) for iid in tree.items], [0, 1, 2])
+
+    def test_update_only_touches_changed_rows(self):
+        tree = FakeTree()
+        binding = TreeviewBinding(tree)
+        binding.update([(1, ("a",)), (2, ("b",)), (3, ("c",))])
+        binding.update([(3, ("c",)), (1, ("a",))])
+
+        self.assertEqual(tree.items, ["3", "1"])
+        self.assertEqual(binding.index("1"), 1)
+
+
+class FakeListbox:
+    """tk.Listbox calls made by ListboxBinding, on a plain list."""
+
+    def __init__(self):
+        self.items = []
+        self.selected = set()
+        self.top = 0
+
+    def insert(self, index, *texts):
+        index = len(self.items) if index == tk.END else index
+        self.items[index:index] = texts
+
+    def delete(self, first, last=None):
+        last = len(self.items) - 1 if last == tk.END else first if last is None else last
+        del self.items[first:last + 1]
+
+    def curselection(self):
+        return tuple(sorted(self.selected))
+
+    def selection_clear(self, first, last):
+        self.selected.clear()
+
+    def selection_set(self, index):
+        self.selected.add(index)
+
+    def nearest(self, y):
+        return self.top
+
+    def yview(self, index):
+        self.top = index
+
+
+class ListboxBindingTest(unittest.TestCase):
+
+    def test_selection_and_scroll_follow_their_keys(self):
+        listbox = FakeListbox()
+        binding = ListboxBinding(listbox)
+        binding.update([(1, "Base"), (2, "Masilla"), (3, "Resina")])
+        listbox.selected = {2}
+        listbox.top = 1
+
+        binding.update([(0, "Aceite"), (2, "Masilla 2"), (3, "Resina")])
+        self.assertEqual(listbox.items, ["Aceite", "Masilla 2", "Resina"])
+        self.assertEqual(listbox.curselection(), (2,))
+        self.assertEqual((listbox.top, binding.key_at(1)), (1, "2"))
+
+
+if __name__ == "__main__":
+    unittest.main()
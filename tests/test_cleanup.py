@@ -0,0 +1,52 @@
+import io
+import unittest
+import cleanup
+import database
+from test_database import DatabaseTestCase
+
+
+class OrphanMovementsTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resin = self.add("Resina", price=2.0)
+        self.paint = self.add("Pintura")
+        database.update_formula(self.paint, [(self.resin, 3.0)])
+        database.record_receipt(self.resin, 100)
+
+    def execute(self, sql, params=()):
+        conn, cursor = database.connect()
+        cursor.execute(sql, params)
+        conn.commit()
+        conn.close()
+
+    def run_cleanup(self):
+        return cleanup.run(apply=True, out=io.StringIO())
+
+    def test_movements_of_a_deleted_order_are_reversed(self):
+        order_id = database.create_order(self.paint, 10)
+        self.assertEqual(database.get_stock(self.resin), 70)
+        # The product goes, so cleanup deletes the order in the same run
+        self.execute("DELETE FROM Formulas WHERE product_id = ?", (self.paint,))
+        self.execute("DELETE FROM Materials WHERE id = ?", (self.paint,))
+
+        self.assertEqual(self.run_cleanup(), 2)
+        self.assertEqual(database.get_stock(self.resin), 100)
+        conn, cursor = database.connect()
+        kinds = [r[0] for r in cursor.execute(
+            "SELECT kind FROM inventory_movements WHERE order_id = ? ORDER BY id", (order_id,))]
+        conn.close()
+        self.assertEqual(kinds, ["consumption", "adjustment"])
+        self.assertEqual(self.run_cleanup(), 0)
+
+    def test_movements_of_archived_orders_are_kept(self):
+        order_id = database.create_order(self.paint, 10)
+        self.execute("UPDATE manufacturing_orders SET date = '2019-05-01 10:00:00' WHERE order_id = ?", (order_id,))
+        database.archive_orders("2020-01-01")
+
+        self.assertEqual(self.run_cleanup(), 0)
+        self.assertEqual(database.get_stock(self.resin), 70)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,477 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+import database
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Each test works on a new database file in a temporary folder."""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.saved_db_name = database.DB_NAME
+        database.DB_NAME = os.path.join(self.folder.name, "materials.db")
+        database.create_tables()
+
+    def tearDown(self):
+        database.unbind_connection()
+        database.DB_NAME = self.saved_db_name
+        self.folder.cleanup()
+
+    def add(self, name, price=0.0):
+        database.add_material(name, price=price)
+        return database.get_material_by_name(name).id
+
+
+class RowVersionTest(DatabaseTestCase):
+
+    def test_saving_formula_then_editing_product_is_not_a_conflict(self):
+        resin = self.add("Resina", price=2.0)
+        product = self.add("Pintura")
+        version = database.get_material_by_id(product).row_version
+
+        # Same station: the save reprices the product, which is not a user edit
+        database.update_formula(product, [(resin, 3.0)])
+        self.assertEqual(database.get_material_by_id(product).price, 6.0)
+        self.assertTrue(database.update_material(product, description="Gris", expected_version=version))
+
+    def test_raw_material_price_change_does_not_bump_upstream_products(self):
+        resin = self.add("Resina", price=2.0)
+        product = self.add("Pintura")
+        database.update_formula(product, [(resin, 3.0)])
+        version = database.get_material_by_id(product).row_version
+
+        database.update_material(resin, price=2.5)
+        self.assertEqual(database.get_material_by_id(product).row_version, version)
+
+    def test_edit_by_another_station_is_a_conflict(self):
+        resin = self.add("Resina", price=2.0)
+        version = database.get_material_by_id(resin).row_version
+
+        database.update_material(resin, price=2.5)
+        with self.assertRaises(database.ConcurrentModificationError):
+            database.update_material(resin, description="Otra", expected_version=version)
+
+    def test_formula_saved_by_another_station_is_a_conflict(self):
+        resin = self.add("Resina", price=2.0)
+        product = self.add("Pintura")
+        database.update_formula(product, [(resin, 3.0)])
+        version = database.get_formula_version(product)
+
+        database.update_formula(product, [(resin, 4.0)], expected_version=version)
+        with self.assertRaises(database.ConcurrentModificationError):
+            database.update_formula(product, [(resin, 5.0)], expected_version=version)
+        self.assertEqual([line.quantity for line in database.get_formulas(product)], [4.0])
+
+
+class CloneProductTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resin = self.add("Resina", price=2.0)
+        self.base = self.add("Base")
+        self.paint = self.add("Pintura")
+        database.update_formula(self.base, [(self.resin, 2.0)])
+        database.update_formula(self.paint, [(self.base, 0.5), (self.resin, 1.0)])
+
+    def lines(self, product_id):
+        return [(line.name, line.quantity) for line in database.get_formulas(product_id)]
+
+    def test_clone_copies_the_formula_and_shares_the_intermediates(self):
+        clone = database.clone_product(self.paint)
+        self.assertEqual(database.get_material_by_id(clone).name, "Pintura - Copia")
+        self.assertEqual(self.lines(clone), self.lines(self.paint))
+        self.assertEqual(database.get_material_by_id(clone).price, database.get_material_by_id(self.paint).price)
+
+    def test_deep_clone_points_to_cloned_intermediates(self):
+        clone = database.clone_product(self.paint, deep=True)
+        self.assertEqual(sorted(self.lines(clone)), [("Base - Copia", 0.5), ("Resina", 1.0)])
+        base_copy = database.get_material_by_name("Base - Copia").id
+        self.assertEqual(self.lines(base_copy), [("Resina", 2.0)])
+        # The originals are untouched
+        self.assertEqual(sorted(self.lines(self.paint)), [("Base", 0.5), ("Resina", 1.0)])
+
+    def test_missing_product_clones_nothing(self):
+        count = len(database.get_materials())
+        self.assertIsNone(database.clone_product(999, deep=True))
+        self.assertEqual(len(database.get_materials()), count)
+
+
+class OrderDateTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.order_id = database.create_order(self.add("Pintura"), 10)
+
+    def set_date(self, value):
+        conn, cursor = database.connect()
+        try:
+            cursor.execute("UPDATE manufacturing_orders SET date = ? WHERE order_id = ?", (value, self.order_id))
+            conn.commit()
+        finally:
+            conn.close()
+        return database.get_order(self.order_id).date
+
+    def test_dates_are_stored_in_canonical_form(self):
+        self.assertEqual(self.set_date("2024-03-05T08:09:10"), "2024-03-05 08:09:10")
+        self.assertEqual(self.set_date("2024-03-05"), "2024-03-05 00:00:00")
+
+    def test_invalid_dates_are_rejected(self):
+        for value in ("05/03/2024", "2024-13-01", "mañana"):
+            with self.subTest(value=value), self.assertRaises(sqlite3.IntegrityError):
+                self.set_date(value)
+        self.assertRegex(database.get_order(self.order_id).date, r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$")
+
+    def test_legacy_formats_are_normalized(self):
+        self.assertEqual(database.normalize_timestamp("2024-03-05T08:09:10.123456"), "2024-03-05 08:09:10")
+        self.assertIsNone(database.normalize_timestamp("no es una fecha"))
+
+
+class PriceSimulationTest(DatabaseTestCase):
+
+    def test_simulation_reports_upstream_prices_and_changes_nothing(self):
+        resin = self.add("Resina", price=2.0)
+        base = self.add("Base")
+        paint = self.add("Pintura")
+        database.update_formula(base, [(resin, 2.0)])
+        database.update_formula(paint, [(base, 0.5), (resin, 1.0)])
+
+        rows = database.simulate_price_changes({resin: 3.0})
+        self.assertEqual([(r.name, r.old_price, r.new_price, r.delta) for r in rows],
+                         [("Base", 4.0, 6.0, 2.0), ("Pintura", 4.0, 6.0, 2.0)])
+        self.assertEqual([database.get_material_by_id(i).price for i in (resin, base, paint)], [2.0, 4.0, 4.0])
+
+
+class StockLedgerTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resin = self.add("Resina", price=2.0)
+        self.paint = self.add("Pintura")
+        database.update_formula(self.paint, [(self.resin, 3.0)])
+
+    def at(self, timestamp, func, *args, **kwargs):
+        """Run a write as if it happened at timestamp (the clock journaled calls use)."""
+        database._thread_state.clock = timestamp
+        try:
+            return func(*args, **kwargs)
+        finally:
+            database._thread_state.clock = None
+
+    def test_balances_follow_receipts_consumption_and_counts(self):
+        database.record_receipt(self.resin, 100)
+        database.create_order(self.paint, 10)
+        self.assertEqual(database.get_stock(self.resin), 70)
+        self.assertIsNone(database.record_adjustment(self.resin, 70))
+        database.record_adjustment(self.resin, 65, notes="recuento")
+        self.assertEqual(database.get_stock(), {self.resin: 65})
+        self.assertEqual(database.get_stock(self.paint), 0.0)
+
+    def test_stock_as_of_a_past_date(self):
+        self.at("2024-01-10 09:00:00", database.record_receipt, self.resin, 100)
+        self.at("2024-01-20 09:00:00", database.record_adjustment, self.resin, 80)
+        self.at("2024-01-31 23:00:00", database.checkpoint_stock)
+        self.at("2024-02-05 09:00:00", database.record_receipt, self.resin, 50)
+
+        self.assertEqual(database.get_stock_as_of(self.resin, "2024-01-09"), 0)
+        self.assertEqual(database.get_stock_as_of(self.resin, "2024-01-15"), 100)
+        self.assertEqual(database.get_stock_as_of(self.resin, "2024-01-31"), 80)
+        self.assertEqual(database.get_stock_as_of(self.resin, "2024-02-10"), 130)
+        self.assertEqual(database.get_stock(self.resin), 130)
+
+    def test_movements_are_append_only(self):
+        database.record_receipt(self.resin, 100)
+        conn, cursor = database.connect()
+        try:
+            for sql in ("UPDATE inventory_movements SET quantity = 1", "DELETE FROM inventory_movements"):
+                with self.subTest(sql=sql), self.assertRaises(sqlite3.IntegrityError):
+                    cursor.execute(sql)
+        finally:
+            conn.close()
+        self.assertEqual(database.get_stock(self.resin), 100)
+
+
+class LazyPriceTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.saved_mode, database.PRICE_MODE = database.PRICE_MODE, "lazy"
+        self.resin = self.add("Resina", price=2.0)
+        self.base = self.add("Base")
+        self.paint = self.add("Pintura")
+        database.update_formula(self.base, [(self.resin, 2.0)])
+        database.update_formula(self.paint, [(self.base, 0.5)])
+        database.refresh_dirty_prices()
+
+    def tearDown(self):
+        database.PRICE_MODE = self.saved_mode
+        super().tearDown()
+
+    def stored(self):
+        """Price and flag as stored, without the refresh readers do."""
+        conn, cursor = database.connect()
+        rows = cursor.execute("SELECT price, price_dirty FROM Materials WHERE id IN (?, ?) ORDER BY id",
+                              (self.base, self.paint)).fetchall()
+        conn.close()
+        return [tuple(r) for r in rows]
+
+    def test_price_change_only_flags_the_products(self):
+        database.update_material(self.resin, price=3.0)
+        self.assertEqual(self.stored(), [(4.0, 1), (2.0, 1)])
+
+        self.assertEqual(database.refresh_dirty_prices(), 2)
+        self.assertEqual(self.stored(), [(6.0, 0), (3.0, 0)])
+        self.assertEqual(database.refresh_dirty_prices(), 0)
+
+    def test_reader_sees_the_refreshed_price(self):
+        database.update_material(self.resin, price=3.0)
+        self.assertEqual(database.get_material_by_id(self.paint).price, 3.0)
+        self.assertEqual(self.stored(), [(6.0, 0), (3.0, 0)])
+
+
+class TransactionTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resin = self.add("Resina", price=2.0)
+        self.paint = self.add("Pintura")
+
+    def test_failed_call_only_undoes_its_own_savepoint(self):
+        version = database.get_material_by_id(self.resin).row_version
+        with database.transaction():
+            database.update_material(self.resin, description="Epoxi")
+            self.assertFalse(database.update_material(self.paint, name="Resina", description="x"))
+            with self.assertRaises(database.ConcurrentModificationError):
+                database.update_material(self.resin, price=9.0, expected_version=version)
+            database.update_formula(self.paint, [(self.resin, 3.0)])
+
+        resin, paint = database.get_material_by_id(self.resin), database.get_material_by_id(self.paint)
+        self.assertEqual((resin.description, resin.price), ("Epoxi", 2.0))
+        self.assertEqual((paint.name, paint.description, paint.price), ("Pintura", "", 6.0))
+
+    def test_block_that_raises_is_rolled_back_as_a_whole(self):
+        with self.assertRaises(RuntimeError), database.transaction():
+            database.update_material(self.resin, price=5.0)
+            database.update_formula(self.paint, [(self.resin, 3.0)])
+            raise RuntimeError
+
+        self.assertEqual(database.get_material_by_id(self.resin).price, 2.0)
+        self.assertEqual(database.get_formulas(self.paint), [])
+
+
+class FormulaFlagsTest(DatabaseTestCase):
+
+    def flags(self, *ids):
+        return [(m.has_formula, m.ingredient_count, m.level)
+                for m in map(database.get_material_by_id, ids)]
+
+    def test_flags_follow_formula_inserts_and_deletes(self):
+        resin = self.add("Resina", price=2.0)
+        base = self.add("Base")
+        paint = self.add("Pintura")
+        database.update_formula(base, [(resin, 2.0)])
+        database.update_formula(paint, [(base, 0.5), (resin, 1.0)])
+        self.assertEqual(self.flags(resin, base, paint), [(0, 0, 0), (1, 1, 1), (1, 2, 2)])
+
+        # Raising a deep ingredient raises every product above it
+        primer = self.add("Imprimación")
+        database.update_formula(primer, [(resin, 1.0)])
+        database.update_formula(base, [(primer, 2.0)])
+        self.assertEqual(self.flags(primer, base, paint), [(1, 1, 1), (1, 1, 2), (1, 2, 3)])
+
+        database.delete_formula(base)
+        self.assertEqual(self.flags(base, paint), [(0, 0, 0), (1, 2, 1)])
+
+
+class KioskTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resin = self.add("Resina", price=2.0)
+        self.saved_read_only, database.READ_ONLY = database.READ_ONLY, True
+
+    def tearDown(self):
+        database.READ_ONLY = self.saved_read_only
+        super().tearDown()
+
+    def test_kiosk_reads_but_cannot_write(self):
+        self.assertEqual(database.get_material_by_id(self.resin).price, 2.0)
+        with self.assertRaises(sqlite3.OperationalError):
+            database.update_material(self.resin, price=3.0)
+        database.add_material("Pintura")  # reports the error itself
+        self.assertIsNone(database.get_material_by_name("Pintura"))
+
+        database.READ_ONLY = False
+        self.assertEqual(database.get_material_by_id(self.resin).price, 2.0)
+
+    def test_read_only_connection_rejects_raw_writes(self):
+        conn = database.open_connection(read_only=True)
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("UPDATE Materials SET price = 3.0")
+        finally:
+            conn.close()
+
+
+class RecordsTest(DatabaseTestCase):
+
+    def test_readers_return_named_records(self):
+        resin = self.add("Resina", price=2.0)
+        product = self.add("Pintura")
+        database.update_formula(product, [(resin, 3.0)])
+        order_id = database.create_order(product, 10)
+
+        self.assertIsInstance(database.get_material_by_name("Resina"), database.Material)
+        self.assertEqual(database.where_used(resin)[0].quantity, 3.0)
+        self.assertEqual(database.get_order_info(order_id).units, 10)
+        self.assertEqual(database.get_order_details(order_id).ingredients[0].quantity, 30.0)
+        self.assertIsNone(database.get_order_details(order_id + 1))
+
+
+class WhereUsedTest(DatabaseTestCase):
+
+    def test_max_depth_limits_the_levels(self):
+        resin = self.add("Resina", price=2.0)
+        base = self.add("Base")
+        paint = self.add("Pintura")
+        database.update_formula(base, [(resin, 2.0)])
+        database.update_formula(paint, [(base, 0.5)])
+
+        self.assertEqual([(r.name, r.depth, r.quantity) for r in database.where_used(resin)],
+                         [("Base", 1, 2.0), ("Pintura", 2, 1.0)])
+        self.assertEqual([r.name for r in database.where_used(resin, max_depth=1)], ["Base"])
+        self.assertEqual(database.where_used(resin, max_depth=0), [])
+
+
+class LockWaitTest(DatabaseTestCase):
+
+    def test_time_blocked_in_busy_timeout_is_counted(self):
+        resin = self.add("Resina", price=2.0)
+        other = sqlite3.connect(database.DB_NAME, check_same_thread=False)
+        other.execute("BEGIN IMMEDIATE")
+        timer = threading.Timer(0.3, other.commit)
+        timer.start()
+        before = database.lock_stats["lock_wait_seconds"]
+        try:
+            database.update_material(resin, price=2.5)
+        finally:
+            timer.join()
+            other.close()
+        self.assertGreaterEqual(database.lock_stats["lock_wait_seconds"] - before, 0.2)
+        self.assertEqual(database.get_material_by_id(resin).price, 2.5)
+
+
+class ExportTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        resin = self.add("Resina", price=2.0)
+        self.product = self.add("Pintura")
+        database.update_formula(self.product, [(resin, 3.0)])
+        self.path = os.path.join(self.folder.name, "orders.csv")
+
+    def read(self):
+        with open(self.path, encoding="utf-8-sig") as f:
+            return f.read()
+
+    def test_resume_after_cut_in_header_rewrites_the_file(self):
+        database.create_order(self.product, 10)
+        database.export_orders(self.path)
+        complete = self.read()
+
+        with open(self.path, "w", encoding="utf-8-sig", newline="") as f:
+            f.write(",".join(database.EXPORT_COLUMNS)[:20])
+        database.export_orders(self.path, resume=True)
+        self.assertEqual(self.read(), complete)
+
+    def test_resume_continues_a_cut_order(self):
+        for units in (10, 20, 30):
+            database.create_order(self.product, units)
+        database.export_orders(self.path)
+        complete = self.read()
+
+        with open(self.path, "r+b") as f:
+            f.truncate(len(complete.encode("utf-8")) - 5)
+        database.export_orders(self.path, resume=True)
+        self.assertEqual(self.read(), complete)
+
+
+class ArchiveTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        product = self.add("Pintura")
+        self.old = database.create_order(product, 10)
+        self.new = database.create_order(product, 20)
+        conn, cursor = database.connect()
+        cursor.execute("UPDATE manufacturing_orders SET date = '2019-05-01 10:00:00' WHERE order_id = ?", (self.old,))
+        conn.commit()
+        conn.close()
+        database.archive_orders("2020-01-01")
+
+    def ids(self, orders):
+        return [o.order_id for o in orders]
+
+    def test_archives_are_read_only_when_the_range_reaches_back(self):
+        self.assertEqual(self.ids(database.get_orders()), [self.new])
+        self.assertEqual(self.ids(database.get_orders("2020-01-01")), [self.new])
+        self.assertEqual(self.ids(database.get_orders("2019-01-01")), [self.new, self.old])
+
+    def test_order_by_id_is_found_in_the_archive(self):
+        self.assertEqual(database.get_order_info(self.old).units, 10)
+
+
+class InMemoryTest(DatabaseTestCase):
+
+    def tearDown(self):
+        database._memory = None
+        super().tearDown()
+
+    def crash(self):
+        """Drop the RAM copy without flushing, as if the process had died."""
+        database._memory.anchor.close()
+        database._memory.disk.close()
+        database._memory = None
+
+    def orders_on_disk(self):
+        database._memory, memory = None, database._memory
+        try:
+            return [(o.order_id, o.client_name, o.date) for o in database.get_orders()]
+        finally:
+            database._memory = memory
+
+    def test_confirmed_writes_survive_a_crash(self):
+        resin = self.add("Resina", price=2.0)
+        product = self.add("Pintura")
+        database.update_formula(product, [(resin, 3.0)])
+        database.load_into_memory()
+        order_id = database.create_order(product, 50, client_name="Cliente")
+        database.record_receipt(resin, 100)
+        created = [(o.order_id, o.client_name, o.date) for o in database.get_orders()]
+        self.crash()
+        self.assertEqual(self.orders_on_disk(), [])
+
+        database.load_into_memory()
+        self.assertEqual(self.orders_on_disk(), created)
+        self.assertEqual(database.get_stock(resin), 100 - 150)
+        self.assertEqual(created[0][0], order_id)
+
+    def test_flushed_work_is_not_replayed(self):
+        product = self.add("Pintura")
+        database.load_into_memory()
+        database.create_order(product, 10)
+        journal = open(database._memory.journal_path).read()
+        database.flush_to_disk()
+        self.crash()
+        # A flush that died after writing the file but before clearing the journal
+        with open(database.DB_NAME + database.REDO_JOURNAL_SUFFIX, "w") as f:
+            f.write(journal)
+
+        database.load_into_memory()
+        self.assertEqual(len(database.get_orders()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
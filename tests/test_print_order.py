@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import database
+from test_database import DatabaseTestCase
+from ui import print_order
+from ui.pdf_cache import PdfCache
+
+
+class FormatDateTest(unittest.TestCase):
+
+    def test_stored_timestamps_are_shown_day_first(self):
+        self.assertEqual(print_order.format_date("2024-03-05 08:09:10"), "05-03-2024")
+        self.assertEqual(print_order.format_date(None), "")
+        self.assertEqual(print_order.format_date("ayer"), "ayer")
+
+
+class PrintOrdersTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        resin = self.add("Resina", price=2.0)
+        self.paint = self.add("Pintura")
+        database.update_formula(self.paint, [(resin, 3.0)])
+        # Temp files of the test land in its own folder
+        self.tmp = os.path.join(self.folder.name, "tmp")
+        os.mkdir(self.tmp)
+        patcher = mock.patch.object(tempfile, "tempdir", self.tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_missing_orders_leave_no_temp_file(self):
+        self.assertEqual(print_order.print_orders([999]), [])
+        self.assertEqual(print_order.print_orders([999], one_file_per_order=True), [])
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_order_is_rendered_to_a_temp_pdf(self):
+        order_id = database.create_order(self.paint, 10)
+        paths = print_order.print_orders([order_id])
+        self.assertEqual(len(paths), 1)
+        with open(paths[0], "rb") as f:
+            self.assertTrue(f.read().startswith(b"%PDF"))
+
+    def test_many_orders_are_rendered_in_worker_processes(self):
+        order_ids = [database.create_order(self.paint, units) for units in (10, 20, 30)]
+        progress = []
+        folder = os.path.join(self.folder.name, "out")
+        with mock.patch.object(print_order, "CHUNK_SIZE", 1):
+            paths = print_order.print_orders(order_ids, folder, one_file_per_order=True,
+                                             progress=lambda done, total: progress.append((done, total)),
+                                             max_workers=2)
+        self.assertEqual(sorted(os.path.basename(p) for p in paths),
+                         sorted(f"orden_{order_id}.pdf" for order_id in order_ids))
+        self.assertEqual(progress[-1], (3, 3))
+
+
+class PdfCacheTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        resin = self.add("Resina", price=2.0)
+        self.paint = self.add("Pintura")
+        database.update_formula(self.paint, [(resin, 3.0)])
+        self.order_id = database.create_order(self.paint, 10)
+        self.out = os.path.join(self.folder.name, "orden.pdf")
+
+    def renders(self):
+        """Sheets rendered by one print of the order."""
+        with mock.patch.object(print_order, "render_sheets", wraps=print_order.render_sheets) as render:
+            print_order.print_orders([self.order_id], self.out)
+        return render.call_count
+
+    def test_unchanged_order_is_served_from_the_cache(self):
+        self.assertEqual(self.renders(), 1)
+        self.assertEqual(self.renders(), 0)
+        with open(self.out, "rb") as f:
+            self.assertTrue(f.read().startswith(b"%PDF"))
+
+    def test_changed_content_is_rendered_again(self):
+        self.renders()
+        database.update_material(self.paint, name="Pintura gris")
+        self.assertEqual(self.renders(), 1)
+
+    def test_least_recently_used_files_are_evicted(self):
+        cache = PdfCache(os.path.join(self.folder.name, "cache"), max_bytes=5)
+        for n, content in enumerate((b"old--", b"newer")):
+            path = cache.path_for(cache.key(n))
+            with open(path, "wb") as f:
+                f.write(content)
+            os.utime(path, (n, n))
+        cache.evict()
+        self.assertIsNone(cache.get(cache.key(0)))
+        self.assertIsNotNone(cache.get(cache.key(1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
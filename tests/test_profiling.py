@@ -0,0 +1,46 @@
+import atexit
+import tkinter as tk
+import unittest
+from ui import profiling
+
+
+def user_action():
+    pass
+
+
+def poller():
+    pass
+
+
+user_action.__module__ = poller.__module__ = "ui.test"
+
+
+class ProfilingTest(unittest.TestCase):
+    """A Tcl interpreter is enough to register and run callbacks without a display."""
+
+    def setUp(self):
+        self.saved_profile = profiling.PROFILE
+        profiling.PROFILE = "time"
+        profiling.samples.clear()
+        profiling.install()
+        self.interp = tk.Tcl()
+
+    def tearDown(self):
+        tk.Misc._register = profiling._original_register
+        tk.Misc.after = profiling._original_after
+        atexit.unregister(profiling.write_report)
+        profiling.PROFILE = self.saved_profile
+        profiling.samples.clear()
+
+    def test_commands_are_measured_but_timers_are_not(self):
+        command = self.interp._register(user_action)  # what command=, bind and trace use
+        timer = self.interp.after(60000, poller)
+        self.interp.tk.call(command)
+        self.interp.tk.call(self.interp.tk.call("after", "info", timer)[0])
+        self.interp.tk.call("update")
+
+        self.assertEqual(list(profiling.samples), ["test.user_action"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+from search import TrigramIndex
+
+
+class TrigramIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = TrigramIndex([
+            (1, "Resina Epoxy"), (2, "Masilla poliester"), (3, "Resína epóxica"), (4, "Disolvente"),
+        ])
+
+    def keys(self, query, **kwargs):
+        return [key for key, _ in self.index.search(query, **kwargs)]
+
+    def test_substring_inside_a_word_is_found_and_ranked_first(self):
+        keys = self.keys("pox")
+        self.assertEqual(set(keys[:2]), {1, 3})
+        self.assertNotIn(4, keys)
+
+    def test_typos_and_accents(self):
+        self.assertEqual(self.keys("resina epoxi"), [3, 1])  # "resina epoxica" contains it
+        self.assertIn(4, self.keys("disovlente"))
+
+    def test_no_limit_returns_every_substring_match(self):
+        index = TrigramIndex((n, f"Pintura {n}") for n in range(120))
+        self.assertEqual(len(index.search("pint", limit=None)), 120)
+        self.assertEqual(len(index.search("pint")), 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
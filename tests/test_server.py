@@ -0,0 +1,103 @@
+import asyncio
+import http.client
+import json
+import threading
+import unittest
+import database
+import server
+from test_database import DatabaseTestCase
+
+
+class ServerTest(DatabaseTestCase):
+    """A real server on 127.0.0.1 (port chosen by the OS), driven over HTTP."""
+
+    def setUp(self):
+        super().setUp()
+        self.resin = self.add("Resina", price=2.0)
+        self.paint = self.add("Pintura")
+        database.update_formula(self.paint, [(self.resin, 3.0)])
+
+        self.server = server.Server(port=0)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result(5)
+        self.client = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=10)
+
+    def tearDown(self):
+        self.client.close()
+
+        async def stop():
+            self.server.close()  # on the loop thread, which opened the monitor connection
+            await self.server.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+        super().tearDown()
+
+    def request(self, method, path, body=None, headers=None):
+        payload = json.dumps(body).encode("utf-8") if body is not None else None
+        self.client.request(method, path, payload, headers or {})
+        response = self.client.getresponse()
+        raw = response.read()
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            raw = json.loads(raw)
+        return response.status, response, raw
+
+    def test_get_with_etag_answers_304_until_the_data_changes(self):
+        status, response, material = self.request("GET", f"/materials/{self.resin}")
+        self.assertEqual((status, material["name"]), (200, "Resina"))
+        etag = response.getheader("ETag")
+
+        status, _, _ = self.request("GET", f"/materials/{self.resin}", headers={"If-None-Match": etag})
+        self.assertEqual(status, 304)
+
+        self.request("PUT", f"/materials/{self.resin}", {"description": "Epoxi"})
+        status, _, material = self.request("GET", f"/materials/{self.resin}", headers={"If-None-Match": etag})
+        self.assertEqual((status, material["description"]), (200, "Epoxi"))
+
+    def test_put_with_a_stale_version_is_a_conflict(self):
+        _, _, material = self.request("GET", f"/materials/{self.resin}")
+        status, _, _ = self.request("PUT", f"/materials/{self.resin}",
+                                    {"price": 2.5, "expected_version": material["row_version"]})
+        self.assertEqual(status, 200)
+
+        status, _, _ = self.request("PUT", f"/materials/{self.resin}",
+                                    {"price": 3.0, "expected_version": material["row_version"]})
+        self.assertEqual(status, 409)
+        self.assertEqual(database.get_material_by_id(self.resin).price, 2.5)
+
+    def test_missing_ids_are_404(self):
+        for method, path, body in [
+            ("GET", "/materials/999", None),
+            ("PUT", "/materials/999", {"description": "x"}),
+            ("POST", "/materials/999/clone", {}),
+            ("GET", "/orders/999", None),
+            ("GET", "/orders/999/pdf", None),
+        ]:
+            with self.subTest(method=method, path=path):
+                self.assertEqual(self.request(method, path, body)[0], 404)
+
+    def test_batch_runs_every_request(self):
+        order_id = database.create_order(self.paint, 10)
+        status, _, results = self.request("POST", "/batch", {"requests": [
+            {"method": "GET", "path": f"/materials/{self.paint}"},
+            {"method": "GET", "path": f"/orders/{order_id}"},
+            {"method": "GET", "path": "/materials/999"},
+        ]})
+        self.assertEqual(status, 200)
+        self.assertEqual([r["status"] for r in results], [200, 200, 404])
+        self.assertEqual(results[1]["body"]["ingredients"][0]["quantity"], 30.0)
+
+    def test_order_pdf_is_served_but_not_cached(self):
+        order_id = database.create_order(self.paint, 10)
+        status, response, body = self.request("GET", f"/orders/{order_id}/pdf")
+        self.assertEqual((status, response.getheader("Content-Type")), (200, "application/pdf"))
+        self.assertTrue(body.startswith(b"%PDF"))
+        self.assertNotIn(f"/orders/{order_id}/pdf", self.server.cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
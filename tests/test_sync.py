@@ -0,0 +1,90 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import unittest
+import database
+import sync
+from test_database import DatabaseTestCase
+
+
+class ImportTest(DatabaseTestCase):
+
+    def write(self, name, origin, changes):
+        path = os.path.join(self.folder.name, name)
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump({"format": sync.FORMAT_VERSION, "origin": origin, "changes": changes}, f)
+        return path
+
+    def material(self, origin, seq, uid, name):
+        return {"entity": "material", "uid": uid, "op": "U", "origin": origin, "seq": seq,
+                "changed_at": "2026-01-01 10:00:00",
+                "data": {"name": name, "identifier": None, "description": "", "price": 2.0}}
+
+    def run_import(self, path):
+        return sync.import_changes(path, out=io.StringIO())
+
+    def test_change_with_unknown_ingredient_is_retried_by_a_later_import(self):
+        formula = {"entity": "formula", "uid": "paint", "op": "U", "origin": "A", "seq": 3,
+                   "changed_at": "2026-01-01 10:00:00", "data": {"lines": [["resin", 3.0]]}}
+        first = self.write("a.json.gz", "A", [self.material("A", 1, "paint", "Pintura"), formula])
+
+        report = self.run_import(first)
+        self.assertEqual((report["applied"], report["deferred"]), (1, 1))
+        self.assertEqual(database.get_formulas(database.get_material_by_name("Pintura").id), [])
+
+        # The ingredient arrives from another copy; the same file then applies cleanly
+        self.run_import(self.write("b.json.gz", "B", [self.material("B", 1, "resin", "Resina")]))
+        report = self.run_import(first)
+        self.assertEqual((report["applied"], report["deferred"]), (1, 0))
+        self.assertEqual(database.get_material_by_name("Pintura").price, 6.0)
+
+
+class RoundTripTest(DatabaseTestCase):
+    """An office database and a laptop copy of it, synced through export files."""
+
+    def setUp(self):
+        super().setUp()
+        self.office = database.DB_NAME
+        self.laptop = os.path.join(self.folder.name, "laptop.db")
+        self.resin = self.add("Resina", price=2.0)
+        self.paint = self.add("Pintura")
+        database.update_formula(self.paint, [(self.resin, 3.0)])
+        database.record_receipt(self.resin, 100)
+        shutil.copyfile(self.office, self.laptop)
+        self.use(self.laptop)
+        sync.fork()
+
+    def use(self, path):
+        database.unbind_connection()
+        database.DB_NAME = path
+
+    def move(self, source, target):
+        self.use(source)
+        path = os.path.join(self.folder.name, "changes.json.gz")
+        sync.export_changes(path)
+        self.use(target)
+        return sync.import_changes(path, out=io.StringIO())
+
+    def test_stock_movements_made_on_the_copy_reach_the_office(self):
+        order_id = database.create_order(self.paint, 10)
+        database.record_receipt(self.resin, 40, notes="albarán 12")
+        database.record_adjustment(self.resin, 125)
+
+        report = self.move(self.laptop, self.office)
+        self.assertEqual((report["applied"], report["deferred"]), (4, 0))
+        self.assertEqual(database.get_stock(self.resin), 125)
+        conn, cursor = database.connect()
+        kinds = [r[0] for r in cursor.execute(
+            "SELECT kind FROM inventory_movements WHERE order_id = ?", (order_id,))]
+        conn.close()
+        self.assertEqual(kinds, ["consumption"])
+
+        # Nothing comes back twice, in either direction
+        self.assertEqual(self.move(self.office, self.laptop)["applied"], 0)
+        self.assertEqual(database.get_stock(self.resin), 125)
+
+
+if __name__ == "__main__":
+    unittest.main()
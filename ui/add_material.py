@@ -2,7 +2,7 @@ import tkinter as tk
 from tkinter import messagebox, filedialog
 import database
 import os
-import shutil
+from .price_preview import PricePreviewDialog
 
 
 
@@ -11,6 +11,7 @@ class AddMaterialFrame(tk.LabelFrame):
         super().__init__(parent, text="Gestionar Materiales", padx=8, pady=8)
         self.controller = controller
         self.selected_material_id = None
+        self.selected_material_version = None
 
         # --- Variables ---
         self.name_var = tk.StringVar()
@@ -38,6 +39,9 @@ class AddMaterialFrame(tk.LabelFrame):
         self.price_entry = tk.Entry(self, width=12, textvariable=self.price_var)
         self.price_entry.grid(row=3, column=1, sticky="w")
 
+        controller.subscribe(database.MaterialUpdated, self.on_material_changed)
+        controller.subscribe(database.PricesChanged, self.on_prices_changed)
+
         # --- Add/Update/Clone Buttons ---
         tk.Button(self, text="Añadir Material", command=self.add_material_only, width=15).grid(
             row=0, column=3, rowspan=2, padx=10, pady=2
@@ -48,6 +52,9 @@ class AddMaterialFrame(tk.LabelFrame):
         tk.Button(self, text="Clonar Material", command=self.clone_material, width=15).grid(
             row=4, column=3, rowspan=2, padx=10, pady=2
         )
+        tk.Button(self, text="Simular precio", command=self.simulate_price, width=15).grid(
+            row=4, column=1, sticky="w", pady=2
+        )
 
         # --- Backup/Restore Buttons on far right ---
         tk.Button(self, text="Guardar BD", width=15, command=self.backup_database).grid(
@@ -70,12 +77,27 @@ class AddMaterialFrame(tk.LabelFrame):
         if not material:
             return
         self.selected_material_id = material_id
-        self.name_var.set(material["name"])
-        self.desc_var.set(material["description"] or "")
-        self.identifier_var.set(material["identifier"] or "")
-        price = material["price"] or 0.0
+        self.selected_material_version = material.row_version
+        self.name_var.set(material.name)
+        self.desc_var.set(material.description or "")
+        self.identifier_var.set(material.identifier or "")
+        price = material.price or 0.0
         self.price_var.set(f"{price:.2f}")
 
+    def on_material_changed(self, event):
+        if event.material_id == self.selected_material_id:
+            self.refresh_version()
+
+    def on_prices_changed(self, event):
+        if self.selected_material_id in event.material_ids:
+            self.refresh_version()
+
+    def refresh_version(self):
+        """A change saved from this station is not a conflict: take its row_version, keep what is typed."""
+        material = database.get_material_by_id(self.selected_material_id)
+        if material:
+            self.selected_material_version = material.row_version
+
     def add_material_only(self):
         name = self.name_var.get().strip()
         desc = self.desc_var.get().strip()
@@ -86,13 +108,13 @@ class AddMaterialFrame(tk.LabelFrame):
             messagebox.showerror("Error", "Precio debe ser un numero")
             return
 
-        ok = database.add_material(name, description=desc, identifier=identifier, price=price)
+        with database.transaction():
+            ok = database.add_material(name, description=desc, identifier=identifier, price=price)
         if not ok:
             messagebox.showerror("Error", "Nombre o identificador ya existe")
             return
         messagebox.showinfo("Added", f"Material '{name}' añadido correctamente")
         self.selected_material_id = None
-        self.controller.refresh_all_lists()
 
     def update_material_only(self):
         if not self.selected_material_id:
@@ -108,19 +130,56 @@ class AddMaterialFrame(tk.LabelFrame):
             messagebox.showerror("Error", "Precio debe ser un numero")
             return
 
-        ok = database.update_material(
-            self.selected_material_id,
-            name=name,
-            identifier=identifier,
-            description=desc,
-            price=price
-        )
+        # Preview the effect on products before changing the price
+        current = database.get_material_by_id(self.selected_material_id)
+        if current and abs((current.price or 0.0) - price) > 1e-9:
+            rows = database.simulate_price_changes({self.selected_material_id: price})
+            if rows:
+                dialog = PricePreviewDialog(self, f"Cambio de precio: {name}", rows, confirm=True)
+                self.wait_window(dialog)
+                if not dialog.confirmed:
+                    return
+
+        try:
+            with database.transaction():
+                ok = database.update_material(
+                    self.selected_material_id,
+                    name=name,
+                    identifier=identifier,
+                    description=desc,
+                    price=price,
+                    expected_version=self.selected_material_version
+                )
+        except database.ConcurrentModificationError:
+            messagebox.showerror(
+                "Conflicto",
+                "Otro usuario ha modificado este material mientras lo editabas.\n"
+                "Se han recargado sus datos actuales; revisa los cambios y vuelve a guardar."
+            )
+            self.load_material(self.selected_material_id)
+            return
         if not ok:
             messagebox.showerror("Error", "Nombre o identificador ya existe")
             return
         messagebox.showinfo("Updated", f"Material '{name}' modificado correctamente")
         self.selected_material_id = None
-        self.controller.refresh_all_lists()
+
+    def simulate_price(self):
+        """Show what the entered price would do to every product using this material, without saving."""
+        if not self.selected_material_id:
+            messagebox.showerror("Error", "Selecciona un material para simular")
+            return
+        try:
+            price = float(self.price_var.get().strip())
+        except ValueError:
+            messagebox.showerror("Error", "Precio debe ser un numero")
+            return
+
+        rows = database.simulate_price_changes({self.selected_material_id: price})
+        if not rows:
+            messagebox.showinfo("Simulación", "Ningún producto usa este material")
+            return
+        PricePreviewDialog(self, f"Simulación: {self.name_var.get().strip()} a €{price:.2f}", rows)
 
     def backup_database(self):
         folder = tk.filedialog.askdirectory(title="Selecciona carpeta para guardar copia")
@@ -148,9 +207,8 @@ class AddMaterialFrame(tk.LabelFrame):
             return
 
         try:
-            shutil.copy2(backup_file, database.DB_NAME)
+            database.restore_database(backup_file)
             messagebox.showinfo("Success", "Database restored successfully!")
-            self.controller.refresh_all_lists()  # refresh UI if needed
         except Exception as e:
             messagebox.showerror("Error", f"Failed to restore database:\n{e}")
 
@@ -166,41 +224,19 @@ class AddMaterialFrame(tk.LabelFrame):
             messagebox.showerror("Error", "No se encontró el material a clonar")
             return
 
-        # Preparar datos del clon
-        new_name = material["name"] + " - Copia"
-        new_desc = material["description"] or ""
-        new_price = material["price"] or 0.0
-
-        # El identificador lo ponemos None para que no choque con el original
-        ok = database.add_material(new_name, description=new_desc, identifier=None, price=new_price)
-        if not ok:
-            messagebox.showerror("Error", "No se pudo crear el material clonado (nombre o identificador duplicado)")
-            return
-
-        # Recuperar el id del material recién insertado
-        conn, cursor = database.connect()
-        cursor.execute("SELECT id FROM Materials WHERE name = ?", (new_name,))
-        row = cursor.fetchone()
-        conn.close()
-        if not row:
-            messagebox.showerror("Error", "Error al recuperar el id del material clonado")
-            return
-        new_material_id = row[0]
-
-        # Copiar también la fórmula asociada
-        formulas = database.get_formulas(self.selected_material_id)
-        if formulas:
-            conn, cursor = database.connect()
-            for row in formulas:
-                ing_id = row[0]   # id del ingrediente
-                qty = row[2]      # cantidad
-                cursor.execute(
-                    "INSERT INTO Formulas (product_id, ingredient_id, quantity) VALUES (?, ?, ?)",
-                    (new_material_id, ing_id, qty)
-                )
-            conn.commit()
-            conn.close()
-
+        # Si la fórmula tiene ingredientes, ofrecer clonar también los intermedios
+        deep = False
+        if database.get_formulas(self.selected_material_id):
+            deep = messagebox.askyesno(
+                "Clonar",
+                "¿Clonar también los productos intermedios de la fórmula?"
+            )
+
+        with database.transaction():
+            new_material_id = database.clone_product(self.selected_material_id, deep=deep)
+            new_name = database.get_material_by_id(new_material_id).name if new_material_id else None
+        if not new_material_id:
+            messagebox.showerror("Error", "No se pudo crear el material clonado")
+            return
 
-        messagebox.showinfo("Clonado", f"Material '{new_name}' creado como copia de '{material['name']}'")
-        self.controller.refresh_all_lists()
+        messagebox.showinfo("Clonado", f"Material '{new_name}' creado como copia de '{material.name}'")
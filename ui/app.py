@@ -1,13 +1,28 @@
+import queue
+import sqlite3
+import threading
 import tkinter as tk
 import database
-from tkinter import font
+from tkinter import font, messagebox
 from .add_material import AddMaterialFrame
 from .product_list import ProductListFrame
 from .ingredient_list import IngredientListFrame
 from .formula_editor import FormulaEditorFrame
 from .save_bar import SaveBar
 from .manufacturing_order import ManufacturingOrderFrame
+from . import profiling
 
+# Lazy price mode: how often stale prices are recomputed in the background
+PRICE_SWEEP_MS = 30000
+
+# Kiosk mode: how often the screens check whether another station changed the data
+KIOSK_POLL_MS = 5000
+
+# How often events published by worker threads are delivered on the Tk thread
+EVENT_POLL_MS = 100
+
+# In-memory mode: how often changes are written back to the database file
+FLUSH_INTERVAL_MS = 30000
 
 
 class Controller:
@@ -15,20 +30,103 @@ class Controller:
         self.root = root
         self.formula_table = []  # list of dicts {id, name, qty}
         self.selected_product_id = None
+        self.formula_version = None  # row_version of the loaded formula
         self.frames = {}
+        self.subscribers = {}  # event type -> [callback]
+        self.read_only = database.READ_ONLY  # kiosk mode: no editing widgets
+        self.thread = threading.current_thread()
+        self.pending_events = queue.Queue()  # published by other threads, for the Tk thread
+        database.add_listener(self.publish)
+        root.after(EVENT_POLL_MS, self.deliver_pending)
 
     def register(self, name, frame):
         self.frames[name] = frame
 
-    def refresh_all_lists(self):
-        self.frames["products"].refresh()
-        self.frames["ingredients"].refresh()
+    # Change events (database.MaterialAdded, PricesChanged, ...) are published by
+    # the database after each committed write; frames subscribe to what they show
+    def subscribe(self, event_type, callback):
+        self.subscribers.setdefault(event_type, []).append(callback)
+
+    def unsubscribe(self, event_type, callback):
+        callbacks = self.subscribers.get(event_type, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def publish(self, event):
+        if threading.current_thread() is not self.thread:
+            # A write made by a worker (printing, export): callbacks touch widgets,
+            # so they run on the Tk thread at the next poll
+            self.pending_events.put(event)
+            return
+        for callback in list(self.subscribers.get(type(event), ())):
+            callback(event)
+
+    def deliver_pending(self):
+        while True:
+            try:
+                event = self.pending_events.get_nowait()
+            except queue.Empty:
+                break
+            self.publish(event)
+        self.root.after(EVENT_POLL_MS, self.deliver_pending)
+
+
+def schedule_price_sweep(root):
+    try:
+        database.refresh_dirty_prices()
+    except sqlite3.OperationalError:
+        pass  # another station holds the lock; try again on the next sweep
+    root.after(PRICE_SWEEP_MS, schedule_price_sweep, root)
+
+
+def schedule_kiosk_poll(root, controller, version):
+    """Kiosk mode: other stations' commits are not published here, so reload every screen when the data changes."""
+    current = database.data_version()
+    if current != version:
+        controller.publish(database.DatabaseReplaced(database.DB_NAME))
+    root.after(KIOSK_POLL_MS, schedule_kiosk_poll, root, controller, current)
+
+
+def schedule_flush(root):
+    try:
+        database.flush_to_disk()
+    except sqlite3.OperationalError:
+        pass  # the file is locked; try again on the next flush
+    except database.ConcurrentModificationError as e:
+        # Not rescheduled: closing the window asks what to do
+        messagebox.showwarning("Base de datos en memoria", f"No se han guardado los cambios en disco:\n{e}")
+        return
+    root.after(FLUSH_INTERVAL_MS, schedule_flush, root)
+
+
+def on_close(root):
+    """In-memory mode: write the changes back before quitting."""
+    try:
+        database.flush_to_disk()
+    except database.ConcurrentModificationError:
+        if messagebox.askyesno(
+            "Base de datos en memoria",
+            "Otro programa ha modificado la base de datos.\n"
+            "¿Sobrescribirla con los cambios de esta sesión? (Los del otro programa se perderán)"
+        ):
+            database.flush_to_disk(force=True)
+    except sqlite3.OperationalError as e:
+        if not messagebox.askyesno("Base de datos en memoria", f"No se pudo guardar: {e}\n¿Salir sin guardar?"):
+            return
+    root.destroy()
 
 
 def run_app():
-    database.create_tables()
+    if database.READ_ONLY:
+        # One read-only connection for the whole session: no write lock is ever taken
+        database.bind_connection(read_only=True)
+    else:
+        database.create_tables()
+        if database.IN_MEMORY:
+            database.load_into_memory()
+    profiling.install()
     root = tk.Tk()
-    root.title("Material Manager")
+    root.title("Material Manager (solo lectura)" if database.READ_ONLY else "Material Manager")
     # --- Ajustar fuente global ---
     default_font = font.nametofont("TkDefaultFont")
     default_font.configure(size=11)  # cambia 11 por el tamaño que prefieras (por defecto suele ser 9 o 10)
@@ -45,9 +143,10 @@ def run_app():
     controller = Controller(root)
 
     # Top frame (Add material)
-    add_material = AddMaterialFrame(root, controller)
-    add_material.pack(fill=tk.X, padx=10, pady=5)
-    controller.register("add_material", add_material)
+    if not controller.read_only:
+        add_material = AddMaterialFrame(root, controller)
+        add_material.pack(fill=tk.X, padx=10, pady=5)
+        controller.register("add_material", add_material)
 
     #Go to Manufacturing order
     # Create a larger font for the button
@@ -81,11 +180,21 @@ def run_app():
 
 
     # Bottom bar
-    save_bar = SaveBar(root, controller)
-    save_bar.pack(fill=tk.X, padx=10, pady=5)
-    controller.register("save_bar", save_bar)
+    if not controller.read_only:
+        save_bar = SaveBar(root, controller)
+        save_bar.pack(fill=tk.X, padx=10, pady=5)
+        controller.register("save_bar", save_bar)
 
     # Initial refresh
-    controller.refresh_all_lists()
+    product_list.refresh()
+    ingredient_list.refresh()
+
+    if controller.read_only:
+        root.after(KIOSK_POLL_MS, schedule_kiosk_poll, root, controller, database.data_version())
+    elif database.PRICE_MODE == "lazy":
+        root.after(PRICE_SWEEP_MS, schedule_price_sweep, root)
+    if database.IN_MEMORY and not controller.read_only:
+        root.after(FLUSH_INTERVAL_MS, schedule_flush, root)
+        root.protocol("WM_DELETE_WINDOW", lambda: on_close(root))
 
     root.mainloop()
@@ -0,0 +1,150 @@
+import tkinter as tk
+
+
+def _unique_keys(rows):
+    """Yield (key, value) with repeated keys made unique ("5", "5#2", ...)."""
+    seen = {}
+    for key, value in rows:
+        key = str(key)
+        if key in seen:
+            seen[key] += 1
+            key = f"{key}#{seen[key]}"
+        else:
+            seen[key] = 1
+        yield key, value
+
+
+def _runs(indexes):
+    """Group sorted indexes into (first, last) contiguous runs."""
+    runs = []
+    for i in indexes:
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return runs
+
+
+def upsert_row(rows, row, sort_key):
+    """
+    Replace the row with the same key (row[0]) in a list kept sorted by
+    sort_key, or insert it at its sorted place.
+    """
+    for i, old in enumerate(rows):
+        if old[0] == row[0]:
+            del rows[i]
+            break
+    key = sort_key(row)
+    index = next((i for i, old in enumerate(rows) if sort_key(old) > key), len(rows))
+    rows.insert(index, row)
+
+
+class TreeviewBinding:
+    """
+    Keeps a flat ttk.Treeview in sync with a keyed list of rows.
+    update() only deletes, inserts or item()-updates rows that changed, so
+    selection, focus and scroll position survive a refresh. Keys become iids.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.rows = {}   # iid -> values
+        self.order = []  # iids in display order
+
+    def index(self, iid):
+        """Position of iid's row in the rows last passed to update() (repeated keys get "5#2" iids)."""
+        return self.order.index(iid)
+
+    def update(self, rows):
+        """rows: iterable of (key, values)."""
+        new_rows = {}
+        new_order = []
+        for iid, values in _unique_keys(rows):
+            new_rows[iid] = tuple(values)
+            new_order.append(iid)
+
+        gone = [iid for iid in self.order if iid not in new_rows]
+        if gone:
+            self.tree.delete(*gone)
+
+        survivors = [iid for iid in self.order if iid in new_rows]
+        reordered = survivors != [iid for iid in new_order if iid in self.rows]
+
+        for index, iid in enumerate(new_order):
+            values = new_rows[iid]
+            old = self.rows.get(iid)
+            if old is None:
+                self.tree.insert("", index, iid=iid, values=values)
+                continue
+            if old != values:
+                self.tree.item(iid, values=values)
+            if reordered:
+                self.tree.move(iid, "", index)
+
+        self.rows = new_rows
+        self.order = new_order
+
+    def clear(self):
+        self.update([])
+
+
+class ListboxBinding:
+    """
+    Keeps a tk.Listbox in sync with a keyed list of (key, text) rows.
+    Removed and added rows are applied as contiguous range deletes/inserts;
+    the selection and the first visible row are restored by key.
+    """
+
+    def __init__(self, listbox):
+        self.listbox = listbox
+        self.keys = []
+        self.texts = []
+
+    def key_at(self, index):
+        return self.keys[index]
+
+    def update(self, rows):
+        """rows: iterable of (key, text)."""
+        pairs = list(_unique_keys(rows))
+        new_keys = [k for k, _ in pairs]
+        new_texts = [t for _, t in pairs]
+        lb = self.listbox
+
+        selected = {self.keys[i] for i in lb.curselection() if i < len(self.keys)}
+        top_key = self.keys[lb.nearest(0)] if self.keys else None
+
+        old_index = {k: i for i, k in enumerate(self.keys)}
+        new_set = set(new_keys)
+        survivors = [k for k in self.keys if k in new_set]
+
+        if survivors != [k for k in new_keys if k in old_index]:
+            # Relative order changed: rebuild in two Tk calls
+            lb.delete(0, tk.END)
+            if new_texts:
+                lb.insert(tk.END, *new_texts)
+        else:
+            removed = [i for i, k in enumerate(self.keys) if k not in new_set]
+            for first, last in reversed(_runs(removed)):
+                lb.delete(first, last)
+
+            added = [j for j, k in enumerate(new_keys) if k not in old_index]
+            for first, last in _runs(added):
+                lb.insert(first, *new_texts[first:last + 1])
+
+            for j, k in enumerate(new_keys):
+                if k in old_index and self.texts[old_index[k]] != new_texts[j]:
+                    lb.delete(j)
+                    lb.insert(j, new_texts[j])
+
+        self.keys = new_keys
+        self.texts = new_texts
+
+        lb.selection_clear(0, tk.END)
+        for j, k in enumerate(new_keys):
+            if k in selected:
+                lb.selection_set(j)
+        if top_key in new_set:
+            lb.yview(new_keys.index(top_key))
+
+    def clear(self):
+        self.update([])
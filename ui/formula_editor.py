@@ -1,5 +1,7 @@
 import tkinter as tk
 from tkinter import ttk, simpledialog, messagebox
+import database
+from .bindings import TreeviewBinding
 
 
 class FormulaEditorFrame(tk.LabelFrame):
@@ -19,12 +21,14 @@ class FormulaEditorFrame(tk.LabelFrame):
         self.tree.heading("quantity", text="Cantidad")
         self.tree.heading("cost", text="Precio (€)")
         self.tree.pack(fill=tk.BOTH, expand=True, pady=5)
+        self.tree_binding = TreeviewBinding(self.tree)
 
-        # Buttons row
-        btn_frame = tk.Frame(self)
-        btn_frame.pack(fill=tk.X, pady=5)
-        ttk.Button(btn_frame, text="Eliminar Ingrediente seleccionado", command=self.remove_selected).pack(side=tk.LEFT, padx=5)
-        ttk.Button(btn_frame, text="Editar Cantidad", command=self.edit_quantity).pack(side=tk.LEFT, padx=5)
+        # Buttons row (not in kiosk mode: the formula is only shown)
+        if not controller.read_only:
+            btn_frame = tk.Frame(self)
+            btn_frame.pack(fill=tk.X, pady=5)
+            ttk.Button(btn_frame, text="Eliminar Ingrediente seleccionado", command=self.remove_selected).pack(side=tk.LEFT, padx=5)
+            ttk.Button(btn_frame, text="Editar Cantidad", command=self.edit_quantity).pack(side=tk.LEFT, padx=5)
 
         # Total quantity label
         self.total_var = tk.StringVar()
@@ -32,6 +36,8 @@ class FormulaEditorFrame(tk.LabelFrame):
         ttk.Label(self, textvariable=self.total_var, font=("Arial", 10, "bold")).pack(pady=5)
 
         controller.register("formula_editor", self)
+        controller.subscribe(database.PricesChanged, self.on_prices_changed)
+        controller.subscribe(database.MaterialUpdated, self.on_material_updated)
 
     def set_product_name(self, name):
         if name:
@@ -40,36 +46,53 @@ class FormulaEditorFrame(tk.LabelFrame):
             self.title_var.set("Formula (Sin selección)")
 
     def update_display(self):
-        # Clear old rows
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-
-        # Insert updated rows
+        # Only rows that changed are touched in the tree
+        rows = []
         total_qty = 0
         total_cost = 0
         for entry in self.controller.formula_table:
-            iid = str(entry["id"])
             price = entry.get("price", 0.0)
-            cost = entry["qty"] * price
             qty = round(entry["qty"], 3)
             cost = round(entry["qty"] * price, 2)
 
-            self.tree.insert("", "end", iid=iid,
-                            values=(entry["name"], f"{qty:.3f}", f"€{cost:.2f}"))
+            rows.append((entry["id"], (entry["name"], f"{qty:.3f}", f"€{cost:.2f}")))
             total_qty += qty
 
             total_cost += cost
+        self.tree_binding.update(rows)
 
         # Update labels
         self.total_var.set(f"Cantidad total: {total_qty:.3f} | Precio total: €{total_cost:.2f}")
 
 
+    def on_prices_changed(self, event):
+        """Refresh the cost of the ingredients whose price changed, keeping unsaved quantities."""
+        changed = set(event.material_ids)
+        entries = [e for e in self.controller.formula_table if e["id"] in changed]
+        if not entries:
+            return
+        for entry in entries:
+            material = database.get_material_by_id(entry["id"])
+            if material:
+                entry["price"] = material.price or 0.0
+        self.update_display()
+
+    def on_material_updated(self, event):
+        entry = next((e for e in self.controller.formula_table if e["id"] == event.material_id), None)
+        if entry is None:
+            return
+        material = database.get_material_by_id(event.material_id)
+        if material:
+            entry["name"] = material.name
+            self.update_display()
+
     def remove_selected(self):
         sel = self.tree.selection()
         if not sel:
             return
-        ids = [int(iid) for iid in sel]
-        self.controller.formula_table = [e for e in self.controller.formula_table if e["id"] not in ids]
+        # By position: a formula can list the same ingredient twice
+        indexes = {self.tree_binding.index(iid) for iid in sel}
+        self.controller.formula_table = [e for i, e in enumerate(self.controller.formula_table) if i not in indexes]
         self.update_display()
 
     def edit_quantity(self):
@@ -77,10 +100,7 @@ class FormulaEditorFrame(tk.LabelFrame):
         if not sel:
             messagebox.showerror("Error", "Selecciona un ingrediente para editar")
             return
-        iid = int(sel[0])
-        entry = next((e for e in self.controller.formula_table if e["id"] == iid), None)
-        if not entry:
-            return
+        entry = self.controller.formula_table[self.tree_binding.index(sel[0])]
         answer = simpledialog.askstring("Editar cantidad", f"Introduce la nueva cantidad para '{entry['name']}'", initialvalue=str(entry["qty"]))
         if answer is None:
             return
@@ -1,6 +1,8 @@
 import tkinter as tk
 from tkinter import messagebox
 import database
+from .bindings import ListboxBinding, upsert_row
+from .where_used import WhereUsedDialog
 
 
 class IngredientListFrame(tk.LabelFrame):
@@ -24,28 +26,46 @@ class IngredientListFrame(tk.LabelFrame):
         scroll.pack(side=tk.LEFT, fill=tk.Y)
 
         self.listbox.bind("<<ListboxSelect>>", self.on_select)
+        self.listbox_binding = ListboxBinding(self.listbox)
+        self.all_materials = []  # full list from the DB; filtered in memory while typing
 
-        qty_frame = tk.Frame(self)
-        qty_frame.pack(fill=tk.X, pady=6)
-        tk.Label(qty_frame, text="Cantidad:").pack(side=tk.LEFT)
-        self.qty_entry = tk.Entry(qty_frame, width=12)
-        self.qty_entry.pack(side=tk.LEFT, padx=6)
-        self.qty_entry.insert(0, "0.0")
+        controller.subscribe(database.MaterialAdded, self.on_material_changed)
+        controller.subscribe(database.MaterialUpdated, self.on_material_changed)
+        controller.subscribe(database.DatabaseReplaced, lambda event: self.refresh())
 
-        tk.Button(self, text="Añadir / Modificar Ingrediente", command=self.add_ingredient).pack(pady=4)
+        if not controller.read_only:
+            qty_frame = tk.Frame(self)
+            qty_frame.pack(fill=tk.X, pady=6)
+            tk.Label(qty_frame, text="Cantidad:").pack(side=tk.LEFT)
+            self.qty_entry = tk.Entry(qty_frame, width=12)
+            self.qty_entry.pack(side=tk.LEFT, padx=6)
+            self.qty_entry.insert(0, "0.0")
+
+            tk.Button(self, text="Añadir / Modificar Ingrediente", command=self.add_ingredient).pack(pady=4)
+        tk.Button(self, text="¿Dónde se usa?", command=self.show_where_used).pack(pady=4)
 
     def refresh(self):
-        filter_text = self.search_var.get() or ""
-        self.listbox.delete(0, tk.END)
-        self.materials = []
+        materials = database.get_material_columns()
+        self.all_materials = list(zip(materials.id, materials.name))
+        self.apply_filter()
+
+    def on_material_changed(self, event):
+        material = database.get_material_by_id(event.material_id)
+        if material:
+            upsert_row(self.all_materials, (material.id, material.name), sort_key=lambda row: row[1])
+            self.apply_filter()
 
-        for mid, mname, identifier, price in database.get_materials():
-            if filter_text.lower() in mname.lower():
-                self.listbox.insert(tk.END, mname)
-                self.materials.append((mid, mname))
+    def apply_filter(self):
+        text = (self.search_var.get() or "").strip()
+        if text:
+            # Every substring match, then typo- and accent-tolerant ones, on name or identifier
+            self.materials = [(hit.material_id, hit.name) for hit in database.search_materials(text, limit=None)]
+        else:
+            self.materials = list(self.all_materials)
+        self.listbox_binding.update(self.materials)
 
     def on_search(self, event=None):
-        self.refresh()
+        self.apply_filter()
 
     def on_select(self, event=None):
         sel = self.listbox.curselection()
@@ -88,3 +108,9 @@ class IngredientListFrame(tk.LabelFrame):
             "qty": qty
         })
         self.controller.frames["formula_editor"].update_display()
+
+    def show_where_used(self):
+        if not self.selected_ingredient_id:
+            messagebox.showerror("Error", "Selecciona un ingrediente primero")
+            return
+        WhereUsedDialog(self, self.selected_ingredient_id, self.selected_ingredient_name)
@@ -1,8 +1,14 @@
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog, simpledialog
 import database
-from datetime import datetime
-from ui.print_order import print_orders  # note the plural
+import os
+import datetime
+import queue
+import threading
+from ui.print_order import print_orders, open_pdf, format_date  # note the plural
+from ui.bindings import TreeviewBinding, ListboxBinding, upsert_row
+
+RECENT_ORDER_DAYS = 90  # default window of the order list; older orders need an explicit "Desde"
 
 class ManufacturingOrderFrame(tk.Toplevel):
     def __init__(self, parent, controller):
@@ -18,6 +24,8 @@ class ManufacturingOrderFrame(tk.Toplevel):
         self.selected_product_name = None
         self.formula_table = []  # per-unit
         self.selected_order_id = None
+        self.showing_order = False  # the formula tree shows a saved order, not a product
+        self.orders = []
 
         # --- Main layout ---
         main_frame = tk.Frame(self)
@@ -41,6 +49,8 @@ class ManufacturingOrderFrame(tk.Toplevel):
         self.product_listbox = tk.Listbox(left_frame, height=8)
         self.product_listbox.pack(fill=tk.BOTH, expand=False)
         self.product_listbox.bind("<<ListboxSelect>>", self.on_product_select)
+        self.product_binding = ListboxBinding(self.product_listbox)
+        self.all_products = []  # [(id, name)] of products with a formula
 
         tk.Label(left_frame, text="Formula del producto seleccionado:").pack(anchor="w", pady=4)
         columns = ("ingredient", "quantity")
@@ -48,24 +58,25 @@ class ManufacturingOrderFrame(tk.Toplevel):
         self.tree.heading("ingredient", text="Componente")
         self.tree.heading("quantity", text="Cantidad")
         self.tree.pack(fill=tk.BOTH, expand=True)
+        self.tree_binding = TreeviewBinding(self.tree)
 
         # Order info label (shows next order id + product name)
         self.order_info_var = tk.StringVar(value="Ningun producto seleccionado")
         tk.Label(left_frame, textvariable=self.order_info_var, font=("Arial", 10, "bold")).pack(anchor="w", pady=2)
 
-        # Invoice number
-        inv_frame = tk.Frame(left_frame)
-        inv_frame.pack(fill=tk.X, pady=4)
-        tk.Label(inv_frame, text="Numero de proforma:").pack(side=tk.LEFT)
-        self.invoice_entry = tk.Entry(inv_frame, width=15)
-        self.invoice_entry.pack(side=tk.LEFT, padx=6)
+        # Invoice number and customer name (kiosk mode only shows orders, it does not create them)
+        if not controller.read_only:
+            inv_frame = tk.Frame(left_frame)
+            inv_frame.pack(fill=tk.X, pady=4)
+            tk.Label(inv_frame, text="Numero de proforma:").pack(side=tk.LEFT)
+            self.invoice_entry = tk.Entry(inv_frame, width=15)
+            self.invoice_entry.pack(side=tk.LEFT, padx=6)
 
-        # Customer name
-        cust_frame = tk.Frame(left_frame)
-        cust_frame.pack(fill=tk.X, pady=4)
-        tk.Label(cust_frame, text="Cliente:").pack(side=tk.LEFT)
-        self.customer_entry = tk.Entry(cust_frame, width=25)
-        self.customer_entry.pack(side=tk.LEFT, padx=6)
+            cust_frame = tk.Frame(left_frame)
+            cust_frame.pack(fill=tk.X, pady=4)
+            tk.Label(cust_frame, text="Cliente:").pack(side=tk.LEFT)
+            self.customer_entry = tk.Entry(cust_frame, width=25)
+            self.customer_entry.pack(side=tk.LEFT, padx=6)
 
         # Units input
         units_frame = tk.Frame(left_frame)
@@ -77,7 +88,8 @@ class ManufacturingOrderFrame(tk.Toplevel):
         self.units_entry.bind("<KeyRelease>", lambda e: self.update_tree())
 
         # Save button
-        tk.Button(left_frame, text="Guardar orden de fabricación", command=self.save_order).pack(pady=6)
+        if not controller.read_only:
+            tk.Button(left_frame, text="Guardar orden de fabricación", command=self.save_order).pack(pady=6)
 
         # -----------------------------
         # RIGHT SIDE: Past Orders + Print Controls
@@ -94,7 +106,19 @@ class ManufacturingOrderFrame(tk.Toplevel):
         self.to_id_entry = tk.Entry(top_right_frame, width=6)
         self.to_id_entry.pack(side=tk.LEFT, padx=2)
 
-        tk.Button(top_right_frame, text="Imprimir", command=self.print_orders_range).pack(pady=4)
+        self.print_button = tk.Button(top_right_frame, text="Imprimir", command=self.print_orders_range)
+        self.print_button.pack(side=tk.LEFT, padx=4, pady=4)
+
+        self.one_file_per_order_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            top_right_frame, text="Un PDF por orden", variable=self.one_file_per_order_var
+        ).pack(side=tk.LEFT, padx=4)
+
+        tk.Button(top_right_frame, text="Exportar...", command=self.export_orders).pack(side=tk.LEFT, padx=4)
+
+        self.print_status_var = tk.StringVar()
+        tk.Label(top_right_frame, textvariable=self.print_status_var).pack(side=tk.LEFT, padx=4)
+        self.print_queue = queue.Queue()
 
         # --- NEW: Search bar for orders ---
         search_order_frame = tk.Frame(right_frame)
@@ -104,6 +128,14 @@ class ManufacturingOrderFrame(tk.Toplevel):
         self.order_search_entry = tk.Entry(search_order_frame, textvariable=self.order_search_var)
         self.order_search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         self.order_search_entry.bind("<KeyRelease>", self.on_order_search)
+        tk.Label(search_order_frame, text="Desde:").pack(side=tk.LEFT)
+        self.orders_from_var = tk.StringVar(
+            value=(datetime.date.today() - datetime.timedelta(days=RECENT_ORDER_DAYS)).isoformat()
+        )
+        orders_from_entry = tk.Entry(search_order_frame, textvariable=self.orders_from_var, width=11)
+        orders_from_entry.pack(side=tk.LEFT, padx=5)
+        orders_from_entry.bind("<Return>", self.on_order_search)
+        orders_from_entry.bind("<FocusOut>", self.on_order_search)
 
         tk.Label(right_frame, text="Ordenes de fabricación:").pack(anchor="w")
         columns = ("id", "product", "units", "customer", "invoice", "date")
@@ -127,6 +159,7 @@ class ManufacturingOrderFrame(tk.Toplevel):
 
         self.orders_tree.pack(fill=tk.BOTH, expand=True)
         self.orders_tree.bind("<<TreeviewSelect>>", self.on_order_select)
+        self.orders_binding = TreeviewBinding(self.orders_tree)
 
         # -----------------------------
         # Initial data
@@ -134,86 +167,128 @@ class ManufacturingOrderFrame(tk.Toplevel):
         self.refresh_products()
         self.refresh_orders()
 
+        # Follow changes made while the window is open
+        self.subscriptions = [
+            (database.OrderCreated, self.on_order_created),
+            (database.FormulaSaved, self.on_product_changed),
+            (database.MaterialAdded, self.on_product_changed),
+            (database.MaterialUpdated, self.on_product_changed),
+            (database.DatabaseReplaced, self.on_database_replaced),
+        ]
+        for event_type, callback in self.subscriptions:
+            controller.subscribe(event_type, callback)
+        self.bind("<Destroy>", self.on_destroy)
+
+    def on_destroy(self, event):
+        if event.widget is self:
+            for event_type, callback in self.subscriptions:
+                self.controller.unsubscribe(event_type, callback)
+
+    def on_product_changed(self, event):
+        """A formula was saved or a material added/renamed: update that product only."""
+        product_id = event[0]
+        material = database.get_material_by_id(product_id)
+        if material and material.has_formula:
+            upsert_row(self.all_products, (product_id, material.name), sort_key=lambda row: row[1])
+        else:
+            self.all_products = [p for p in self.all_products if p[0] != product_id]
+        self.filter_products()
+
+        if product_id == self.selected_product_id and not self.showing_order and material and material.has_formula:
+            lines = database.get_formulas(product_id)
+            self.selected_product_name = material.name
+            self.formula_table = [{"id": l.ingredient_id, "name": l.name, "qty": l.quantity} for l in lines]
+            self.update_next_order_label()
+            self.update_tree()
+
+    def on_order_created(self, event):
+        if self.order_search_var.get().strip():
+            self.on_order_search()
+        else:
+            order = database.get_order(event.order_id)
+            if order:
+                self.populate_orders_listbox([order] + self.orders)
+        self.update_next_order_label()
+
+    def on_database_replaced(self, event):
+        self.refresh_products()
+        self.refresh_orders()
+
+    def update_next_order_label(self):
+        next_id = database.get_next_order_id()
+        if self.selected_product_name:
+            self.order_info_var.set(f"Next Order #{next_id} for {self.selected_product_name}")
+        else:
+            self.order_info_var.set(f"Next Order #{next_id}")
+
     # -----------------------------
     # Product search / list
     # -----------------------------
     def refresh_products(self):
-        filter_text = self.search_var.get().lower() if self.search_var.get() else ""
-        self.product_listbox.delete(0, tk.END)
-
         # Only products that have a formula
-        conn, cursor = database.connect()
-        cursor.execute("""
-            SELECT DISTINCT m.id, m.name, m.identifier, m.price
-            FROM Materials m
-            JOIN Formulas f ON m.id = f.product_id
-            ORDER BY m.name
-        """)
-        rows = cursor.fetchall()
-        conn.close()
-
-        for row in rows:
-            mid, mname, identifier, price = row
-            if filter_text in mname.lower():
-                # Solo mostrar el nombre, no el ID
-                self.product_listbox.insert(tk.END, mname)
-
+        self.all_products = [(p.id, p.name) for p in database.get_products()]
+        self.filter_products()
+
+    def filter_products(self):
+        text = (self.search_var.get() or "").strip()
+        # Solo mostrar el nombre, no el ID
+        if text:
+            hits = database.search_materials(text, limit=None, ids=[mid for mid, _ in self.all_products])
+            self.product_binding.update((hit.material_id, hit.name) for hit in hits)
+        else:
+            self.product_binding.update(self.all_products)
 
     def on_search(self, event=None):
-        self.refresh_products()
+        self.filter_products()
 
     def on_product_select(self, event=None):
         sel = self.product_listbox.curselection()
         if not sel:
             return
+        product_id = int(self.product_binding.key_at(sel[0]))
         product_name = self.product_listbox.get(sel[0])
-
-        # Buscar id en la base de datos usando el nombre
-        product = database.get_material_by_name(product_name)
-        if not product:
-            return
-        self.selected_product_id = product["id"]
+        self.selected_product_id = product_id
         self.selected_product_name = product_name
+        self.showing_order = False
 
         # Load per-unit formula
         formula = database.get_formulas(self.selected_product_id)
         self.formula_table = [{"id": ing_id, "name": name, "qty": qty} for ing_id, name, qty, _ in formula]
 
         # Show order info (next ID + product)
-        next_id = database.get_next_order_id()
-        self.order_info_var.set(f"Next Order #{next_id} for {product_name}")
+        self.update_next_order_label()
 
         self.update_tree()
 
     # -----------------------------
     # Orders
     # -----------------------------
-    def refresh_orders(self):
-        orders = database.get_orders()
-        self.populate_orders_listbox(orders)
+    def orders_from(self):
+        """Start of the listed range, or None (main database only) if empty or not a date."""
+        try:
+            return datetime.date.fromisoformat(self.orders_from_var.get().strip()).isoformat()
+        except ValueError:
+            return None
 
+    def refresh_orders(self):
+        self.on_order_search()
 
     def on_order_search(self, event=None):
         """Filter orders by invoice number or client name"""
         query = self.order_search_var.get().strip()
         if query:
-            orders = database.search_orders(query)
+            orders = database.search_orders(query, self.orders_from())
         else:
-            orders = database.get_orders()
+            orders = database.get_orders(self.orders_from())
         self.populate_orders_listbox(orders)
 
     def populate_orders_listbox(self, orders):
+        self.orders = list(orders)
         # Ahora trabajamos con self.orders_tree
-        for row in self.orders_tree.get_children():
-            self.orders_tree.delete(row)
-
-        for oid, pname, units, ts, customer_name, invoice_number in orders:
-            ts_fmt = self._format_date_for_display(ts)
-            self.orders_tree.insert(
-                "", "end",
-                iid=str(oid),
-                values=(oid, pname, f"{units:.2f}", customer_name or "-", invoice_number or "-", ts_fmt)
-            )
+        self.orders_binding.update(
+            (oid, (oid, pname, f"{units:.2f}", customer_name or "-", invoice_number or "-", format_date(ts)))
+            for oid, pname, units, ts, customer_name, invoice_number in self.orders
+        )
 
 
     def on_order_select(self, event=None):
@@ -221,13 +296,15 @@ class ManufacturingOrderFrame(tk.Toplevel):
         if not sel:
             return
         self.selected_order_id = int(sel[0])
+        self.showing_order = True
 
-        pid, units, ingredients, *_ = database.get_order_details(self.selected_order_id)
-        if not pid:
+        details = database.get_order_details(self.selected_order_id)
+        if details is None:
             return
+        pid, units, ingredients = details.product_id, details.units, details.ingredients
 
         self.selected_product_id = pid
-        self.selected_product_name = database.get_material_by_id(pid)["name"]
+        self.selected_product_name = database.get_material_by_id(pid).name
         self.units_entry.delete(0, tk.END)
         self.units_entry.insert(0, str(units))
 
@@ -246,11 +323,11 @@ class ManufacturingOrderFrame(tk.Toplevel):
             units = float(self.units_entry.get())
         except ValueError:
             units = 0
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        for entry in self.formula_table:
-            value = round(entry["qty"] * units, 3)        # redondear a 3 decimales
-            self.tree.insert("", "end", values=(entry["name"], f"{value:.3f}"))
+        self.tree_binding.update(
+            # redondear a 3 decimales
+            (entry["id"], (entry["name"], f"{round(entry['qty'] * units, 3):.3f}"))
+            for entry in self.formula_table
+        )
 
     # -----------------------------
     # Save order
@@ -268,26 +345,19 @@ class ManufacturingOrderFrame(tk.Toplevel):
 
         invoice = self.invoice_entry.get().strip()
         customer = self.customer_entry.get().strip()
-        order_id = database.create_order(
-            self.selected_product_id,
-            units,
-            proforma_number=invoice,
-            client_name=customer
-        )
+        with database.transaction():
+            order_id = database.create_order(
+                self.selected_product_id,
+                units,
+                proforma_number=invoice,
+                client_name=customer
+            )
         messagebox.showinfo("Success", f"Order {order_id} saved for {self.selected_product_name}")
 
-        # Refresh orders & keep window on top
-        self.refresh_orders()
+        # The orders list and next order label follow the OrderCreated event; keep window on top
         self.lift()
         self.focus_force()
 
-        # Update next order label
-        next_id = database.get_next_order_id()
-        if self.selected_product_name:
-            self.order_info_var.set(f"Next Order #{next_id} for {self.selected_product_name}")
-        else:
-            self.order_info_var.set(f"Next Order #{next_id}")
-
     # -----------------------------
     # Print multiple orders
     # -----------------------------
@@ -329,39 +399,111 @@ class ManufacturingOrderFrame(tk.Toplevel):
                 last_order_id = orders[0][0]  # assuming descending by date
                 order_ids = [last_order_id]
 
-        from ui.print_order import print_orders
-        print_orders(order_ids)
+        self.start_print(order_ids)
+
+    def start_print(self, order_ids):
+        """Render the PDF in a background thread (process pool for big ranges) and poll for progress."""
+        one_file_per_order = self.one_file_per_order_var.get()
+        output_path = None
+        if one_file_per_order:
+            output_path = filedialog.askdirectory(title="Carpeta para los PDF")
+            if not output_path:
+                return
+        elif not hasattr(os, "startfile"):
+            # Sin visor del sistema: guardar en la ruta elegida
+            output_path = filedialog.asksaveasfilename(
+                title="Guardar hojas de fabricación",
+                defaultextension=".pdf",
+                filetypes=[("PDF", "*.pdf")]
+            )
+            if not output_path:
+                return
+
+        def progress(done, total):
+            self.print_queue.put(("progress", done, total))
+
+        def worker():
+            try:
+                paths = print_orders(
+                    order_ids,
+                    output_path=output_path,
+                    one_file_per_order=one_file_per_order,
+                    progress=progress
+                )
+                self.print_queue.put(("done", paths, one_file_per_order))
+            except Exception as e:
+                self.print_queue.put(("error", e))
+
+        self.print_button.config(state=tk.DISABLED)
+        self.print_status_var.set(f"Imprimiendo 0/{len(order_ids)}...")
+        threading.Thread(target=worker, daemon=True).start()
+        self.after(100, self.poll_print_queue)
+
+    def poll_print_queue(self):
+        while True:
+            try:
+                msg = self.print_queue.get_nowait()
+            except queue.Empty:
+                break
+            if msg[0] == "progress":
+                self.print_status_var.set(f"Imprimiendo {msg[1]}/{msg[2]}...")
+                continue
+
+            self.print_button.config(state=tk.NORMAL)
+            self.print_status_var.set("")
+            if msg[0] == "error":
+                messagebox.showerror("Error", f"No se pudo imprimir:\n{msg[1]}")
+            elif not msg[1]:
+                messagebox.showinfo("Info", "No hay ordenes en ese rango")
+            elif msg[2]:
+                messagebox.showinfo("Success", f"{len(msg[1])} PDF guardados en:\n{os.path.dirname(msg[1][0])}")
+            elif not open_pdf(msg[1][0]):
+                messagebox.showinfo("Success", f"PDF guardado en:\n{msg[1][0]}")
+            return
+        self.after(100, self.poll_print_queue)
 
 
     # -----------------------------
-    # Date formatting helper
+    # Export for accounting
     # -----------------------------
+    def export_orders(self):
+        date_from = simpledialog.askstring("Exportar", "Desde fecha (AAAA-MM-DD, vacío = sin el archivo de años anteriores):", parent=self)
+        if date_from is None:
+            return
+        date_to = simpledialog.askstring("Exportar", "Hasta fecha (AAAA-MM-DD, vacío = hasta hoy):", parent=self)
+        if date_to is None:
+            return
+        path = filedialog.asksaveasfilename(
+            title="Exportar ordenes",
+            defaultextension=".csv",
+            filetypes=[("CSV", "*.csv"), ("JSON Lines", "*.jsonl")]
+        )
+        if not path:
+            return
+        fmt = "jsonl" if path.endswith(".jsonl") else "csv"
 
-    def _format_date_for_display(self, ts):
-        """Return ts as DD-MM-YYYY if possible, otherwise sensible fallback."""
-        if not ts:
-            return ""
-        # Try common formats (with and without microseconds, with 'T', etc.)
-        candidates = [
-            "%Y-%m-%d %H:%M:%S.%f",
-            "%Y-%m-%d %H:%M:%S",
-            "%Y-%m-%dT%H:%M:%S.%f",
-            "%Y-%m-%dT%H:%M:%S",
-            "%Y-%m-%d",
-        ]
-        for fmt in candidates:
+        result = {}
+
+        def worker():
             try:
-                dt = datetime.strptime(ts, fmt)
-                return dt.strftime("%d-%m-%Y")
-            except Exception:
-                pass
-        # Try fromisoformat as a last attempt (handles some variants)
-        try:
-            dt = datetime.fromisoformat(ts)
-            return dt.date().strftime("%d-%m-%Y")
-        except Exception:
-            pass
-        # Fallback: return just the date part if there is a space
-        if isinstance(ts, str) and " " in ts:
-            return ts.split(" ")[0].replace("-", "/")  # still make it readable
-        return str(ts)
+                result["rows"] = database.export_orders(
+                    path, date_from.strip() or None, date_to.strip() or None, format=fmt
+                )
+            except Exception as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        self.print_status_var.set("Exportando...")
+
+        def poll():
+            if thread.is_alive():
+                self.after(200, poll)
+                return
+            self.print_status_var.set("")
+            if "error" in result:
+                messagebox.showerror("Error", f"No se pudo exportar:\n{result['error']}")
+            else:
+                messagebox.showinfo("Exportado", f"{result['rows']} líneas exportadas a:\n{path}")
+
+        self.after(200, poll)
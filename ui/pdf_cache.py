@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+
+# Default size cap for the whole cache folder
+MAX_CACHE_BYTES = 200 * 1024 * 1024
+
+
+class PdfCache:
+    """
+    Disk cache of rendered PDFs addressed by a hash of their printable content.
+    Least recently used files are evicted once the folder exceeds max_bytes
+    (hits refresh the file mtime).
+    """
+
+    def __init__(self, directory, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(content):
+        """Stable hash of any JSON-serialisable content."""
+        data = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + ".pdf")
+
+    def get(self, key):
+        """Return the cached file path or None, marking it as recently used."""
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def evict(self):
+        """Delete least recently used files until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".pdf"):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
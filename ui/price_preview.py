@@ -0,0 +1,52 @@
+import tkinter as tk
+from tkinter import ttk
+
+
+class PricePreviewDialog(tk.Toplevel):
+    """
+    Shows the result of database.simulate_price_changes: old/new price of every
+    affected product. With confirm=True it has Aplicar/Cancelar buttons and
+    self.confirmed tells which one was pressed.
+    """
+
+    def __init__(self, parent, title, rows, confirm=False):
+        super().__init__(parent)
+        self.title(title)
+        self.confirmed = False
+        self.transient(parent)
+
+        tk.Label(self, text=f"{len(rows)} productos afectados", font=("Arial", 10, "bold")).pack(anchor="w", padx=8, pady=4)
+
+        columns = ("product", "old", "new", "delta")
+        tree = ttk.Treeview(self, columns=columns, show="headings", height=15)
+        tree.heading("product", text="Producto")
+        tree.heading("old", text="Precio actual")
+        tree.heading("new", text="Precio nuevo")
+        tree.heading("delta", text="Diferencia")
+        tree.column("product", width=320, anchor="w")
+        for col in ("old", "new", "delta"):
+            tree.column(col, width=100, anchor="e")
+        scroll = tk.Scrollbar(self, command=tree.yview)
+        tree.config(yscrollcommand=scroll.set)
+
+        for row in rows:
+            pct = f" ({row.delta / row.old_price:+.1%})" if row.old_price else ""
+            tree.insert("", "end", iid=str(row.product_id),
+                        values=(row.name, f"€{row.old_price:.2f}", f"€{row.new_price:.2f}", f"{row.delta:+.2f}{pct}"))
+
+        btn_frame = tk.Frame(self)
+        btn_frame.pack(side=tk.BOTTOM, fill=tk.X, pady=6)
+        if confirm:
+            tk.Button(btn_frame, text="Aplicar", width=12, command=self.on_confirm).pack(side=tk.RIGHT, padx=6)
+            tk.Button(btn_frame, text="Cancelar", width=12, command=self.destroy).pack(side=tk.RIGHT, padx=6)
+        else:
+            tk.Button(btn_frame, text="Cerrar", width=12, command=self.destroy).pack(side=tk.RIGHT, padx=6)
+
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(8, 0))
+        scroll.pack(side=tk.LEFT, fill=tk.Y)
+
+        self.grab_set()
+
+    def on_confirm(self):
+        self.confirmed = True
+        self.destroy()
@@ -1,98 +1,247 @@
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import tempfile
 import os
-from datetime import datetime
+import shutil
+from functools import lru_cache
 import database
+from ui.pdf_cache import PdfCache
 
-def print_orders(order_ids):
-    """Print multiple manufacturing orders, each on its own page (portrait A4)."""
-    if not order_ids:
-        return
+# Orders per worker job; small batches are rendered without starting a pool
+CHUNK_SIZE = 20
 
-    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    pdf_path = tmp_file.name
-    tmp_file.close()
+# Part of every cache key: bump it whenever draw_order_sheet changes
+TEMPLATE_VERSION = 1
 
-    c = canvas.Canvas(pdf_path, pagesize=A4)
-    width, height = A4
-    margin_left = 40
-    margin_right = 70
+# Rendered sheets cache; None means a "pdf_cache" folder next to the database
+CACHE_DIR = None
 
-    for order_id in order_ids:
-        product_id, units, ingredients, client_name, proforma_number = database.get_order_details(order_id)
-        product = database.get_material_by_id(product_id)
-        product_name = product["name"] if product else "ERROR"
-
-        ts = next((t for oid, pname, u, t, cl, pf in database.get_orders() if oid == order_id), "")
-        ts_fmt = format_date(ts)
-
-        # --- Cabecera ---
-        y = height - 50
-        c.setFont("Helvetica-Bold", 21)
-        c.drawString(margin_left, y, f"Orden de fabricación: {order_id}")
-        y -= 28
-
-        c.setFont("Helvetica", 13)
-        c.drawString(margin_left, y, f"Cliente: {client_name or '-'}")
-        c.drawRightString(width - margin_right, y, f"Fecha: {ts_fmt}")
-        y -= 18
-
-        c.drawString(margin_left, y, f"Proforma: {proforma_number or '-'}")
-        y -= 30
-
-        # --- Producto principal ---
-        c.setFont("Helvetica-Bold", 15)
-        c.line(margin_left, y, width - margin_right, y)
-        y -= 22
-        c.drawString(margin_left, y, product_name)
-        c.drawRightString(width - margin_right, y, f"Kgs: {units}")
-        y -= 22
-        c.line(margin_left, y, width - margin_right, y)
-        y -= 25
-
-        # --- Cabecera tabla ---
-        c.setFont("Helvetica-Bold", 14)
-        x_descr_left = margin_left                 # Descripcion empieza desde el margen izquierdo
-        x_qty = width - margin_right - 75         # Kgs un poco a la izquierda, suficiente espacio para 6 caracteres
-        x_code_right = width - margin_right        # Codigo al final
-
-        c.drawString(x_descr_left, y, "Descripcion")
-        c.drawRightString(x_qty, y, "Kg")          # drawRightString usa la posición de la derecha
-        c.drawRightString(x_code_right, y, "Codigo")
-        y -= 16
-        c.line(margin_left, y, width - margin_right, y)
-        y -= 22
-
-        # --- Filas tabla ---
-        c.setFont("Helvetica", 14)
-        table_row_height = 24
-        for ing_id, ing_name, qty in ingredients:
-            identifier = next((midf for mid, mname, midf, price in database.get_materials() if mid == ing_id), "")
-            c.drawString(x_descr_left, y, ing_name)
-            c.drawRightString(x_qty, y, f"{qty:.3f}")        # Kgs
-            c.drawRightString(x_code_right, y, str(identifier))  # Codigo
-            y -= table_row_height
-
-            if y < 60:
-                c.showPage()
-                y = height - 50
-
-        c.showPage()
 
+def print_orders(order_ids, output_path=None, one_file_per_order=False, progress=None, max_workers=None):
+    """
+    Render manufacturing orders to PDF, each on its own page (portrait A4).
+
+    output_path is the PDF file to write, or the destination folder when
+    one_file_per_order is True. If omitted, a temp file is used.
+    Every order is rendered once into the PDF cache, keyed by its printable
+    content; only orders missing from the cache are rendered (in a process
+    pool when there are many) and the cached pages are then stitched together.
+    progress(done, total) is called as orders finish.
+    Returns the list of written PDF paths.
+    """
+    order_ids = list(order_ids)
+    if not order_ids:
+        return []
+
+    sheets = load_order_sheets(order_ids)
+    if not sheets:
+        return []
+
+    if output_path is None:
+        if one_file_per_order:
+            output_path = tempfile.mkdtemp(prefix="ordenes_")
+        else:
+            tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+            output_path = tmp_file.name
+            tmp_file.close()
+
+    if not one_file_per_order and len(sheets) > 1 and not _can_merge():
+        # Without pypdf cached pages cannot be stitched: render the range directly
+        render_sheets(sheets, output_path)
+        if progress:
+            progress(len(order_ids), len(order_ids))
+        return [output_path]
+
+    cache = get_cache()
+    paths = []
+    missing = []
+    for sheet in sheets:
+        key = cache.key([TEMPLATE_VERSION, sheet])
+        path = cache.get(key)
+        if path is None:
+            path = cache.path_for(key)
+            missing.append((sheet, path))
+        paths.append(path)
+
+    total = len(order_ids)
+    done = total - len(missing)
+    if progress:
+        progress(done, total)
+
+    chunks = [missing[i:i + CHUNK_SIZE] for i in range(0, len(missing), CHUNK_SIZE)]
+    if len(chunks) == 1:
+        _render_job(chunks[0])
+        if progress:
+            progress(total, total)
+    elif chunks:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(_render_job, chunk): len(chunk) for chunk in chunks}
+            for future in as_completed(futures):
+                future.result()
+                done += futures[future]
+                if progress:
+                    progress(done, total)
+
+    if one_file_per_order:
+        os.makedirs(output_path, exist_ok=True)
+        written = []
+        for sheet, path in zip(sheets, paths):
+            dest = os.path.join(output_path, f"orden_{sheet['order_id']}.pdf")
+            shutil.copyfile(path, dest)
+            written.append(dest)
+    elif len(paths) == 1:
+        shutil.copyfile(paths[0], output_path)
+        written = [output_path]
+    else:
+        _merge_pdfs(paths, output_path)
+        written = [output_path]
+
+    cache.evict()
+    return written
+
+
+def get_cache():
+    directory = CACHE_DIR or os.path.join(os.path.dirname(os.path.abspath(database.DB_NAME)), "pdf_cache")
+    return PdfCache(directory)
+
+
+def open_pdf(pdf_path):
+    """Open a PDF with the system viewer where that is possible (Windows)."""
+    if hasattr(os, "startfile"):
+        os.startfile(pdf_path, "open")
+        return True
+    return False
+
+
+def _can_merge():
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _merge_pdfs(paths, output_path):
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for path in paths:
+        writer.append(path, import_outline=False)
+    with open(output_path, "wb") as f:
+        writer.write(f)
+    writer.close()
+
+
+def _render_job(items):
+    """
+    Worker entry point: renders each (sheet, path) pair into its own file.
+    Files are written under a temporary name and renamed, so a crashed
+    worker never leaves a truncated PDF in the cache.
+    """
+    for sheet, path in items:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        render_sheets([sheet], tmp_path)
+        os.replace(tmp_path, path)
+
+
+def load_order_sheets(order_ids):
+    """Fetch everything needed to print the given orders. Missing orders are skipped."""
+    materials = database.get_material_columns()
+    identifiers = dict(zip(materials.id, materials.identifier))
+    sheets = []
+    for order_id in order_ids:
+        info = database.get_order_info(order_id)
+        if info is None:
+            continue
+        details = database.get_order_details(order_id)
+        product = database.get_material_by_id(info.product_id)
+        sheets.append({
+            "order_id": order_id,
+            "product_name": product.name if product else "ERROR",
+            "units": info.units,
+            "date": format_date(info.date),
+            "client_name": info.client_name,
+            "proforma_number": info.proforma_number,
+            "ingredients": [
+                (line.name, line.quantity, identifiers.get(line.ingredient_id) or "")
+                for line in details.ingredients
+            ],
+        })
+    return sheets
+
+
+def render_sheets(sheets, pdf_path):
+    c = canvas.Canvas(pdf_path, pagesize=A4)
+    for sheet in sheets:
+        draw_order_sheet(c, sheet)
     c.save()
-    os.startfile(pdf_path, "open")
 
 
+def draw_order_sheet(c, sheet):
+    width, height = A4
+    margin_left = 40
+    margin_right = 70
+
+    # --- Cabecera ---
+    y = height - 50
+    c.setFont("Helvetica-Bold", 21)
+    c.drawString(margin_left, y, f"Orden de fabricación: {sheet['order_id']}")
+    y -= 28
+
+    c.setFont("Helvetica", 13)
+    c.drawString(margin_left, y, f"Cliente: {sheet['client_name'] or '-'}")
+    c.drawRightString(width - margin_right, y, f"Fecha: {sheet['date']}")
+    y -= 18
+
+    c.drawString(margin_left, y, f"Proforma: {sheet['proforma_number'] or '-'}")
+    y -= 30
+
+    # --- Producto principal ---
+    c.setFont("Helvetica-Bold", 15)
+    c.line(margin_left, y, width - margin_right, y)
+    y -= 22
+    c.drawString(margin_left, y, sheet["product_name"])
+    c.drawRightString(width - margin_right, y, f"Kgs: {sheet['units']}")
+    y -= 22
+    c.line(margin_left, y, width - margin_right, y)
+    y -= 25
+
+    # --- Cabecera tabla ---
+    c.setFont("Helvetica-Bold", 14)
+    x_descr_left = margin_left                 # Descripcion empieza desde el margen izquierdo
+    x_qty = width - margin_right - 75         # Kgs un poco a la izquierda, suficiente espacio para 6 caracteres
+    x_code_right = width - margin_right        # Codigo al final
+
+    c.drawString(x_descr_left, y, "Descripcion")
+    c.drawRightString(x_qty, y, "Kg")          # drawRightString usa la posición de la derecha
+    c.drawRightString(x_code_right, y, "Codigo")
+    y -= 16
+    c.line(margin_left, y, width - margin_right, y)
+    y -= 22
+
+    # --- Filas tabla ---
+    c.setFont("Helvetica", 14)
+    table_row_height = 24
+    for ing_name, qty, identifier in sheet["ingredients"]:
+        c.drawString(x_descr_left, y, ing_name)
+        c.drawRightString(x_qty, y, f"{qty:.3f}")        # Kgs
+        c.drawRightString(x_code_right, y, str(identifier))  # Codigo
+        y -= table_row_height
+
+        if y < 60:
+            c.showPage()
+            y = height - 50
+
+    c.showPage()
+
+
+@lru_cache(maxsize=4096)
 def format_date(ts):
-    """Return ts as DD-MM-YYYY"""
+    """Return a stored 'YYYY-MM-DD HH:MM:SS' timestamp as DD-MM-YYYY"""
     if not ts:
         return ""
-    candidates = ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%Y-%m-%dT%H:%M:%S.%f"]
-    for fmt in candidates:
-        try:
-            dt = datetime.strptime(ts, fmt)
-            return dt.strftime("%d-%m-%Y")
-        except Exception:
-            pass
-    return str(ts)
+    ts = str(ts)
+    if len(ts) >= 10 and ts[4] == "-" and ts[7] == "-":
+        return f"{ts[8:10]}-{ts[5:7]}-{ts[0:4]}"
+    return ts
@@ -1,5 +1,6 @@
 import tkinter as tk
 import database
+from .bindings import ListboxBinding, upsert_row
 
 
 class ProductListFrame(tk.LabelFrame):
@@ -22,19 +23,35 @@ class ProductListFrame(tk.LabelFrame):
         scroll.pack(side=tk.LEFT, fill=tk.Y)
 
         self.listbox.bind("<<ListboxSelect>>", self.on_select)
+        self.listbox_binding = ListboxBinding(self.listbox)
+        self.all_materials = []  # full list from the DB; filtered in memory while typing
+
+        controller.subscribe(database.MaterialAdded, self.on_material_changed)
+        controller.subscribe(database.MaterialUpdated, self.on_material_changed)
+        controller.subscribe(database.DatabaseReplaced, lambda event: self.refresh())
 
     def refresh(self):
-        filter_text = self.search_var.get() or ""
-        self.listbox.delete(0, tk.END)
-        self.products = []
+        materials = database.get_material_columns()
+        self.all_materials = list(zip(materials.id, materials.name))
+        self.apply_filter()
+
+    def on_material_changed(self, event):
+        material = database.get_material_by_id(event.material_id)
+        if material:
+            upsert_row(self.all_materials, (material.id, material.name), sort_key=lambda row: row[1])
+            self.apply_filter()
 
-        for mid, mname, identifier, price in database.get_materials():
-            if filter_text.lower() in mname.lower():
-                self.listbox.insert(tk.END, mname)
-                self.products.append((mid, mname))
+    def apply_filter(self):
+        text = (self.search_var.get() or "").strip()
+        if text:
+            # Every substring match, then typo- and accent-tolerant ones, on name or identifier
+            self.products = [(hit.material_id, hit.name) for hit in database.search_materials(text, limit=None)]
+        else:
+            self.products = list(self.all_materials)
+        self.listbox_binding.update(self.products)
 
     def on_search(self, event=None):
-        self.refresh()
+        self.apply_filter()
 
     def on_select(self, event=None):
         sel = self.listbox.curselection()
@@ -46,6 +63,7 @@ class ProductListFrame(tk.LabelFrame):
         self.controller.selected_product_id = product_id
 
         # Load its formula from DB
+        self.controller.formula_version = database.get_formula_version(product_id)
         rows = database.get_formulas(product_id)
         self.controller.formula_table = [
             {"id": r[0], "name": r[1], "qty": r[2], "price": r[3]} for r in rows
@@ -0,0 +1,174 @@
+import atexit
+import cProfile
+import os
+import sys
+import time
+import tkinter as tk
+import tracemalloc
+from datetime import datetime
+from functools import wraps
+import database
+from stats import percentile
+
+# Opt-in profiling of UI callbacks: None (off), "time", "cprofile" or "tracemalloc".
+# "time" only measures; the other two also capture slow callbacks.
+PROFILE = os.environ.get("MATERIALMANAGER_PROFILE") or None
+
+# Callbacks slower than this (event to idle) are captured
+SLOW_MS = float(os.environ.get("MATERIALMANAGER_PROFILE_SLOW_MS", 250))
+
+# Reports folder; None means a "profiles" folder next to the database
+PROFILE_DIR = None
+
+# Only callbacks defined in these modules are measured
+MODULE_PREFIX = "ui."
+
+samples = {}  # action -> [milliseconds]
+slow_calls = []  # (action, milliseconds, capture file or None)
+
+_depth = 0
+_seq = 0
+_in_after = 0
+_original_register = tk.Misc._register
+_original_after = tk.Misc.after
+
+
+def install():
+    """
+    Wrap every Tk callback registered from ui/*.py (command=, bind, trace)
+    so its time from event to idle is recorded. after() timers (event
+    delivery, print and kiosk polls, price sweeps) are not user actions and
+    are left out. Must run before widgets are created; the percentile summary
+    is written at exit.
+    """
+    if not PROFILE or tk.Misc._register is not _original_register:
+        return
+    if PROFILE == "tracemalloc":
+        tracemalloc.start(25)
+    tk.Misc._register = _register
+    tk.Misc.after = _after
+    atexit.register(write_report)
+
+
+def _register(self, func, subst=None, needcleanup=1):
+    if not _in_after and (getattr(func, "__module__", None) or "").startswith(MODULE_PREFIX):
+        func = _wrap(self, func)
+    return _original_register(self, func, subst, needcleanup)
+
+
+def _after(self, ms, func=None, *args):
+    """Misc.after (and after_idle) registering its callback unmeasured."""
+    global _in_after
+    _in_after += 1
+    try:
+        return _original_after(self, ms, func, *args)
+    finally:
+        _in_after -= 1
+
+
+def _action_name(func):
+    func = getattr(func, "__func__", func)
+    return f"{func.__module__[len(MODULE_PREFIX):]}.{func.__qualname__}"
+
+
+def _wrap(widget, func):
+    action = _action_name(func)
+
+    @wraps(func)
+    def measured(*args):
+        global _depth
+        if _depth:
+            # Nested callback (update(), event_generate, dialogs): the outer one owns the time
+            return func(*args)
+        _depth += 1
+        profiler = None
+        if PROFILE == "cprofile":
+            profiler = cProfile.Profile()
+        elif PROFILE == "tracemalloc":
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            if profiler:
+                return profiler.runcall(func, *args)
+            return func(*args)
+        finally:
+            _depth -= 1
+            _until_idle(widget, action, start, profiler)
+
+    return measured
+
+
+def _until_idle(widget, action, start, profiler):
+    """Record the callback once Tk has run the redraws and idle work it queued."""
+
+    def done():
+        ms = (time.perf_counter() - start) * 1000
+        try:
+            widget.deletecommand(name)
+        except tk.TclError:
+            pass
+        samples.setdefault(action, []).append(ms)
+        if ms >= SLOW_MS:
+            slow_calls.append((action, ms, _capture(action, profiler)))
+
+    # Registered with the original _register so the probe itself is not measured
+    name = _original_register(widget, done)
+    try:
+        widget.tk.call("after", "idle", name)
+    except tk.TclError:
+        done()  # the application was destroyed by the callback (quit)
+
+
+def _capture(action, profiler):
+    global _seq
+    if PROFILE not in ("cprofile", "tracemalloc"):
+        return None
+    _seq += 1
+    directory = _report_dir()
+    base = os.path.join(directory, f"{_seq:04d}-{action.replace('<', '').replace('>', '')}")
+    if profiler:
+        path = base + ".prof"
+        profiler.dump_stats(path)
+        return path
+
+    path = base + ".txt"
+    _, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().statistics("lineno")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"{action}: peak {peak / 1024:.0f} KiB\n\n")
+        for stat in stats[:30]:
+            f.write(f"{stat}\n")
+    return path
+
+
+def _report_dir():
+    directory = PROFILE_DIR or os.path.join(os.path.dirname(os.path.abspath(database.DB_NAME)), "profiles")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def summary():
+    """Rows of (action, count, p50, p90, p99, max, total) in ms, slowest p90 first."""
+    rows = []
+    for action, values in samples.items():
+        values = sorted(values)
+        rows.append((action, len(values), percentile(values, 50), percentile(values, 90),
+                     percentile(values, 99), values[-1], sum(values)))
+    rows.sort(key=lambda row: row[3], reverse=True)
+    return rows
+
+
+def write_report():
+    if not samples:
+        return None
+    path = os.path.join(_report_dir(), f"resumen-{datetime.now():%Y%m%d-%H%M%S}.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"{'action':<60} {'n':>6} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9} {'total':>10}\n")
+        for action, n, p50, p90, p99, high, total in summary():
+            f.write(f"{action:<60} {n:>6} {p50:>9.1f} {p90:>9.1f} {p99:>9.1f} {high:>9.1f} {total:>10.1f}\n")
+        if slow_calls:
+            f.write(f"\nslow calls (>= {SLOW_MS:.0f} ms):\n")
+            for action, ms, capture in slow_calls:
+                f.write(f"{ms:>9.1f}  {action}  {capture or ''}\n")
+    print(f"profile summary written to {path}", file=sys.stderr)
+    return path
@@ -21,9 +21,25 @@ class SaveBar(tk.Frame):
             messagebox.showerror("Error", "Selecciona un producto para guardar su fórmula")
             return
         ingredients = [(e["id"], e["qty"]) for e in self.controller.formula_table]
-        database.update_formula(product_id, ingredients)
+        try:
+            rows = self.write_formula(product_id, ingredients, self.controller.formula_version)
+        except database.ConcurrentModificationError:
+            overwrite = messagebox.askyesno(
+                "Conflicto",
+                "Otro usuario ha guardado esta fórmula mientras la editabas.\n"
+                "¿Sobrescribir su versión con la tuya?"
+            )
+            if not overwrite:
+                return
+            rows = self.write_formula(product_id, ingredients)
         messagebox.showinfo("Success", "Formula guardada correctamente")
-        # Reload to be safe
-        rows = database.get_formulas(product_id)
         self.controller.formula_table = [{"id": r[0], "name": r[1], "qty": r[2], "price": r[3]} for r in rows]
         self.controller.frames["formula_editor"].update_display()
+
+    def write_formula(self, product_id, ingredients, expected_version=None):
+        """Save the formula and reload it (with the new prices) in one transaction."""
+        with database.transaction():
+            self.controller.formula_version = database.update_formula(
+                product_id, ingredients, expected_version=expected_version
+            )
+            return database.get_formulas(product_id)
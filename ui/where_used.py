@@ -0,0 +1,34 @@
+import tkinter as tk
+from tkinter import ttk
+import database
+
+
+class WhereUsedDialog(tk.Toplevel):
+    """Every product that contains a material, at any depth (database.where_used)."""
+
+    def __init__(self, parent, material_id, material_name):
+        super().__init__(parent)
+        self.title(f"Dónde se usa: {material_name}")
+        self.transient(parent)
+
+        rows = database.where_used(material_id)
+        tk.Label(self, text=f"{len(rows)} productos contienen '{material_name}'",
+                 font=("Arial", 10, "bold")).pack(anchor="w", padx=8, pady=4)
+
+        columns = ("product", "depth", "quantity")
+        tree = ttk.Treeview(self, columns=columns, show="headings", height=15)
+        tree.heading("product", text="Producto")
+        tree.heading("depth", text="Nivel")
+        tree.heading("quantity", text="Cantidad por unidad")
+        tree.column("product", width=320, anchor="w")
+        tree.column("depth", width=60, anchor="center")
+        tree.column("quantity", width=140, anchor="e")
+        scroll = tk.Scrollbar(self, command=tree.yview)
+        tree.config(yscrollcommand=scroll.set)
+
+        for row in rows:
+            tree.insert("", "end", iid=str(row.product_id), values=(row.name, row.depth, f"{row.quantity:.3f}"))
+
+        tk.Button(self, text="Cerrar", width=12, command=self.destroy).pack(side=tk.BOTTOM, anchor="e", padx=6, pady=6)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(8, 0))
+        scroll.pack(side=tk.LEFT, fill=tk.Y)